@@ -1,5 +1,7 @@
 from __future__ import print_function
 import argparse
+import csv
+import json
 from math import ceil, floor, log
 import textwrap
 
@@ -17,6 +19,9 @@ DEFAULT_NKEY = 100  # (M)
 DEFAULT_NCONN = 5 * K
 DEFAULT_FAILURE_DOMAIN = 5.0  # 5% of the nodes may be lost at once
 DEFAULT_SIZE = 64  # slimcache only
+DEFAULT_HIT_RATIO = 0.95  # only used with a hit ratio curve
+DEFAULT_CHURN = 0.0  # slimcache only, fraction of sets writing a new key
+DEFAULT_MAX_EVICT = 0.001  # slimcache only, evictions of keys in use per set
 
 MAX_HOST_LIMIT = 10  # based on platform / job size constraint
 
@@ -25,6 +30,9 @@ CONN_OVERHEAD = 33 * KB  # 2 16KiB buffers, one channel, and stream overhead
 SAFETY_BUF = 128  # in MB
 BASE_OVERHEAD = 10  # in MB
 KQPS = 30  # much lower than single-instance max, picked to scale to 10 jobs/host
+# with a measured ceiling (--calibration), the fraction of it a job is sized for,
+# leaving room for co-located jobs and load spikes
+DEFAULT_UTILIZATION = 0.5
 # segcache needs 8/7*8 byte per object for hash table, considering
 # hash bucket overflow, give it 12, this should be sufficient for hash table load 1
 HASH_OVERHEAD = {'twemcache': 8, 'slimcache': 0, 'segcache': 12}
@@ -48,6 +56,159 @@ def hash_parameters(nkey, runnable):
   return (hash_power, ram_hash)
 
 
+def load_mrc(fname):
+  """load a hit ratio curve from csv, with columns cache_bytes,[objects,]hit_ratio
+     (as written by klog/analyze.py --mrc). Returns [(cache_bytes, objects, hit_ratio)]
+     sorted by size, objects being None if not provided.
+  """
+  curve = []
+  with open(fname) as f:
+    rows = list(csv.reader(f))
+  header = ['cache_bytes', 'hit_ratio']
+  if rows and not rows[0][0].replace('.', '', 1).isdigit():
+    header = [col.strip() for col in rows.pop(0)]
+  for row in rows:
+    if not row:
+      continue
+    d = dict(zip(header, row))
+    objects = float(d['objects']) if 'objects' in d else None
+    curve.append((float(d['cache_bytes']), objects, float(d['hit_ratio'])))
+  if not curve:
+    raise ValueError('empty hit ratio curve in {}'.format(fname))
+  return sorted(curve)
+
+
+def mrc_points(curve, size):
+  """(objects, hit_ratio) points of a curve, deriving objects from size if missing"""
+  return [(obj if obj is not None else nbyte / size, ratio) for nbyte, obj, ratio in curve]
+
+
+def mrc_objects(curve, hit_ratio, size):
+  """smallest number of cached objects reaching hit_ratio, interpolating linearly,
+     or None if the curve never gets there
+  """
+  prev_obj, prev_ratio = 0.0, 0.0
+  for obj, ratio in mrc_points(curve, size):
+    if ratio >= hit_ratio:
+      if ratio == prev_ratio:
+        return obj
+      return prev_obj + (obj - prev_obj) * (hit_ratio - prev_ratio) / (ratio - prev_ratio)
+    prev_obj, prev_ratio = obj, ratio
+  return None
+
+
+def mrc_hit_ratio(curve, nobj, size):
+  """hit ratio with room for nobj objects, interpolating linearly"""
+  prev_obj, prev_ratio = 0.0, 0.0
+  for obj, ratio in mrc_points(curve, size):
+    if obj >= nobj:
+      return prev_ratio + (ratio - prev_ratio) * (nobj - prev_obj) / max(obj - prev_obj, 1e-9)
+    prev_obj, prev_ratio = obj, ratio
+  return prev_ratio
+
+
+def load_calibration(fname):
+  """load a profile written by load_testing/calibrate.py, returns
+     {nconn: [(size, kqps)]} sorted by nconn and size
+  """
+  with open(fname) as f:
+    profile = json.load(f)
+  table = {}
+  for p in profile['points']:
+    table.setdefault(p['nconn'], []).append((p['size'], p['kqps']))
+  if not table:
+    raise ValueError('no calibration points in {}'.format(fname))
+  return dict((nconn, sorted(points)) for nconn, points in table.items())
+
+
+def _interpolate(points, x):
+  """linear interpolation over sorted (x, y) in log(x), clamped at the ends"""
+  if x <= points[0][0]:
+    return points[0][1]
+  for (x0, y0), (x1, y1) in zip(points, points[1:]):
+    if x <= x1:
+      return y0 + (y1 - y0) * (log(x) - log(x0)) / (log(x1) - log(x0))
+  return points[-1][1]
+
+
+def calibrated_kqps(table, size, nconn):
+  """measured qps ceiling (K) of one instance for a key+value size and nconn"""
+  per_nconn = [(n, _interpolate(points, size)) for n, points in sorted(table.items())]
+  return _interpolate(per_nconn, nconn)
+
+
+def job_kqps(args):
+  """qps (K) one job is sized for: a share of the measured ceiling if a
+     calibration profile is given, KQPS otherwise
+  """
+  if getattr(args, 'calibration', None):
+    return calibrated_kqps(load_calibration(args.calibration), args.size, args.nconn) * \
+      args.utilization
+  return KQPS
+
+
+def working_set(args):
+  """returns (nkey, curve): nkey (M) is all keys, unless a hit ratio curve
+     (args.mrc) says a smaller working set already meets args.hit_ratio
+  """
+  nkey = args.nkey
+  curve = None
+  if getattr(args, 'mrc', None):
+    curve = load_mrc(args.mrc)
+    nobj = mrc_objects(curve, args.hit_ratio, args.size)
+    if nobj is None:
+      print('WARNING: hit ratio curve never reaches {:.4f}, sizing for all keys.'.format(
+        args.hit_ratio))
+    else:
+      nkey = min(nkey, 1.0 * nobj / M)
+  return nkey, curve
+
+
+def item_model(args, ram):
+  """returns (item_size, ram_partial, model) for a job of ram GB: item_size is
+     bytes per item including overhead, from the slab class model (model)
+     recommended for that much memory for twemcache when a size distribution
+     (args.sizes) is given; ram_partial is the memory (MB) of partially
+     filled slabs under that model.
+  """
+  item_size = int(KEYVAL_ALIGNMENT * ceil(1.0 * (ITEM_OVERHEAD[args.runnable] + args.size) /
+    KEYVAL_ALIGNMENT))
+  ram_partial = 0
+  model = None
+  if args.runnable == 'twemcache' and getattr(args, 'sizes', None):
+    # slab classes waste more than alignment does; size with the slab memory
+    # actually consumed per item, and set aside the partially filled slabs
+    import slab  # imports this module, so not at the top
+    sizes = slab.load_sizes(args.sizes)
+    rec = slab.recommend(sizes, ram * GB)
+    model = rec[2] if rec is not None else \
+      slab.SlabModel(sizes, item_max=slab.item_max_for(slab.SLAB_SIZE))
+    item_size = model.bytes_per_item()
+    ram_partial = int(ceil(1.0 * model.partial_mem() / MB))
+  return item_size, ram_partial, model
+
+
+def dataset(args, ram=None):
+  """what has to fit in memory, returns (nkey, item_size, ram_partial, model, curve),
+     see working_set() and item_model(); ram (GB) defaults to the smallest of args.ram
+  """
+  nkey, curve = working_set(args)
+  item_size, ram_partial, model = item_model(args, ram or min(args.ram))
+  return nkey, item_size, ram_partial, model, curve
+
+
+def cuckoo_load(args):
+  """fraction of slimcache's nitem the keys may fill (1.0 for other engines):
+     beyond it, cuckoo displacement chains run out and keys still in use are
+     evicted on more than args.max_evict of sets, see cuckoosim.py
+  """
+  if args.runnable != 'slimcache':
+    return 1.0
+  import cuckoosim  # requires numpy, only needed for slimcache
+  return cuckoosim.max_load(churn_rate=getattr(args, 'churn', DEFAULT_CHURN),
+                            max_evict=getattr(args, 'max_evict', DEFAULT_MAX_EVICT))
+
+
 def calculate(args):
   """calculate job configuration according to requirements.
      For segcache, returns a dict with:
@@ -62,16 +223,24 @@ def calculate(args):
       memory_bound
      For slimcache, return a dict with:
       cpu, ram, disk,
-      item_size, nitem,
+      item_size, nitem, load_factor (keys per slot nitem is sized for),
       instance, host_limit, rack_limit,
       memory_bound
+     For twemcache given a size distribution (args.sizes), item size comes from
+     the slab class model (slab.py) instead of --size, and the dict also has:
+      slab_size, slab_item_growth, slab_item_max (recommended), efficiency
+     If a hit ratio curve is given (args.mrc), only the objects needed to reach
+     args.hit_ratio have to fit in memory rather than all of nkey, and the dict
+     also has:
+      nkey_cached, min_mem (data memory per instance needed for the target),
+      hit_ratio (expected with the memory actually configured)
   """
   if args.failure_domain < FAILURE_DOMAIN_LOWER or args.failure_domain > FAILURE_DOMAIN_UPPER:
     print('ERROR: failure domain should be between {:.1f}% and {:.1f}'.format(
       FAILURE_DOMAIN_LOWER, FAILURE_DOMAIN_UPPER))
 
   # first calculate njob disrecarding memory, note both njob & bottleneck are not yet final
-  njob_qps = int(ceil(1.0 * args.qps / KQPS))
+  njob_qps = int(ceil(1.0 * args.qps / job_kqps(args)))
   njob_fd = int(ceil(100.0 / args.failure_domain))
   if njob_qps >= njob_fd:
     bottleneck = 'qps'
@@ -82,23 +251,29 @@ def calculate(args):
 
   # then calculate njob (vector) assuming memory-bound
 
+  nkey, curve = working_set(args)
+  load = cuckoo_load(args)
   # all ram-related values in this function are in MB
-  # amount of ram needed to store dataset, factoring in overhead
-  item_size = int(KEYVAL_ALIGNMENT * ceil(1.0 * (ITEM_OVERHEAD[args.runnable] + args.size) /
-    KEYVAL_ALIGNMENT))
-  ram_data = 1.0 * item_size * args.nkey * M / MB
   # per-job memory overhead, in MB
   ram_conn = int(ceil(1.0 * CONN_OVERHEAD * args.nconn / MB))
   ram_fixed = BASE_OVERHEAD + SAFETY_BUF
 
   njob_mem = []
+  models = []
   sorted_ram = sorted(args.ram)
   for ram in sorted_ram:
+    # slab classes are recommended for the memory they divide, so the item
+    # size and partial slabs depend on the candidate
+    item_size, ram_partial, model = item_model(args, ram)
+    # amount of ram needed to store dataset, factoring in overhead and, for
+    # slimcache, the slots left free so inserts find room
+    ram_data = 1.0 * item_size * nkey * M / MB / load
+    models.append((item_size, ram_partial, model, ram_data))
     ram = ram * GB / MB  # change unit to MB
     n_low = int(ceil(ram_data / ram))  # number of shards, lower bound
-    nkey_per_shard = 1.0 * args.nkey * M / n_low  # number of keys per shard, upper bound
+    nkey_per_shard = 1.0 * nkey * M / n_low  # number of keys per shard, upper bound
     hash_power, ram_hash = hash_parameters(nkey_per_shard, args.runnable)  # upper bound for both
-    n = int(ceil(ram_data / (ram - ram_fixed - ram_conn - ram_hash)))
+    n = int(ceil(ram_data / (ram - ram_fixed - ram_conn - ram_hash - ram_partial)))
     njob_mem.append(n)
 
   # get final njob count; prefer larger ram if it reduces njob, which means:
@@ -115,8 +290,10 @@ def calculate(args):
   if njob > WARNING_THRESHOLD:
     print('WARNING: more than {} instances needed, please verify input.'.format(WARNING_THRESHOLD))
 
-  # recalculate hash parameters with the final job count
-  nkey_per_shard = 1.0 * (sorted_ram[index] * GB - ram_fixed * MB - ram_conn * MB) / item_size
+  # recalculate hash parameters with the final job count and ram
+  item_size, ram_partial, model, ram_data = models[index]
+  nkey_per_shard = 1.0 * (sorted_ram[index] * GB - (ram_fixed + ram_conn + ram_partial) * MB) / \
+    item_size
   # used by twemcache and segcache
   hash_power, ram_hash = hash_parameters(nkey_per_shard, args.runnable)
   slab_mem = sorted_ram[index] * GB / MB - ram_fixed - ram_conn - ram_hash
@@ -134,15 +311,28 @@ def calculate(args):
       'rack_limit': rack_limit,
       'host_limit': host_limit,
       'bottleneck': bottleneck}
+  if curve is not None:
+    # per-instance data memory that just meets the target, and what the
+    # configured memory (slab_mem or nitem per instance) is expected to achieve
+    ret['nkey_cached'] = nkey
+    ret['min_mem'] = int(ceil(ram_data / njob))
+    cached = njob * (nitem * load if args.runnable == 'slimcache' else slab_mem * MB / item_size)
+    ret['hit_ratio'] = mrc_hit_ratio(curve, cached, args.size)
   if args.runnable == 'twemcache':
     ret['hash_power'] = hash_power
     ret['slab_mem'] = slab_mem
+    if model is not None:
+      ret['slab_size'] = model.slab_size
+      ret['slab_item_growth'] = model.growth
+      ret['slab_item_max'] = model.item_max
+      ret['efficiency'] = model.efficiency(slab_mem * MB)
   elif args.runnable == 'segcache':
       ret['hash_power'] = hash_power
       ret['seg_mem'] = slab_mem
   elif args.runnable == 'slimcache':
     ret['item_size'] = item_size
     ret['nitem'] = nitem
+    ret['load_factor'] = load
 
   return ret
 
@@ -162,6 +352,15 @@ def format_input(args):
              args.nconn, args.failure_domain))
 
 
+def mrc_format_output(config):
+  return textwrap.dedent('''
+    hit ratio curve:
+      keys to cache:   {:.3f} M
+      min data mem:    {} MB per instance
+      expected hit:    {:.4f}
+  '''.format(config['nkey_cached'], config['min_mem'], config['hit_ratio']))
+
+
 def twemcache_format_output(config):
   return textwrap.dedent('''
     pelikan_twemcache config:
@@ -181,11 +380,23 @@ def twemcache_format_output(config):
              config['instance'], config['host_limit'], config['rack_limit']))
 
 
+def slab_format_output(config):
+  return textwrap.dedent('''
+    slab classes (recommended):
+      slab_size:        {}
+      slab_item_growth: {:.2f}
+      slab_item_max:    {}
+      efficiency:       {:.3f}
+  '''.format(config['slab_size'], config['slab_item_growth'], config['slab_item_max'],
+             config['efficiency']))
+
+
 def slimcache_format_output(config):
   return textwrap.dedent('''
     pelikan_slimcache config:
       item_size:       {}
       nitem:           {}
+      load factor:     {:.3f}
 
     job config:
       cpu:             {}
@@ -195,7 +406,7 @@ def slimcache_format_output(config):
       host limit:      {}
       rack limit:      {}
 
-  '''.format(config['item_size'], config['nitem'],
+  '''.format(config['item_size'], config['nitem'], config['load_factor'],
              config['cpu'], config['ram'], config['disk'],
              config['instance'], config['host_limit'], config['rack_limit']))
 
@@ -228,6 +439,20 @@ parser.add_argument('--failure_domain', dest='failure_domain', type=float,
     help='percentage of server/data that may be lost simultaneously')
 parser.add_argument('--ram', nargs='+', type=int, default=RAM_CANDIDATES,
     help='provide a (sorted) list of container ram sizes to consider')
+parser.add_argument('--mrc', dest='mrc', type=str, default=None,
+    help='hit ratio curve csv (cache_bytes,[objects,]hit_ratio), e.g. from klog/analyze.py')
+parser.add_argument('--sizes', dest='sizes', type=str, default=None,
+    help='twemcache: key+value size distribution, csv of size,count or a keyspace json')
+parser.add_argument('--calibration', dest='calibration', type=str, default=None,
+    help='qps ceiling profile from load_testing/calibrate.py, replaces the fixed KQPS')
+parser.add_argument('--utilization', dest='utilization', type=float, default=DEFAULT_UTILIZATION,
+    help='fraction of the calibrated qps ceiling to use per job')
+parser.add_argument('--hit_ratio', dest='hit_ratio', type=float, default=DEFAULT_HIT_RATIO,
+    help='target hit ratio, used with --mrc')
+parser.add_argument('--churn', dest='churn', type=float, default=DEFAULT_CHURN,
+    help='slimcache: fraction of sets writing a new key in place of one in use')
+parser.add_argument('--max_evict', dest='max_evict', type=float, default=DEFAULT_MAX_EVICT,
+    help='slimcache: evictions of keys in use per set tolerated, sets the nitem headroom')
 # end of parser
 
 if __name__ == "__main__":
@@ -242,4 +467,8 @@ if __name__ == "__main__":
   print(format_input(args))
   config = calculate(args)
   print(format_output[args.runnable](config))
+  if 'slab_size' in config:
+    print(slab_format_output(config))
+  if 'hit_ratio' in config:
+    print(mrc_format_output(config))
   print('Cluster sizing is primarily driven by {}.\n'.format(config['bottleneck']))
@@ -0,0 +1,150 @@
+"""Replay one workload through models of twemcache, segcache and slimcache.
+
+For every engine and memory budget, the same klog trace (or synthetic
+workload) is run through the storage model of the engine:
+
+  twemcache  slab classes with random slab eviction (slabsim.py), a hash
+             table of 8 bytes per bucket
+  segcache   segments in TTL buckets with merge eviction (segsim.py), a hash
+             table of about 12 bytes per item
+  slimcache  a cuckoo table (cuckoosim.py) of fixed-size slots as large as
+             the largest item, no separate hash table
+
+The hash table comes out of the budget first, sized for the items the rest of
+it holds at the workload's mean size, as calculator.py sizes it. Each engine
+then reports its hit ratio, how many items it ends up holding, memory
+efficiency (key+value bytes of those items over the budget) and metadata per
+item (item header and hash table).
+
+The workload is streamed again by every simulation, which run in a process
+pool, one per engine and budget. Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import concurrent.futures
+from math import ceil, log
+
+import numpy as np
+
+from calculator import HASH_OVERHEAD, ITEM_OVERHEAD, KEYVAL_ALIGNMENT, MB
+import cuckoosim
+import segsim
+from slab import SLAB_SIZE
+import slabsim
+import workload
+
+
+ENGINES = ['twemcache', 'segcache', 'slimcache']
+MEM = [64 * MB]
+
+
+def hash_bytes(engine, mem, nkey, mean_kv):
+  """hash table bytes for the items mem holds at mean_kv key+value bytes,
+     never more buckets than there are keys
+  """
+  nitem = min(nkey, 1.0 * mem / (mean_kv + ITEM_OVERHEAD[engine] + HASH_OVERHEAD[engine]))
+  if HASH_OVERHEAD[engine] == 0 or nitem < 1:
+    return 0
+  return HASH_OVERHEAD[engine] * 2 ** int(ceil(log(max(nitem, 2), 2)))
+
+
+def slot_size(max_kv):
+  """cuckoo_item_size holding the largest item"""
+  size = ITEM_OVERHEAD['slimcache'] + max_kv
+  return int(KEYVAL_ALIGNMENT * ceil(1.0 * size / KEYVAL_ALIGNMENT))
+
+
+def simulate(engine, mem, chunks, nkey, mean_kv, max_kv, set_on_miss=True, slab_size=SLAB_SIZE,
+             seg_size=segsim.SEG_SIZE, slot=0, seed=workload.SEED):
+  """run a workload through one engine model; returns a dict of results.
+     slot is cuckoo_item_size, 0 to hold the largest item (max_kv)
+  """
+  table = hash_bytes(engine, mem, nkey, mean_kv)
+  data_mem = mem - table
+  kv = np.zeros(nkey + 1, dtype=np.int64)  # key+value bytes, by key
+  if engine == 'twemcache':
+    cache = slabsim.SlabCache(data_mem, slab_size, set_on_miss=set_on_miss, seed=seed)
+  elif engine == 'segcache':
+    cache = segsim.SegCache(data_mem, seg_size, set_on_miss=set_on_miss, seed=seed)
+  else:
+    item_size = slot or slot_size(max_kv)
+    nitem = int(data_mem // item_size)
+    if nitem < 1:
+      raise ValueError('{} bytes hold no slot of {} bytes'.format(data_mem, item_size))
+    cache = cuckoosim.Cuckoo(nitem, seed=seed)
+  now = 0.0
+  for op, key, klen, vlen, ttl, t in chunks:
+    if key.max() >= len(kv):
+      kv = np.concatenate([kv, np.zeros(int(key.max()) + 1 - len(kv), dtype=np.int64)])
+    known = vlen >= 0
+    kv[key[known]] = klen[known] + vlen[known]
+    if engine == 'twemcache':
+      cache.process(op, key, klen, vlen, ttl, t)
+    elif engine == 'segcache':
+      size = np.where(known, segsim.item_size(klen, vlen), 0)
+      cache.process(op, key, size, ttl, t)
+    else:
+      size = np.where(known, ITEM_OVERHEAD['slimcache'] + klen + vlen, 0)
+      cache.replay(op, key, size, ttl, t, item_size, set_on_miss)
+    now = float(t[-1])
+  live = live_keys(engine, cache, now)
+  nlive = len(live)
+  return {
+    'engine': engine, 'mem': mem, 'hash_mem': table,
+    'hit_ratio': 1.0 * cache.stats['hit'] / max(1, cache.stats['get']),
+    'items': nlive,
+    'efficiency': 1.0 * kv[live].sum() / mem,
+    'metadata': ITEM_OVERHEAD[engine] + (1.0 * table / nlive if nlive else 0.0),
+    'oversize': cache.stats.get('oversize', 0)}
+
+
+def live_keys(engine, cache, now):
+  if engine == 'segcache':
+    stored = np.nonzero(cache.key_seg >= 0)[0]
+    return stored[cache.seg_expire[cache.key_seg[stored]] > now]
+  return cache.live_keys(now)
+
+
+def run_config(args, engine, mem, profile):
+  """one simulation, as a process pool task"""
+  return simulate(engine, mem, workload.from_args(args), *profile,
+                  set_on_miss=workload.set_on_miss(args), slab_size=args.slab_size, seg_size=args.seg_size,
+                  slot=args.slot_size, seed=args.seed)
+
+
+def format_results(results):
+  lines = ['{:>10} {:>10} {:>9} {:>12} {:>10} {:>14} {:>8}'.format(
+    'engine', 'mem MB', 'hit', 'items', 'efficiency', 'metadata/item', 'hash MB')]
+  for r in results:
+    lines.append('{:>10} {:>10.1f} {:>9.4f} {:>12} {:>10.3f} {:>14.1f} {:>8.1f}'.format(
+      r['engine'], 1.0 * r['mem'] / MB, r['hit_ratio'], r['items'], r['efficiency'],
+      r['metadata'], 1.0 * r['hash_mem'] / MB))
+    if r['oversize']:
+      lines.append('{:>10} {} sets too large to store'.format('', r['oversize']))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Replay a klog trace or a synthetic workload through the twemcache,
+    segcache and slimcache storage models for each memory budget, and compare
+    hit ratio, memory efficiency and metadata per item.
+    """)
+  parser.add_argument('--engine', dest='engine', nargs='+', choices=ENGINES, default=ENGINES, help='engines to compare')
+  parser.add_argument('--mem', dest='mem', type=int, nargs='+', default=MEM, help='memory budget(s) in bytes, hash table included')
+  parser.add_argument('--slab_size', dest='slab_size', type=int, default=SLAB_SIZE, help='twemcache: slab size in bytes')
+  parser.add_argument('--seg_size', dest='seg_size', type=int, default=segsim.SEG_SIZE, help='segcache: segment size in bytes')
+  parser.add_argument('--slot_size', dest='slot_size', type=int, default=0, help='slimcache: cuckoo_item_size, 0 for the largest item (larger ones are rejected)')
+  workload.add_arguments(parser)
+  parser.add_argument('--processes', dest='processes', type=int, default=0, help='parallel simulations, 0 for one per core')
+
+  args = parser.parse_args()
+
+  profile = workload.profile(workload.from_args(args))
+  print('{} keys, key+value bytes: {:.1f} mean, {} max\n'.format(*profile))
+  configs = [(e, m) for m in args.mem for e in args.engine]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes or None) as pool:
+    results = list(pool.map(run_config, [args] * len(configs), *zip(*configs),
+                            [profile] * len(configs)))
+  print(format_results(results))
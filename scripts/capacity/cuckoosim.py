@@ -0,0 +1,435 @@
+"""Simulator of the slimcache cuckoo table (src/storage/cuckoo) under key churn.
+
+Every key has D = 4 candidate slots out of cuckoo_nitem. A set updates the key
+in place if it is present, else inserts it into the first of its candidates
+that holds no valid item. With all four taken, a victim among them is chosen by
+cuckoo_policy (random, or the one expiring soonest) and displaced: moved to an
+invalid candidate of its own, or, failing that, displacing another item in
+turn, for at most cuckoo_displace steps; the item at the end of a chain that
+found no room is evicted. As in cuckoo.c, the check meant to keep a chain from
+revisiting a slot never skips a candidate, so a step may pick the slot the
+displaced item already is in.
+
+The workload keeps nkey keys in use: the table is first filled with all of
+them, then every set either rewrites a key in use or, with probability churn,
+replaces one of them with a new key. A replaced key is left to expire or be
+evicted, or deleted with probability delete_ratio. Evicting a key still in use
+is what a client sees as an unexpected miss; the load factor (nkey / nitem)
+keeping such evictions rare is the headroom calculator.py sizes nitem with.
+
+Sets are processed in chunks with NumPy: updates, and inserts with a free
+candidate no earlier insert of the chunk claims, are applied at once from the
+state at the start of the chunk; the remaining inserts, which displace, are
+replayed one by one exactly as cuckoo_insert() does. Keys replaced within a
+chunk may still be rewritten until the chunk ends. replay() runs a trace of
+gets, sets and deletes (workload.py) through the table instead.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import concurrent.futures
+import random
+
+import numpy as np
+
+import workload
+from workload import DELETE, GET
+
+
+# mirrors src/storage/cuckoo/cuckoo.c and cuckoo.h
+D = 4
+CUCKOO_DISPLACE = 2
+CUCKOO_MAX_TTL = 30 * 24 * 60 * 60  # in seconds, a ttl of 0 means this
+POLICIES = ['random', 'expire']
+
+NITEM = 1 << 20
+LOAD = 0.9  # nkey / nitem
+CHURN = 0.05  # fraction of sets writing a new key
+DELETE_RATIO = 0.0
+TTL = 0  # in seconds
+RATE = 100000  # sets per second of simulated time
+NSET_FACTOR = 4  # sets after the fill, per slot
+CHUNK = 4096
+SEED = 0
+
+# headroom search, see max_load()
+MAX_EVICT = 0.001  # evictions of keys in use per set
+SEARCH_NITEM = 1 << 14
+SEARCH_LOW = 0.5
+SEARCH_STEPS = 7
+
+
+def mix(x):
+  """splitmix64 finalizer, vectorized over uint64"""
+  x = x ^ (x >> np.uint64(30))
+  x = x * np.uint64(0xbf58476d1ce4e5b9)
+  x = x ^ (x >> np.uint64(27))
+  x = x * np.uint64(0x94d049bb133111eb)
+  return x ^ (x >> np.uint64(31))
+
+
+class Cuckoo(object):
+
+  def __init__(self, nitem=NITEM, displace=CUCKOO_DISPLACE, policy='random', seed=SEED):
+    if policy not in POLICIES:
+      raise ValueError('unknown cuckoo policy {}'.format(policy))
+    self.nitem = nitem
+    self.displace = displace
+    self.policy = policy
+    self.rng = random.Random(seed)
+    self.salt = np.uint64(seed) * np.uint64(D)
+    # per slot: key id (-1 for none), expire time (-1 if never written or
+    # deleted) and the candidates of the key, which move along with it
+    self.key = np.full(nitem, -1, dtype=np.int64)
+    self.expire = np.full(nitem, -1.0)
+    self.cand = np.zeros((nitem, D), dtype=np.int64)
+    # per key, grown on demand
+    self.in_use = np.zeros(0, dtype=bool)
+    # counters; moves[i] is the number of inserts that moved i items
+    self.key_size = np.zeros(0, dtype=np.int64)  # replay() only
+    self.stats = dict.fromkeys(['set', 'update', 'insert', 'displace', 'evict', 'evict_in_use',
+                                'expire', 'delete', 'get', 'hit', 'oversize'], 0)
+    self.moves = np.zeros(displace + 1, dtype=np.int64)
+    self.first_evict_load = None
+
+
+  def offsets(self, keys):
+    """candidate slots of keys, one row each, as cuckoo_hash()"""
+    x = keys.astype(np.uint64)[:, None] * np.uint64(D) + np.arange(D, dtype=np.uint64)
+    return (mix(x + self.salt) % np.uint64(self.nitem)).astype(np.int64)
+
+
+  def _grow(self, nkey):
+    if nkey > len(self.in_use):
+      grow = max(nkey, 2 * len(self.in_use)) - len(self.in_use)
+      self.in_use = np.concatenate([self.in_use, np.zeros(grow, dtype=bool)])
+      self.key_size = np.concatenate([self.key_size, np.zeros(grow, dtype=np.int64)])
+
+
+  def valid(self, now):
+    return self.expire >= now
+
+
+  def _find(self, keys, now):
+    """(candidates, slot of each key or -1)"""
+    cand = self.offsets(keys)
+    match = (self.key[cand] == keys[:, None]) & (self.expire[cand] >= now)
+    slot = np.where(match.any(axis=1), cand[np.arange(len(keys)), match.argmax(axis=1)], -1)
+    return cand, slot
+
+
+  def _pick(self, offsets):
+    """_select_candidate(); _sort_candidate() puts the same slot first"""
+    if self.policy == 'random':
+      return offsets[self.rng.randrange(D)]
+    expire = self.expire[offsets]
+    return offsets[int(np.argmin(expire))]
+
+
+  def _insert_one(self, k, cand, expire, now):
+    """cuckoo_insert() of a key with no free candidate at the start of the chunk"""
+    slot_key, slot_expire = self.key, self.expire
+    for o in cand:
+      if slot_expire[o] < now:
+        self._store(o, k, cand, expire)
+        self.moves[0] += 1
+        return
+    displaced = self._pick(cand)
+    path = [displaced]
+    evict = True
+    while len(path) <= self.displace:
+      oc = self.cand[displaced]
+      empty = [o for o in oc if slot_expire[o] < now]
+      if empty:
+        if slot_key[empty[0]] >= 0:
+          self.stats['expire'] += 1
+        path.append(empty[0])
+        evict = False
+        break
+      displaced = self._pick(oc)
+      path.append(displaced)
+    step = len(path) - 1
+    if evict:
+      victim = slot_key[path[step]]
+      self.stats['evict'] += 1
+      if self.in_use[victim]:
+        self.stats['evict_in_use'] += 1
+      if self.first_evict_load is None:
+        self.first_evict_load = float(self.valid(now).sum()) / self.nitem
+    for i in range(step, 0, -1):
+      src, dst = path[i - 1], path[i]
+      slot_key[dst], slot_expire[dst] = slot_key[src], slot_expire[src]
+      self.cand[dst] = self.cand[src]
+    self.stats['displace'] += step
+    self.moves[step] += 1
+    slot_key[path[0]], slot_expire[path[0]] = k, expire
+    self.cand[path[0]] = cand
+
+
+  def _store(self, o, k, cand, expire):
+    if self.key[o] >= 0 and self.expire[o] >= 0:
+      self.stats['expire'] += 1
+    self.key[o], self.expire[o] = k, expire
+    self.cand[o] = cand
+
+
+  def process(self, key, retired, delete, t, ttl=TTL):
+    """simulate one chunk of sets; retired[i] is the key replaced by key[i]
+       (-1 if none), deleted if delete[i]
+    """
+    n = len(key)
+    if n == 0:
+      return
+    now = float(t[0])
+    expire = t + (ttl or CUCKOO_MAX_TTL)
+    self._grow(int(max(key.max(), retired.max())) + 1)
+    gone = retired[retired >= 0]
+    self.in_use[gone] = False
+    dkeys = np.unique(retired[delete & (retired >= 0)])
+    if len(dkeys):
+      _, slot = self._find(dkeys, now)
+      slot = slot[slot >= 0]
+      self.key[slot], self.expire[slot] = -1, -1.0
+      self.stats['delete'] += len(slot)
+    self.in_use[key] = True
+    self.stats['set'] += n
+
+    # one write per distinct key, in order of first appearance, expiring as
+    # the last set of it in the chunk says
+    uk, first = np.unique(key, return_index=True)
+    _, last = np.unique(key[::-1], return_index=True)
+    order = np.argsort(first, kind='stable')
+    uk, uexpire = uk[order], expire[n - 1 - last[order]]
+    inserts = self._write(uk, uexpire, now)
+    self.stats['insert'] += inserts
+    self.stats['update'] += n - inserts
+
+
+  def _write(self, uk, uexpire, now):
+    """set distinct keys, in order; returns how many were inserts"""
+    cand, slot = self._find(uk, now)
+    hit = slot >= 0
+    self.expire[slot[hit]] = uexpire[hit]
+    miss = np.nonzero(~hit)[0]
+
+    # inserts into a free candidate, unless an earlier insert claims it
+    free = self.expire[cand[miss]] < now
+    has = free.any(axis=1)
+    target = cand[miss, free.argmax(axis=1)]
+    idx = np.nonzero(has)[0]
+    _, win = np.unique(target[idx], return_index=True)
+    fast = np.zeros(len(miss), dtype=bool)
+    fast[idx[win]] = True
+    o, m = target[fast], miss[fast]
+    self.stats['expire'] += int(((self.key[o] >= 0) & (self.expire[o] >= 0)).sum())
+    self.key[o], self.expire[o] = uk[m], uexpire[m]
+    self.cand[o] = cand[m]
+    self.moves[0] += len(m)
+    for i in miss[~fast]:
+      self._insert_one(int(uk[i]), cand[i], float(uexpire[i]), now)
+    return len(miss)
+
+
+  def replay(self, op, key, size, ttl, t, item_size, set_on_miss=True):
+    """simulate one chunk of a workload (see workload.py), size being the
+       item size of each request (0 if unknown); items larger than item_size
+       are rejected, as cuckoo_insert() does
+    """
+    if len(op) == 0:
+      return
+    now = float(t[0])
+    self._grow(int(key.max()) + 1)
+    known = size > 0
+    self.key_size[key[known]] = size[known]
+    _, slot = self._find(key, now)
+    hit, write, order, first = workload.decide(op, key, slot >= 0, set_on_miss)
+    self.stats['get'] += int((op == GET).sum())
+    self.stats['hit'] += int(hit.sum())
+    oversize = write & (self.key_size[key] > item_size)
+    self.stats['oversize'] += int(oversize.sum())
+    write &= ~oversize
+    self.stats['set'] += int(write.sum())
+
+    fpos = workload.final_changes(write | (op == DELETE), order, first)
+    dkeys = key[fpos[op[fpos] == DELETE]]
+    if len(dkeys):
+      _, slot = self._find(dkeys, now)
+      slot = slot[slot >= 0]
+      self.key[slot], self.expire[slot] = -1, -1.0
+      self.stats['delete'] += len(slot)
+    fpos = np.sort(fpos[op[fpos] != DELETE])
+    self.in_use[key[fpos]] = True
+    inserts = self._write(key[fpos], t[fpos] + np.where(ttl[fpos] > 0, ttl[fpos], CUCKOO_MAX_TTL), now)
+    self.stats['insert'] += inserts
+    self.stats['update'] += int(write.sum()) - inserts
+
+
+  def live_keys(self, now):
+    """keys stored and not expired"""
+    return self.key[self.valid(now) & (self.key >= 0)]
+
+
+  def load(self, now):
+    """valid items / nitem"""
+    return float(self.valid(now).sum()) / self.nitem
+
+
+def fill(nkey, rate=RATE, chunk=CHUNK, seed=SEED):
+  """yield chunks setting keys 0..nkey-1 once, in random order"""
+  rng = np.random.default_rng(seed)
+  keys = rng.permutation(nkey)
+  for start in range(0, nkey, chunk):
+    key = keys[start:start + chunk]
+    none = np.full(len(key), -1, dtype=np.int64)
+    yield key, none, np.zeros(len(key), dtype=bool), (start + np.arange(len(key))) / float(rate)
+
+
+def churn(nkey, nset, churn=CHURN, delete_ratio=DELETE_RATIO, rate=RATE, chunk=CHUNK,
+          seed=SEED):
+  """yield chunks of sets to the nkey keys in use after fill(), each replacing
+     one of them with a new key with probability churn
+  """
+  rng = np.random.default_rng(seed + 1)
+  in_use = np.arange(nkey, dtype=np.int64)
+  next_key = nkey
+  for start in range(0, nset, chunk):
+    n = min(chunk, nset - start)
+    pos = rng.integers(nkey, size=n)
+    new = rng.random(n) < churn
+    key = in_use[pos]
+    retired = np.full(n, -1, dtype=np.int64)
+    ci = np.nonzero(new)[0]
+    key[ci] = next_key + np.arange(len(ci))
+    next_key += len(ci)
+    # a position replaced twice in the chunk retires the key it got first
+    order = np.argsort(pos[ci], kind='stable')
+    cs, ps = ci[order], pos[ci][order]
+    again = np.r_[False, ps[1:] == ps[:-1]]
+    retired[cs] = np.where(again, np.roll(key[cs], 1), in_use[ps])
+    last = np.r_[ps[1:] != ps[:-1], True] if len(ps) else np.zeros(0, dtype=bool)
+    in_use[ps[last]] = key[cs[last]]
+    delete = new & (rng.random(n) < delete_ratio)
+    yield key, retired, delete, (nkey + start + np.arange(n)) / float(rate)
+
+
+def simulate(nitem=NITEM, load=LOAD, displace=CUCKOO_DISPLACE, policy='random', churn_rate=CHURN,
+             delete_ratio=DELETE_RATIO, ttl=TTL, rate=RATE, nset=None, chunk=CHUNK, seed=SEED):
+  """fill the table with load * nitem keys, then run nset sets of churn
+     (NSET_FACTOR * nitem by default); returns a dict of results, rates being
+     per set after the fill
+  """
+  nkey = int(load * nitem)
+  nset = nset if nset is not None else NSET_FACTOR * nitem
+  table = Cuckoo(nitem, displace, policy, seed)
+  now = 0.0
+  for key, retired, delete, t in fill(nkey, rate, chunk, seed):
+    table.process(key, retired, delete, t, ttl)
+  fill_load = table.load(float(t[-1]))
+  before, moves = dict(table.stats), table.moves.copy()
+  for key, retired, delete, t in churn(nkey, nset, churn_rate, delete_ratio, rate, chunk, seed):
+    table.process(key, retired, delete, t, ttl)
+    now = float(t[-1])
+  stats = dict((k, table.stats[k] - before[k]) for k in table.stats)
+  moves = table.moves - moves
+  sets = max(1, stats['set'])
+  inserts = max(1, stats['insert'])
+  return {
+    'nitem': nitem, 'nkey': nkey, 'displace': displace, 'policy': policy,
+    'fill_load': fill_load, 'load': table.load(now),
+    'first_evict_load': table.first_evict_load,
+    'evict_rate': 1.0 * stats['evict'] / sets,
+    'evict_in_use_rate': 1.0 * stats['evict_in_use'] / sets,
+    'insert_rate': 1.0 * stats['insert'] / sets,
+    'displace_per_set': 1.0 * stats['displace'] / sets,
+    'displace_per_insert': 1.0 * stats['displace'] / inserts,
+    'displace_max': int(np.nonzero(moves)[0].max()) if moves.any() else 0,
+    'moves': [int(m) for m in moves],
+    'stats': stats}
+
+
+def max_load(displace=CUCKOO_DISPLACE, policy='random', churn_rate=CHURN,
+             delete_ratio=DELETE_RATIO, max_evict=MAX_EVICT, nitem=SEARCH_NITEM, seed=SEED):
+  """largest nkey / nitem, to 1/2**SEARCH_STEPS, at which keys in use are
+     evicted on at most max_evict of sets; SEARCH_LOW if none is found. The
+     load factor doesn't depend on the size of the table, so a small one is
+     simulated.
+  """
+  low, high = SEARCH_LOW, 1.0
+  for _ in range(SEARCH_STEPS):
+    mid = (low + high) / 2
+    result = simulate(nitem, mid, displace, policy, churn_rate, delete_ratio,
+                      chunk=max(1, nitem // 64), seed=seed)
+    if result['evict_in_use_rate'] <= max_evict:
+      low = mid
+    else:
+      high = mid
+  return low
+
+
+def format_result(r):
+  lines = ['nitem {} nkey {} (load {:.3f}) displace {} policy {}'.format(
+    r['nitem'], r['nkey'], 1.0 * r['nkey'] / r['nitem'], r['displace'], r['policy'])]
+  first = r['first_evict_load']
+  lines.append('  load after fill:        {:.4f}, first eviction at {}'.format(
+    r['fill_load'], 'none' if first is None else '{:.4f}'.format(first)))
+  lines.append('  load after churn:       {:.4f}'.format(r['load']))
+  lines.append('  evictions per set:      {:.6f} ({:.6f} of keys in use)'.format(
+    r['evict_rate'], r['evict_in_use_rate']))
+  lines.append('  inserts per set:        {:.4f}'.format(r['insert_rate']))
+  lines.append('  moves per set:          {:.4f} mean ({:.4f} per insert), {} max'.format(
+    r['displace_per_set'], r['displace_per_insert'], r['displace_max']))
+  total = max(1, sum(r['moves']))
+  lines.append('  inserts by moves:       {}'.format(', '.join(
+    '{}: {:.4f}'.format(i, 1.0 * m / total) for i, m in enumerate(r['moves']))))
+  return '\n'.join(lines)
+
+
+def run_config(args, load, displace, policy):
+  """one simulation, as a process pool task"""
+  return simulate(args.nitem, load, displace, policy, args.churn, args.delete_ratio, args.ttl,
+                  args.rate, args.nset, args.chunk, args.seed)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Simulate the slimcache cuckoo table filled to each load factor and then
+    churned, for each displace/policy combination: load factor reached,
+    evictions per set and items moved per set.
+    """)
+  parser.add_argument('--nitem', dest='nitem', type=int, default=NITEM, help='cuckoo_nitem')
+  parser.add_argument('--load', dest='load', type=float, nargs='+', default=[LOAD], help='keys in use, as a fraction of nitem')
+  parser.add_argument('--displace', dest='displace', type=int, nargs='+', default=[CUCKOO_DISPLACE], help='cuckoo_displace (compiled in as CUCKOO_DISPLACE)')
+  parser.add_argument('--policy', dest='policy', nargs='+', choices=POLICIES, default=['random'], help='cuckoo_policy')
+  parser.add_argument('--churn', dest='churn', type=float, default=CHURN, help='fraction of sets writing a new key in place of one in use')
+  parser.add_argument('--delete_ratio', dest='delete_ratio', type=float, default=DELETE_RATIO, help='fraction of replaced keys deleted rather than left to expire or be evicted')
+  parser.add_argument('--ttl', dest='ttl', type=int, default=TTL, help='ttl of every set in seconds, 0 for cuckoo_max_ttl')
+  parser.add_argument('--rate', dest='rate', type=float, default=RATE, help='sets per simulated second')
+  parser.add_argument('--nset', dest='nset', type=int, default=None, help='sets after the fill, {} * nitem by default'.format(NSET_FACTOR))
+  parser.add_argument('--chunk', dest='chunk', type=int, default=CHUNK, help='sets simulated per vectorized step')
+  parser.add_argument('--seed', dest='seed', type=int, default=SEED, help='random seed')
+  parser.add_argument('--max_evict', dest='max_evict', type=float, default=None, help='also search the highest load evicting keys in use on at most this fraction of sets')
+  parser.add_argument('--processes', dest='processes', type=int, default=0, help='parallel simulations, 0 for one per core')
+
+  args = parser.parse_args()
+
+  configs = [(l, d, p) for l in args.load for d in args.displace for p in args.policy]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes or None) as pool:
+    results = list(pool.map(run_config, [args] * len(configs), *zip(*configs)))
+  for r in results:
+    print(format_result(r))
+    print('')
+  print('{:>6} {:>8} {:>8} {:>8} {:>12} {:>12} {:>10}'.format(
+    'load', 'displace', 'policy', 'reached', 'evict/set', 'in use/set', 'moves/set'))
+  for r in results:
+    print('{:>6.3f} {:>8} {:>8} {:>8.4f} {:>12.6f} {:>12.6f} {:>10.4f}'.format(
+      1.0 * r['nkey'] / r['nitem'], r['displace'], r['policy'], r['load'], r['evict_rate'],
+      r['evict_in_use_rate'], r['displace_per_set']))
+  if args.max_evict is not None:
+    print('')
+    for d in args.displace:
+      for p in args.policy:
+        print('displace {} policy {}: max load {:.3f} for {} evictions of keys in use per set'.format(
+          d, p, max_load(d, p, args.churn, args.delete_ratio, args.max_evict, seed=args.seed),
+          args.max_evict))
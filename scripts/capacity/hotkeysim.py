@@ -0,0 +1,247 @@
+"""Model of hotkey detection (src/hotkey) to evaluate its settings on a workload.
+
+The servers call hotkey_sample() on every get that hits. One key in every
+hotkey_sample_rate is pushed into a FIFO window of the last
+hotkey_sample_size keys sampled (key_window), the oldest popped when it is
+full, and counted in a map of key to occurrences in the window (kc_map); the
+key is signaled hot when its count reaches hotkey_threshold_ratio *
+hotkey_sample_size, truncated as hotkey_setup() does.
+
+The detector is measured against the keys that are actually hot: the gets
+are cut into consecutive windows of sample_rate * sample_size gets, the span
+the sample window covers, and a key is hot in a window if it takes at least
+threshold_ratio of its gets. A run of windows a key is hot in is an episode,
+starting when its count crosses the threshold in the first of them. A signal
+is right if its key is in an episode then, or within one window after it, as
+the sample window lags; precision is the fraction of signals that are right,
+recall the fraction of episodes signaled at all, and detection latency the
+time from the start of an episode to its first signal.
+
+The CPU cost is estimated from the sampling rate: every sampled key costs
+about SAMPLE_NS (two murmur3 hashes and bucket walks in kc_map, a key copied
+into and out of the window), everything else only a counter increment. The
+window and map keep MAX_KEY_LEN bytes per sampled key.
+
+Gets stand in for get hits: a key hot enough to matter rarely misses. A
+synthetic workload (workload.py) can move its hot spots every --shift
+seconds, so detection latency has something to measure. Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import concurrent.futures
+from math import ceil
+
+import numpy as np
+
+import workload
+from workload import GET, SEED
+
+
+HOTKEY_SAMPLE_RATE = 100  # defaults in src/hotkey/hotkey.h
+HOTKEY_SAMPLE_SIZE = 10000
+HOTKEY_THRESHOLD_RATIO = 0.01
+MAX_KEY_LEN = 250
+# per sampled key kept: key_window_node, kc_map_entry and a kc_map bucket
+WINDOW_NODE = MAX_KEY_LEN + 2 + 4 + 8  # in bytes
+MAP_ENTRY = 8 + MAX_KEY_LEN + 2 + 4 + 4 + 4  # in bytes
+MAP_BUCKET = 16  # in bytes
+SAMPLE_NS = 150  # in nanoseconds, rough cost of hotkey_sample() on a sampled key
+REQUEST_NS = 5000  # in nanoseconds, cost of serving a get, for the relative overhead
+SHIFT = 0  # in seconds, 0: hot spots never move
+
+
+def shifted(chunks, nkey, period, seed=SEED):
+  """remap the keys of a synthetic workload through a new random permutation
+     every period seconds, so the hot keys change
+  """
+  rng = np.random.default_rng(seed + 1)
+  epoch, perm = -1, None
+  for op, key, klen, vlen, ttl, t in chunks:
+    epochs = (t // period).astype(np.int64)
+    out = np.empty_like(key)
+    for e in np.unique(epochs):
+      if e != epoch:
+        epoch, perm = e, rng.permutation(nkey)
+      sel = epochs == e
+      out[sel] = perm[key[sel]]
+    yield op, out, klen, vlen, ttl, t
+
+
+def gets(chunks):
+  """chunks of (key, t) of the gets of a workload"""
+  for op, key, klen, vlen, ttl, t in chunks:
+    is_get = op == GET
+    if is_get.any():
+      yield key[is_get], t[is_get]
+
+
+def threshold(ratio, size):
+  """hotkey_threshold as hotkey_setup() computes it"""
+  return int(ratio * size)
+
+
+def detect(chunks, rate, size, thresh):
+  """the (key, t) of every signal hotkey_sample() raises over chunks of gets"""
+  count = 0
+  window = np.zeros(0, dtype=np.int64)  # the last size keys sampled
+  for key, t in chunks:
+    pos = count + np.arange(len(key))
+    count += len(key)
+    sampled = (pos + 1) % rate == 0  # ++hotkey_counter % hotkey_rate == 0
+    skey, st = key[sampled], t[sampled]
+    if len(skey) == 0:
+      continue
+    keys = np.concatenate([window, skey])
+    n = len(keys)
+    idx = np.arange(n)
+    order = np.lexsort((idx, keys))
+    # occurrences of the same key among the size samples ending at each one
+    comb = keys[order] * n + idx[order]
+    lo = np.searchsorted(comb, keys[order] * n + np.maximum(idx[order] - size + 1, 0))
+    freq = np.empty(n, dtype=np.int64)
+    freq[order] = idx - lo + 1
+    hot = freq[len(window):] >= thresh
+    yield skey[hot], st[hot]
+    window = keys[-size:]
+
+
+def episodes(chunks, span, ratio):
+  """hot episodes over consecutive windows of span gets: a list of (key, start
+     of first window, threshold crossed, end of last window, duration of last
+     window), and when the last whole window ends
+  """
+  need = max(1, int(ceil(ratio * span)))
+  done, current = [], {}
+  bufk, buft, nbuf = [], [], 0
+  end = None
+
+  def close(keys):
+    for k in keys:
+      done.append(tuple(current.pop(k)))
+
+  for key, t in chunks:
+    bufk.append(key)
+    buft.append(t)
+    nbuf += len(key)
+    while nbuf >= span:
+      allk, allt = np.concatenate(bufk), np.concatenate(buft)
+      wk, wt = allk[:span], allt[:span]
+      bufk, buft, nbuf = [allk[span:]], [allt[span:]], nbuf - span
+      order = np.argsort(wk, kind='stable')
+      ks = wk[order]
+      starts = np.nonzero(np.concatenate([[True], ks[1:] != ks[:-1]]))[0]
+      counts = np.diff(np.concatenate([starts, [span]]))
+      hot = counts >= need
+      hot_keys = ks[starts[hot]]
+      cross = wt[order[starts[hot] + need - 1]]
+      start, end = float(wt[0]), float(wt[-1])
+      now_hot = set(hot_keys.tolist())
+      close([k for k in current if k not in now_hot])
+      for k, c in zip(hot_keys.tolist(), cross.tolist()):
+        if k in current:
+          current[k][3:] = [end, end - start]
+        else:
+          current[k] = [k, start, c, end, end - start]
+  close(list(current))
+  return done, end
+
+
+def evaluate(signals, hot, end):
+  """precision, recall and detection latencies (seconds) of signals
+     (key, t arrays) against hot episodes, up to end
+  """
+  skey, st = signals
+  keep = st <= end
+  skey, st = skey[keep], st[keep]
+  order = np.lexsort((st, skey))
+  skey, st = skey[order], st[order]
+  right = np.zeros(len(skey), dtype=bool)
+  latency = []
+  for key, start, onset, last, grace in hot:
+    lo, hi = np.searchsorted(skey, key, side='left'), np.searchsorted(skey, key, side='right')
+    times = st[lo:hi]
+    a, b = np.searchsorted(times, start, side='left'), np.searchsorted(times, last + grace, side='right')
+    right[lo + a:lo + b] = True
+    if b > a:
+      latency.append(max(0.0, float(times[a]) - onset))
+  return {'signals': len(skey), 'right': int(right.sum()), 'episodes': len(hot),
+          'detected': len(latency), 'hot_keys': len(set(h[0] for h in hot)),
+          'signaled_keys': len(np.unique(skey)),
+          'precision': 1.0 * right.sum() / len(skey) if len(skey) else 1.0,
+          'recall': 1.0 * len(latency) / len(hot) if hot else 1.0,
+          'latency': latency}
+
+
+def cost(rate, size, sample_ns=SAMPLE_NS):
+  """(ns per get, bytes) of detection at a sampling rate and window size"""
+  return 1.0 * sample_ns / rate, size * (WINDOW_NODE + MAP_ENTRY + MAP_BUCKET)
+
+
+def simulate(chunks_fn, rate, size, ratio, sample_ns=SAMPLE_NS, request_ns=REQUEST_NS):
+  """evaluate one setting; chunks_fn() streams the gets (key, t) anew"""
+  thresh = threshold(ratio, size)
+  signals = list(detect(chunks_fn(), rate, size, thresh))
+  signals = (np.concatenate([k for k, _ in signals] or [np.zeros(0, dtype=np.int64)]),
+             np.concatenate([t for _, t in signals] or [np.zeros(0)]))
+  hot, end = episodes(chunks_fn(), rate * size, ratio)
+  if end is None:
+    raise ValueError('fewer than {} gets, no window to evaluate against'.format(rate * size))
+  result = evaluate(signals, hot, end)
+  ns, mem = cost(rate, size, sample_ns)
+  latency = np.asarray(result['latency'])
+  result.update({'rate': rate, 'size': size, 'ratio': ratio, 'threshold': thresh,
+                 'ns_per_get': ns, 'overhead': ns / request_ns, 'memory': mem,
+                 'latency_p90': float(np.percentile(latency, 90)) if len(latency) else None,
+                 'latency_max': float(latency.max()) if len(latency) else None})
+  return result
+
+
+def get_chunks(args):
+  chunks = workload.from_args(args)
+  if args.shift > 0 and not args.klog:
+    chunks = shifted(chunks, args.nkey, args.shift, args.seed)
+  return gets(chunks)
+
+
+def run_config(args, rate, size, ratio):
+  """one simulation, as a process pool task"""
+  return simulate(lambda: get_chunks(args), rate, size, ratio, args.sample_ns, args.request_ns)
+
+
+def format_results(results):
+  lines = ['{:>6} {:>7} {:>7} {:>6} {:>8} {:>9} {:>9} {:>9} {:>10} {:>10} {:>8} {:>9} {:>9}'.format(
+    'rate', 'size', 'ratio', 'thresh', 'signals', 'precision', 'episodes', 'recall',
+    'lat p90 s', 'lat max s', 'ns/get', 'overhead', 'mem KB')]
+  for r in results:
+    lines.append('{:>6} {:>7} {:>7.4f} {:>6} {:>8} {:>9.4f} {:>9} {:>9.4f} {:>10} {:>10} {:>8.2f} {:>9.4%} {:>9.0f}'.format(
+      r['rate'], r['size'], r['ratio'], r['threshold'], r['signals'], r['precision'],
+      r['episodes'], r['recall'],
+      '-' if r['latency_p90'] is None else '{:.2f}'.format(r['latency_p90']),
+      '-' if r['latency_max'] is None else '{:.2f}'.format(r['latency_max']),
+      r['ns_per_get'], r['overhead'], r['memory'] / 1024.0))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Run the gets of a klog trace or a synthetic workload through a model of
+    hotkey detection for each sample rate/size/threshold combination, and
+    report precision and recall of its signals, detection latency and cost.
+    """)
+  parser.add_argument('--sample_rate', dest='sample_rate', type=int, nargs='+', default=[HOTKEY_SAMPLE_RATE], help='hotkey_sample_rate(s)')
+  parser.add_argument('--sample_size', dest='sample_size', type=int, nargs='+', default=[HOTKEY_SAMPLE_SIZE], help='hotkey_sample_size(s)')
+  parser.add_argument('--threshold_ratio', dest='threshold_ratio', type=float, nargs='+', default=[HOTKEY_THRESHOLD_RATIO], help='hotkey_threshold_ratio(s)')
+  parser.add_argument('--sample_ns', dest='sample_ns', type=float, default=SAMPLE_NS, help='cost of sampling one key, in nanoseconds')
+  parser.add_argument('--request_ns', dest='request_ns', type=float, default=REQUEST_NS, help='cost of serving one get, in nanoseconds, for the relative overhead')
+  workload.add_arguments(parser)
+  parser.add_argument('--shift', dest='shift', type=float, default=SHIFT, help='synthetic: seconds between reshuffles of key popularity, 0 for never')
+  parser.add_argument('--processes', dest='processes', type=int, default=0, help='parallel simulations, 0 for one per core')
+
+  args = parser.parse_args()
+
+  configs = [(r, s, t) for r in args.sample_rate for s in args.sample_size
+             for t in args.threshold_ratio]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes or None) as pool:
+    results = list(pool.map(run_config, [args] * len(configs), *zip(*configs)))
+  print(format_results(results))
@@ -0,0 +1,180 @@
+"""Search job shapes for a pelikan cluster.
+
+calculator.py sizes a cluster for a fixed list of job RAM sizes and a fixed
+CPU_PER_JOB. This evaluates a whole grid of job shapes (CPU, RAM, connections
+per server) at once with the same overhead and hash table formulas, and keeps
+the shapes on the Pareto frontier of:
+
+  cost          total over all jobs, from --cpu_cost and --ram_cost
+  headroom      how much qps or data (whichever is tighter) can grow before
+                more jobs are needed
+  blast radius  percentage of the dataset lost when one host fails
+
+Pelikan runs a single worker thread per instance, so throughput per job grows
+with CPU only up to CPU_PER_JOB (the worker plus the server/admin threads);
+larger shapes only pay off through RAM.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import textwrap
+
+import numpy as np
+
+import calculator
+from calculator import BASE_OVERHEAD, CONN_OVERHEAD, CPU_PER_JOB, GB, HASH_OVERHEAD, M, \
+  MAX_HOST_LIMIT, MB, RACK_TO_HOST_RATIO, SAFETY_BUF
+
+
+CPU_CANDIDATES = [1, 2, 4]
+RAM_GRID = [2, 4, 8, 16, 32, 64]  # in GB
+CPU_COST = 1.0  # relative cost of a core
+RAM_COST = 0.125  # relative cost of a GB of RAM, i.e. 8GB costs as much as a core
+PARETO_BLOCK = 1024  # shapes compared at once, bounds memory of the dominance check
+
+
+def hash_parameters(nkey, runnable):
+  """vectorized calculator.hash_parameters()"""
+  hash_power = np.ceil(np.log2(np.maximum(nkey, 2)))
+  ram_hash = np.ceil(1.0 * HASH_OVERHEAD[runnable] * 2 ** hash_power / MB)
+  return hash_power, ram_hash
+
+
+def shapes(cpus, rams, nconns):
+  """grid of job shapes as flat arrays"""
+  cpu, ram, nconn = np.meshgrid(np.asarray(cpus, dtype=float), np.asarray(rams, dtype=float),
+                                np.asarray(nconns, dtype=float), indexing='ij')
+  return cpu.ravel(), ram.ravel(), nconn.ravel()
+
+
+def evaluate(args, cpu, ram, nconn):
+  """calculate() for every shape at once, returns a dict of arrays; shapes
+     that can't hold any data after overhead have feasible == False
+  """
+  nkey, _ = calculator.working_set(args)
+  # slab classes are recommended for the memory they divide, as in calculate(),
+  # so item size and partial slabs are modelled once per distinct ram
+  rams, inverse = np.unique(ram, return_inverse=True)
+  models = [calculator.item_model(args, r)[:2] for r in rams]
+  item_size = np.array([m[0] for m in models], dtype=float)[inverse]
+  ram_partial = np.array([m[1] for m in models], dtype=float)[inverse]
+  ram_data = 1.0 * item_size * nkey * M / MB / calculator.cuckoo_load(args)
+  ram_mb = ram * GB / MB
+  ram_conn = np.ceil(1.0 * CONN_OVERHEAD * nconn / MB)
+  ram_fixed = BASE_OVERHEAD + SAFETY_BUF
+
+  kqps = calculator.job_kqps(args) * np.minimum(cpu, CPU_PER_JOB) / CPU_PER_JOB
+  njob_qps = np.ceil(1.0 * args.qps / kqps)
+  njob_fd = np.ceil(100.0 / args.failure_domain)
+  n_low = np.ceil(ram_data / ram_mb)
+  _, ram_hash = hash_parameters(1.0 * nkey * M / n_low, args.runnable)
+  avail = ram_mb - ram_fixed - ram_conn - ram_hash - ram_partial
+  feasible = avail > 0
+  njob_mem = np.ceil(ram_data / np.where(feasible, avail, 1))
+  need = np.stack([njob_qps, np.broadcast_to(njob_fd, cpu.shape), njob_mem])
+  njob = need.max(axis=0)
+  bottleneck = np.array(['qps', 'failure domain', 'memory'])[need.argmax(axis=0)]
+
+  # final per-job configuration, as in calculate()
+  nkey_per_shard = (ram_mb - ram_fixed - ram_conn - ram_partial) * MB / item_size
+  hash_power, ram_hash = hash_parameters(nkey_per_shard, args.runnable)
+  slab_mem = ram_mb - ram_fixed - ram_conn - ram_hash
+
+  rack_limit = np.floor(njob * args.failure_domain / 100)
+  host_limit = np.floor(np.minimum(args.max_host_limit, np.maximum(1, rack_limit / RACK_TO_HOST_RATIO)))
+  qps_headroom = njob * kqps / args.qps - 1
+  mem_headroom = njob * np.maximum(slab_mem - ram_partial, 0) / ram_data - 1
+  return {
+    'cpu': cpu, 'ram': ram, 'nconn': nconn, 'instance': njob,
+    'cost': njob * (cpu * args.cpu_cost + ram * args.ram_cost),
+    'headroom': np.minimum(qps_headroom, mem_headroom),
+    'blast_radius': 100.0 * host_limit / njob,
+    'bottleneck': bottleneck, 'hash_power': hash_power, 'slab_mem': slab_mem,
+    'host_limit': host_limit, 'rack_limit': rack_limit, 'feasible': feasible}
+
+
+def pareto(objectives):
+  """mask of rows of objectives (n x k, all minimized) no other row dominates"""
+  n = len(objectives)
+  keep = np.ones(n, dtype=bool)
+  for start in range(0, n, PARETO_BLOCK):
+    block = objectives[start:start + PARETO_BLOCK, None, :]
+    le = np.all(objectives[None, :, :] <= block, axis=2)
+    lt = np.any(objectives[None, :, :] < block, axis=2)
+    keep[start:start + PARETO_BLOCK] = ~np.any(le & lt, axis=1)
+  return keep
+
+
+def plan(args):
+  """evaluate the shape grid, returns (all results, indices of the frontier by cost).
+     Of shapes with identical objectives, only the one allowing the most
+     connections is kept.
+  """
+  result = evaluate(args, *shapes(args.cpu, args.ram_grid, args.nconn_grid))
+  idx = np.nonzero(result['feasible'])[0]
+  objectives = np.column_stack([result['cost'][idx], -result['headroom'][idx],
+                                result['blast_radius'][idx]])
+  # many shapes share objectives; compare each distinct point once
+  points, inverse = np.unique(objectives, axis=0, return_inverse=True)
+  on_frontier = pareto(points)[inverse.ravel()]
+  best = {}
+  for i, point in zip(idx[on_frontier], inverse.ravel()[on_frontier]):
+    if point not in best or result['nconn'][i] > result['nconn'][best[point]]:
+      best[point] = i
+  frontier = np.array(sorted(best.values()), dtype=int)
+  return result, frontier[np.argsort(result['cost'][frontier], kind='stable')]
+
+
+def format_plan(result, frontier):
+  lines = ['{:>5} {:>7} {:>7} {:>9} {:>10} {:>9} {:>7} {:>10} {:>12} {:>16}'.format(
+    'cpu', 'ram GB', 'nconn', 'instances', 'cost', 'headroom', 'blast', 'hash_power',
+    'slab_mem MB', 'bottleneck')]
+  for i in frontier:
+    lines.append('{:>5g} {:>7g} {:>7g} {:>9g} {:>10.1f} {:>8.1f}% {:>6.2f}% {:>10g} {:>12g} {:>16}'
+                 .format(result['cpu'][i], result['ram'][i], result['nconn'][i],
+                         result['instance'][i], result['cost'][i], 100 * result['headroom'][i],
+                         result['blast_radius'][i], result['hash_power'][i],
+                         result['slab_mem'][i], result['bottleneck'][i]))
+  return '\n'.join(lines)
+
+
+def write_csv(result, fname):
+  cols = ['cpu', 'ram', 'nconn', 'instance', 'cost', 'headroom', 'blast_radius', 'bottleneck',
+          'hash_power', 'slab_mem', 'host_limit', 'rack_limit', 'feasible']
+  with open(fname, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(cols)
+    for row in zip(*[result[c] for c in cols]):
+      writer.writerow(row)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    parents=[calculator.parser], conflict_handler='resolve',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=textwrap.dedent("""
+      Evaluate a grid of job shapes (cpu, ram, connections) for a pelikan cluster
+      and print those on the Pareto frontier of cost, headroom and blast radius.
+      Takes the same workload options as calculator.py.
+      """))
+  parser.add_argument('runnable', choices=['twemcache', 'segcache', 'slimcache'], help='flavor of backend')
+  parser.add_argument('--cpu', dest='cpu', type=float, nargs='+', default=CPU_CANDIDATES, help='cores per job to consider')
+  parser.add_argument('--ram_grid', dest='ram_grid', type=int, nargs='+', default=RAM_GRID, help='ram per job (GB) to consider')
+  parser.add_argument('--nconn_grid', dest='nconn_grid', type=int, nargs='+', default=None, help='connections per server to consider, defaults to --nconn')
+  parser.add_argument('--cpu_cost', dest='cpu_cost', type=float, default=CPU_COST, help='relative cost of a core')
+  parser.add_argument('--ram_cost', dest='ram_cost', type=float, default=RAM_COST, help='relative cost of a GB of ram')
+  parser.add_argument('--max_host_limit', dest='max_host_limit', type=int, default=MAX_HOST_LIMIT, help='most jobs allowed on a host')
+  parser.add_argument('--csv', dest='csv', type=str, default=None, help='write every evaluated shape to this file')
+
+  args = parser.parse_args()
+  args.nconn_grid = args.nconn_grid or [args.nconn]
+
+  result, frontier = plan(args)
+  print(calculator.format_input(args))
+  print('{} shapes evaluated, {} on the frontier:'.format(len(result['cpu']), len(frontier)))
+  print(format_plan(result, frontier))
+  if args.csv:
+    write_csv(result, args.csv)
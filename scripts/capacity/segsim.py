@@ -0,0 +1,421 @@
+"""Discrete-event simulator of segcache storage (src/storage/seg).
+
+Items are appended to the tail segment of their TTL bucket, segments expire as
+a whole (create_at + bucket ttl), and when no free segment is left one is
+reclaimed by the eviction policy:
+
+  random  evict a random sealed segment
+  fifo    evict the oldest sealed segment
+  merge   walk the TTL buckets round robin and merge the seg_n_merge oldest
+          segments of a bucket into one, retaining the items with the highest
+          frequency per byte (what segmerge.c does, simplified)
+
+The simulator reports hit ratio, bytes held by dead (overwritten/deleted)
+items, bytes lost at segment tails, expired bytes and segment utilization
+over time, for a klog trace or a synthetic workload.
+
+Requests are processed in chunks with NumPy: within a chunk, whether a get
+hits is decided from the state at the start of the chunk plus the latest
+write to the same key earlier in the chunk, and placement into segments is a
+cumulative sum per TTL bucket. Segments needed by a chunk are reclaimed before
+it starts, which is the only approximation (evictions happen up to one chunk
+early); keep --chunk well below the number of items that fit in memory.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+from calculator import ITEM_OVERHEAD, KEYVAL_ALIGNMENT, MB
+import workload
+from workload import GET, SET, DELETE, SEED
+
+
+# mirrors src/storage/seg/constant.h and seg.h
+N_BUCKET_PER_STEP_N_BIT = 8
+N_BUCKET_PER_STEP = 1 << N_BUCKET_PER_STEP_N_BIT
+TTL_BUCKET_INTVL_N_BIT = [3, 7, 11, 15]
+MAX_N_TTL_BUCKET = N_BUCKET_PER_STEP * 4
+SEG_SIZE = MB
+SEG_MEM = 64 * MB
+SEG_N_MERGE = 4
+FREQ_MAX = 127
+
+POLICIES = ['random', 'fifo', 'merge']
+REPORT_INTERVAL = 60  # in seconds of trace time
+
+
+def ttl_bucket_idx(ttl):
+  """vectorized find_ttl_bucket_idx()"""
+  ttl = np.asarray(ttl, dtype=np.int64)
+  b = N_BUCKET_PER_STEP_N_BIT
+  idx = np.where(ttl < (1 << (TTL_BUCKET_INTVL_N_BIT[0] + b)), ttl >> TTL_BUCKET_INTVL_N_BIT[0],
+        np.where(ttl < (1 << (TTL_BUCKET_INTVL_N_BIT[1] + b)),
+                 (ttl >> TTL_BUCKET_INTVL_N_BIT[1]) + N_BUCKET_PER_STEP,
+        np.where(ttl < (1 << (TTL_BUCKET_INTVL_N_BIT[2] + b)),
+                 (ttl >> TTL_BUCKET_INTVL_N_BIT[2]) + 2 * N_BUCKET_PER_STEP,
+                 np.minimum((ttl >> TTL_BUCKET_INTVL_N_BIT[3]) + 3 * N_BUCKET_PER_STEP,
+                            MAX_N_TTL_BUCKET - 1))))
+  return np.where(ttl <= 0, MAX_N_TTL_BUCKET - 1, idx)
+
+
+def bucket_ttl(idx):
+  """ttl of a bucket, as set up in ttl_bucket_setup()"""
+  step, j = divmod(int(idx), N_BUCKET_PER_STEP)
+  return (1 << TTL_BUCKET_INTVL_N_BIT[step]) * j + 1
+
+
+def item_size(klen, vlen):
+  """vectorized item_ntotal(): header, key, value (at least 8 bytes), aligned"""
+  sz = ITEM_OVERHEAD['segcache'] + np.asarray(klen) + np.maximum(np.asarray(vlen), 8)
+  return (sz + KEYVAL_ALIGNMENT - 1) // KEYVAL_ALIGNMENT * KEYVAL_ALIGNMENT
+
+
+def sized(chunks):
+  """workload chunks -> (op, key, size, ttl, t), size 0 where vlen is unknown"""
+  for op, key, klen, vlen, ttl, t in chunks:
+    yield op, key, np.where(vlen >= 0, item_size(klen, vlen), 0), ttl, t
+
+
+class SegCache(object):
+
+  def __init__(self, heap_mem=SEG_MEM, seg_size=SEG_SIZE, policy='merge',
+               n_merge=SEG_N_MERGE, set_on_miss=True, seed=SEED):
+    if policy not in POLICIES:
+      raise ValueError('unknown eviction policy {}'.format(policy))
+    self.seg_size = seg_size
+    self.nseg = int(heap_mem // seg_size)
+    if self.nseg < 2:
+      raise ValueError('heap_mem must hold at least 2 segments')
+    self.policy = policy
+    self.n_merge = n_merge
+    self.set_on_miss = set_on_miss
+    self.rng = np.random.default_rng(seed)
+    # per segment
+    self.seg_bucket = np.full(self.nseg, -1, dtype=np.int32)
+    self.seg_create = np.zeros(self.nseg)
+    self.seg_expire = np.zeros(self.nseg)
+    self.seg_offset = np.zeros(self.nseg, dtype=np.int64)  # bytes written
+    self.seg_live = np.zeros(self.nseg, dtype=np.int64)  # bytes of live items
+    self.seg_items = [[] for _ in range(self.nseg)]  # [(keys, versions)] appended
+    self.free = list(range(self.nseg - 1, -1, -1))
+    # per TTL bucket
+    self.tail = np.full(MAX_N_TTL_BUCKET, -1, dtype=np.int64)
+    self.chain = [[] for _ in range(MAX_N_TTL_BUCKET)]  # sealed segs, oldest first
+    self.merge_bkt = 0
+    # per key, grown on demand
+    self.key_seg = np.full(0, -1, dtype=np.int32)
+    self.key_ver = np.zeros(0, dtype=np.int64)
+    self.key_size = np.zeros(0, dtype=np.int64)
+    self.key_freq = np.zeros(0, dtype=np.int16)
+    self.next_ver = 0
+    # counters
+    self.stats = dict.fromkeys(['get', 'hit', 'set', 'delete', 'evict_seg', 'evict_item',
+                                'evict_bytes', 'merge', 'expire_seg', 'expire_bytes'], 0)
+
+
+  def _grow(self, nkey):
+    if nkey <= len(self.key_seg):
+      return
+    n = max(nkey, 2 * len(self.key_seg))
+    grow = n - len(self.key_seg)
+    self.key_seg = np.concatenate([self.key_seg, np.full(grow, -1, dtype=np.int32)])
+    self.key_ver = np.concatenate([self.key_ver, np.zeros(grow, dtype=np.int64)])
+    self.key_size = np.concatenate([self.key_size, np.zeros(grow, dtype=np.int64)])
+    self.key_freq = np.concatenate([self.key_freq, np.zeros(grow, dtype=np.int16)])
+
+
+  # segment reclamation
+
+  def _live_items(self, seg):
+    """keys and versions of the items of seg that are still current"""
+    if not self.seg_items[seg]:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys = np.concatenate([k for k, _ in self.seg_items[seg]])
+    vers = np.concatenate([v for _, v in self.seg_items[seg]])
+    live = (self.key_seg[keys] == seg) & (self.key_ver[keys] == vers)
+    return keys[live], vers[live]
+
+
+  def _release(self, seg):
+    """return a segment to the free pool, dropping whatever is still in it"""
+    keys, _ = self._live_items(seg)
+    self.key_seg[keys] = -1
+    bkt = self.seg_bucket[seg]
+    if self.tail[bkt] == seg:
+      self.tail[bkt] = -1
+    elif seg in self.chain[bkt]:
+      self.chain[bkt].remove(seg)
+    self.seg_bucket[seg] = -1
+    self.seg_offset[seg] = 0
+    self.seg_live[seg] = 0
+    self.seg_items[seg] = []
+    self.free.append(seg)
+    return len(keys)
+
+
+  def _evict_one(self):
+    if self.policy == 'merge' and self._merge():
+      return
+    sealed = [s for c in self.chain for s in c]
+    if not sealed:  # only tail segments left, evict one of those
+      sealed = [int(s) for s in self.tail if s >= 0]
+    if self.policy == 'random':
+      seg = sealed[self.rng.integers(len(sealed))]
+    else:
+      seg = min(sealed, key=lambda s: self.seg_create[s])
+    self.stats['evict_seg'] += 1
+    self.stats['evict_bytes'] += int(self.seg_live[seg])
+    self.stats['evict_item'] += self._release(seg)
+
+
+  def _merge(self):
+    """merge the oldest segments of the next eligible bucket, False if none"""
+    for i in range(MAX_N_TTL_BUCKET):
+      bkt = (self.merge_bkt + i) % MAX_N_TTL_BUCKET
+      if len(self.chain[bkt]) >= 2:
+        break
+    else:
+      return False
+    self.merge_bkt = (bkt + 1) % MAX_N_TTL_BUCKET
+    segs = self.chain[bkt][:self.n_merge]
+    keys = np.concatenate([self._live_items(s)[0] for s in segs])
+    sizes = self.key_size[keys]
+    mean = max(1.0, sizes.mean()) if len(sizes) else 1.0
+    score = self.key_freq[keys] / (sizes / mean)
+    order = np.argsort(-score, kind='stable')
+    keep = order[np.cumsum(sizes[order]) <= self.seg_size]
+    kept = np.zeros(len(keys), dtype=bool)
+    kept[keep] = True
+    dest = segs[0]
+    create = self.seg_create[segs].min()
+    self.stats['merge'] += 1
+    self.stats['evict_seg'] += len(segs) - 1
+    self.stats['evict_item'] += int((~kept).sum())
+    self.stats['evict_bytes'] += int(sizes[~kept].sum())
+    self.key_seg[keys[~kept]] = -1
+    for s in segs[1:]:
+      self._release(s)
+    # rewrite dest with the retained items, keeping its place in the chain
+    kkeys = keys[kept]
+    vers = self.next_ver + np.arange(len(kkeys))
+    self.next_ver += len(kkeys)
+    self.key_seg[kkeys] = dest
+    self.key_ver[kkeys] = vers
+    self.key_freq[kkeys] >>= 1
+    self.seg_items[dest] = [(kkeys, vers)]
+    self.seg_offset[dest] = self.seg_live[dest] = int(self.key_size[kkeys].sum())
+    self.seg_create[dest] = create
+    self.seg_expire[dest] = create + bucket_ttl(bkt)
+    return True
+
+
+  def expire(self, now):
+    """proactively free expired segments, like the background thread does"""
+    used = np.nonzero((self.seg_bucket >= 0) & (self.seg_expire <= now))[0]
+    for seg in used:
+      self.stats['expire_seg'] += 1
+      self.stats['expire_bytes'] += int(self.seg_live[seg])
+      self._release(int(seg))
+
+
+  # placement
+
+  def _place(self, bkt, sizes, now, dry_run):
+    """assign segments to items appended to a bucket; returns (segs, nseg_new)"""
+    out = np.empty(len(sizes), dtype=np.int64)
+    seg = int(self.tail[bkt])
+    offset = int(self.seg_offset[seg]) if seg >= 0 else self.seg_size
+    cums = np.cumsum(sizes)
+    i = nnew = 0
+    while i < len(sizes):
+      base = cums[i - 1] if i > 0 else 0
+      j = int(np.searchsorted(cums, base + self.seg_size - offset, side='right'))
+      if j > i:
+        if not dry_run:
+          out[i:j] = seg
+          self.seg_offset[seg] += int(cums[j - 1] - base)
+        offset += int(cums[j - 1] - base)
+        i = j
+      if i < len(sizes):  # seal and open a new segment
+        nnew += 1
+        offset = 0
+        if not dry_run:
+          if seg >= 0:
+            self.chain[bkt].append(seg)
+          seg = self.free.pop()
+          self.tail[bkt] = seg
+          self.seg_bucket[seg] = bkt
+          self.seg_create[seg] = now
+          self.seg_expire[seg] = now + bucket_ttl(bkt)
+    return out, nnew
+
+
+  def _decide(self, op, key, t):
+    """hits and writes of a chunk given the current state"""
+    seg = self.key_seg[key]
+    before = (seg >= 0) & (self.seg_expire[np.maximum(seg, 0)] > t)
+    return workload.decide(op, key, before, self.set_on_miss)
+
+
+  def _needed(self, write, bkt, size):
+    need = 0
+    for b in np.unique(bkt[write]):
+      need += self._place(int(b), size[write & (bkt == b)], 0, True)[1]
+    return need
+
+
+  def process(self, op, key, size, ttl, t):
+    """simulate one chunk of requests"""
+    n = len(op)
+    if n == 0:
+      return
+    self._grow(int(key.max()) + 1)
+    now = float(t[0])
+    self.expire(now)
+    known = size > 0
+    self.key_size[key[known]] = size[known]
+    size = np.where(known, size, np.maximum(self.key_size[key], item_size(0, 0)))
+    bkt = ttl_bucket_idx(ttl)
+    # make room for the chunk first; decisions change as items are evicted
+    while True:
+      hit, write, order, first = self._decide(op, key, t)
+      need = self._needed(write, bkt, size)
+      if need <= len(self.free):
+        break
+      if need > self.nseg // 2:
+        raise ValueError('chunk of {} requests needs {} of {} segments, lower --chunk'
+                         .format(n, need, self.nseg))
+      for _ in range(need - len(self.free)):
+        self._evict_one()
+    self.stats['get'] += int((op == GET).sum())
+    self.stats['hit'] += int(hit.sum())
+    self.stats['set'] += int((op == SET).sum())
+    self.stats['delete'] += int((op == DELETE).sum())
+    # frequency of hit items
+    np.add.at(self.key_freq, key[hit], 1)
+    np.minimum(self.key_freq, FREQ_MAX, out=self.key_freq)
+    # versions superseded by this chunk: the state before it, for keys written
+    # or deleted, plus every in-chunk write that is later overwritten/deleted
+    change = write | (op == DELETE)
+    wkeys = np.unique(key[change])
+    old = self.key_seg[wkeys]
+    had = old >= 0
+    np.add.at(self.seg_live, old[had], -self.key_size[wkeys[had]])
+    # place new versions
+    wseg = np.full(n, -1, dtype=np.int64)
+    for b in np.unique(bkt[write]):
+      mask = write & (bkt == b)
+      wseg[mask] = self._place(int(b), size[mask], float(t[mask][0]), False)[0]
+    wver = np.full(n, -1, dtype=np.int64)
+    nw = int(write.sum())
+    wver[write] = self.next_ver + np.arange(nw)
+    self.next_ver += nw
+    # the last change per key wins
+    fpos = workload.final_changes(change, order, first)
+    fkey = key[fpos]
+    self.key_seg[fkey] = np.where(op[fpos] == DELETE, -1, wseg[fpos])
+    self.key_ver[fkey] = wver[fpos]
+    self.key_freq[fkey] = np.where(op[fpos] == DELETE, 0, self.key_freq[fkey])
+    # only final versions are live
+    live = np.zeros(n, dtype=bool)
+    live[fpos] = write[fpos]
+    np.add.at(self.seg_live, wseg[live], size[live])
+    for s in np.unique(wseg[write]):
+      mask = wseg == s
+      self.seg_items[s].append((key[mask], wver[mask]))
+
+
+  def snapshot(self):
+    used = self.seg_bucket >= 0
+    nused = int(used.sum())
+    live = int(self.seg_live[used].sum())
+    written = int(self.seg_offset[used].sum())
+    sealed = [s for c in self.chain for s in c]
+    tail_waste = int(sum(self.seg_size - self.seg_offset[s] for s in sealed))
+    return {'seg_used': nused, 'live_bytes': live, 'dead_bytes': written - live,
+            'tail_waste_bytes': tail_waste,
+            'utilization': 1.0 * live / (nused * self.seg_size) if nused else 0.0}
+
+
+def simulate(chunks, heap_mem=SEG_MEM, seg_size=SEG_SIZE, policy='merge',
+             set_on_miss=True, report_interval=REPORT_INTERVAL, seed=SEED):
+  """run a workload through a SegCache; returns (timeline, final stats)"""
+  cache = SegCache(heap_mem, seg_size, policy, set_on_miss=set_on_miss, seed=seed)
+  timeline = []
+  now = next_report = None
+  prev = dict(cache.stats)
+  for op, key, size, ttl, t in chunks:
+    cache.process(op, key, size, ttl, t)
+    now = float(t[-1])
+    next_report = now + report_interval if next_report is None else next_report
+    if now >= next_report:
+      timeline.append(report(cache, now, prev))
+      prev = dict(cache.stats)
+      next_report += report_interval
+  if now is not None and (not timeline or timeline[-1]['time'] != now):
+    timeline.append(report(cache, now, prev))
+  return timeline, cache.stats
+
+
+def report(cache, now, prev):
+  row = {'time': now}
+  gets = cache.stats['get'] - prev['get']
+  row['hit_ratio'] = 1.0 * (cache.stats['hit'] - prev['hit']) / gets if gets else 0.0
+  for k in ['evict_seg', 'expire_bytes', 'merge']:
+    row[k] = cache.stats[k] - prev[k]
+  row.update(cache.snapshot())
+  return row
+
+
+def format_timeline(timeline):
+  lines = ['{:>10} {:>9} {:>8} {:>9} {:>12} {:>12} {:>12} {:>12} {:>6}'.format(
+    'time', 'hit', 'util', 'seg_used', 'live MB', 'dead MB', 'tail MB', 'expired MB',
+    'evict')]
+  for r in timeline:
+    lines.append('{:>10.1f} {:>9.4f} {:>8.3f} {:>9} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>6}'
+                 .format(r['time'], r['hit_ratio'], r['utilization'], r['seg_used'],
+                         1.0 * r['live_bytes'] / MB, 1.0 * r['dead_bytes'] / MB,
+                         1.0 * r['tail_waste_bytes'] / MB, 1.0 * r['expire_bytes'] / MB,
+                         r['evict_seg']))
+  return '\n'.join(lines)
+
+
+def run_config(args, seg_size, policy):
+  """one simulation, as a process pool task"""
+  timeline, stats = simulate(sized(workload.from_args(args)), args.heap_mem, seg_size, policy,
+                             workload.set_on_miss(args), args.report_interval, args.seed)
+  return seg_size, policy, timeline, stats
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Simulate segcache storage (segments, TTL buckets, eviction) on a klog
+    trace or a synthetic Zipf workload, for each seg_size/policy combination.
+    """)
+  parser.add_argument('--heap_mem', dest='heap_mem', type=int, default=SEG_MEM, help='cache memory in bytes')
+  parser.add_argument('--seg_size', dest='seg_size', type=int, nargs='+', default=[SEG_SIZE], help='segment size(s) in bytes')
+  parser.add_argument('--policy', dest='policy', nargs='+', choices=POLICIES, default=['merge'], help='eviction policies')
+  workload.add_arguments(parser)
+  parser.add_argument('--report_interval', dest='report_interval', type=float, default=REPORT_INTERVAL, help='seconds of trace time per timeline row')
+  parser.add_argument('--processes', dest='processes', type=int, default=0, help='parallel simulations, 0 for one per core')
+
+  args = parser.parse_args()
+
+  configs = [(s, p) for s in args.seg_size for p in args.policy]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes or None) as pool:
+    results = list(pool.map(run_config, [args] * len(configs), *zip(*configs)))
+  summary = []
+  for seg_size, policy, timeline, stats in results:
+    print('seg_size {} policy {}'.format(seg_size, policy))
+    print(format_timeline(timeline))
+    print('')
+    summary.append((seg_size, policy, 1.0 * stats['hit'] / max(1, stats['get']),
+                    timeline[-1]['utilization']))
+  print('{:>12} {:>8} {:>10} {:>8}'.format('seg_size', 'policy', 'hit ratio', 'util'))
+  for seg_size, policy, hit, util in summary:
+    print('{:>12} {:>8} {:>10.4f} {:>8.3f}'.format(seg_size, policy, hit, util))
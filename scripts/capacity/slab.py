@@ -0,0 +1,256 @@
+"""Slab class model of the twemcache storage (src/storage/slab).
+
+Items are stored in the smallest slab class whose chunk fits them, and each
+slab (slab_size bytes, minus a header) holds a whole number of chunks of one
+class. Given the distribution of key+value sizes, this computes how slabs are
+shared among classes, how much of slab_mem goes to chunk padding and slab
+tails, and thus how many items fit: the effective capacity. Heavy-tailed sizes
+spread over many classes and waste much more than the 8-byte alignment
+calculator.py assumes otherwise.
+
+The largest class is capped at slab_item_max, which the server defaults to
+ITEM_SIZE_MAX whatever slab_size is, and refuses to start with if it doesn't
+fit in one slab. A recommended slab_size therefore comes with slab_item_max
+set to what the slab holds (with the larger header of a build with
+assertions, so it starts either way), so the server builds the classes
+modelled.
+
+Slabs are assumed to be allocated to classes in proportion to the items
+arriving in them, which is what random slab eviction (slab_evict_opt: 1)
+converges to when items of all sizes have similar lifetimes.
+"""
+
+from __future__ import print_function
+import argparse
+from bisect import bisect_left
+import csv
+import json
+from math import ceil
+
+from calculator import ITEM_OVERHEAD, KB, MB
+
+
+# mirrors src/storage/slab/slab.h and slabclass.h
+SLAB_HDR_SIZE = 24  # offsetof(struct slab, data) without assertions
+SLAB_HDR_SIZE_ASSERT = 32  # with CC_ASSERT_PANIC or CC_ASSERT_LOG, which add a magic
+SLAB_SIZE = MB
+ITEM_SIZE_MAX = SLAB_SIZE - SLAB_HDR_SIZE  # slab_item_max compiled in
+ITEM_SIZE_MIN = 44
+ITEM_FACTOR = 1.25
+SLABCLASS_MAX_ID = 254
+CC_ALIGNMENT = 8
+
+GROWTH_CANDIDATES = [round(1.05 + 0.05 * i, 2) for i in range(20)]  # 1.05 - 2.0, as the server parses them
+SLAB_SIZE_CANDIDATES = [256 * KB, 512 * KB, MB, 2 * MB, 4 * MB, 8 * MB]
+TIE_TOLERANCE = 0.005  # prefer fewer classes if capacity is within 0.5%
+
+
+def align_down(n, alignment=CC_ALIGNMENT):
+  return n // alignment * alignment
+
+
+def item_max_for(slab_size):
+  """the slab_item_max recommended with slab_size: the most any build fits in a slab"""
+  return slab_size - SLAB_HDR_SIZE_ASSERT
+
+
+def slab_profile(slab_size=SLAB_SIZE, growth=ITEM_FACTOR, item_min=ITEM_SIZE_MIN,
+                 item_max=None):
+  """chunk size of each slab class, as generated by _slab_profile_setup();
+     item_max defaults to the server's, ITEM_SIZE_MAX
+  """
+  capacity = slab_size - SLAB_HDR_SIZE
+  item_max = ITEM_SIZE_MAX if item_max is None else item_max
+  if item_max > capacity:
+    raise ValueError('slab_item_max {} does not fit in a slab of {} bytes'.format(item_max, slab_size))
+  if growth <= 1.0:
+    raise ValueError('growth factor must be greater than 1')
+  profile = []
+  linear_nitem = int(1.0 / (growth - 1.0))
+  nitem = capacity // ((item_min + CC_ALIGNMENT - 1) // CC_ALIGNMENT * CC_ALIGNMENT)
+  nbyte = capacity // nitem
+  # exponential growth phase
+  while nbyte <= item_max and nitem > linear_nitem:
+    if profile and profile[-1] == nbyte:
+      nbyte += CC_ALIGNMENT
+    profile.append(nbyte)
+    nitem = int(capacity // nbyte / growth)
+    if nitem == 0:
+      break
+    nbyte = align_down(capacity // nitem)
+  # linear growth phase
+  nitem = linear_nitem
+  nbyte = align_down(capacity // nitem) if nitem > 0 else item_max + 1
+  while nbyte <= item_max and nitem > 0:
+    profile.append(nbyte)
+    nitem -= 1
+    if nitem > 0:
+      nbyte = align_down(capacity // nitem)
+  if len(profile) > SLABCLASS_MAX_ID:
+    raise ValueError('too many slab classes, growth factor too small')
+  return profile
+
+
+def item_size(klen, vlen, runnable='twemcache'):
+  """item_ntotal(): header, cas, key and value, unaligned"""
+  return ITEM_OVERHEAD[runnable] + klen + vlen
+
+
+def load_sizes(fname):
+  """load a size distribution, returns [(key+value bytes, weight)].
+     Accepts a csv with columns size,count (header optional), or a keyspace json
+     as written by klog/analyze.py --keyspace, whose values are shifted by ksize.
+  """
+  if fname.endswith('.json'):
+    with open(fname) as f:
+      keyspace = json.load(f)
+    return [(keyspace['ksize'] + int(vsize), float(weight))
+            for vsize, weight in keyspace['values']]
+  sizes = []
+  with open(fname) as f:
+    for row in csv.reader(f):
+      if not row or not row[0].strip().isdigit():
+        continue
+      sizes.append((int(row[0]), float(row[1]) if len(row) > 1 else 1.0))
+  if not sizes:
+    raise ValueError('empty size distribution in {}'.format(fname))
+  return sizes
+
+
+class SlabModel(object):
+  """allocation of slabs among classes for a distribution of item sizes"""
+
+  def __init__(self, sizes, slab_size=SLAB_SIZE, growth=ITEM_FACTOR,
+               profile=None, runnable='twemcache', item_max=None):
+    """sizes: [(key+value bytes, weight)]; item_max is slab_item_max"""
+    self.slab_size = slab_size
+    self.growth = growth
+    self.item_max = ITEM_SIZE_MAX if item_max is None else item_max
+    self.profile = profile or slab_profile(slab_size, growth, item_max=self.item_max)
+    self.capacity = slab_size - SLAB_HDR_SIZE
+    total = sum(w for _, w in sizes)
+    # per class: [weight, item bytes]
+    self.classes = {}
+    self.oversize = 0.0  # fraction of items too large for any class
+    self.data = 0.0  # mean key+value bytes per item
+    for size, w in sizes:
+      w /= total
+      self.data += w * size
+      isize = item_size(0, size, runnable)
+      idx = bisect_left(self.profile, isize)
+      if idx == len(self.profile):
+        self.oversize += w
+        continue
+      cls = self.classes.setdefault(idx, [0.0, 0.0])
+      cls[0] += w
+      cls[1] += w * isize
+    stored = 1.0 - self.oversize
+    # slabs per stored item, averaged over the distribution
+    self.slab_per_item = sum(w / (self.capacity // self.profile[idx])
+                             for idx, (w, _) in self.classes.items()) / stored if stored else 0.0
+
+
+  def nitem(self, slab_mem):
+    """items that fit in slab_mem bytes; each class in use holds one partial slab"""
+    nslab = slab_mem // self.slab_size - len(self.classes)
+    if nslab <= 0 or self.slab_per_item == 0:
+      return 0
+    return int(nslab / self.slab_per_item)
+
+
+  def bytes_per_item(self):
+    """slab memory consumed per stored item, not counting partial slabs"""
+    return self.slab_per_item * self.slab_size
+
+
+  def partial_mem(self):
+    """bytes held by the one partially filled slab of each class in use"""
+    return len(self.classes) * self.slab_size
+
+
+  def efficiency(self, slab_mem):
+    """fraction of slab_mem holding key+value data"""
+    return self.data * self.nitem(slab_mem) / slab_mem
+
+
+  def breakdown(self, slab_mem):
+    """per class (chunk size, item share, slabs, chunk padding and slab tail bytes)"""
+    nitem = self.nitem(slab_mem)
+    rows = []
+    for idx, (w, wsize) in sorted(self.classes.items()):
+      chunk = self.profile[idx]
+      per_slab = self.capacity // chunk
+      n = w / (1.0 - self.oversize) * nitem
+      nslab = int(ceil(n / per_slab))
+      rows.append({'class': idx + 1, 'chunk': chunk, 'share': w, 'items': int(n),
+                   'slabs': nslab, 'padding': max(0.0, n * (chunk - wsize / w)),
+                   'tail': nslab * (self.capacity - per_slab * chunk) + nslab * SLAB_HDR_SIZE})
+    return rows
+
+
+def recommend(sizes, slab_mem, growths=GROWTH_CANDIDATES, slab_sizes=SLAB_SIZE_CANDIDATES):
+  """(growth, slab_size, model) storing every item and maximizing effective
+     capacity; among near ties, the one with the fewest classes. Each slab_size
+     is modelled with slab_item_max set to item_max_for() it
+  """
+  models = []
+  for slab_size in slab_sizes:
+    for growth in growths:
+      try:
+        model = SlabModel(sizes, slab_size, growth, item_max=item_max_for(slab_size))
+      except ValueError:
+        continue
+      if model.oversize == 0 and model.nitem(slab_mem) > 0:
+        models.append(model)
+  if not models:
+    return None
+  best = max(m.nitem(slab_mem) for m in models)
+  close = [m for m in models if m.nitem(slab_mem) >= best * (1 - TIE_TOLERANCE)]
+  choice = min(close, key=lambda m: (len(m.profile), -m.nitem(slab_mem)))
+  return choice.growth, choice.slab_size, choice
+
+
+def format_model(model, slab_mem):
+  lines = ['slab_size: {}  slab_item_growth: {:.2f}  slab_item_max: {}  classes: {} ({} in use)'.format(
+    model.slab_size, model.growth, model.item_max, len(model.profile), len(model.classes))]
+  lines.append('{:>6} {:>9} {:>8} {:>12} {:>8} {:>12} {:>12}'.format(
+    'class', 'chunk', 'share', 'items', 'slabs', 'padding MB', 'tail MB'))
+  for r in model.breakdown(slab_mem):
+    lines.append('{:>6} {:>9} {:>8.4f} {:>12} {:>8} {:>12.1f} {:>12.1f}'.format(
+      r['class'], r['chunk'], r['share'], r['items'], r['slabs'],
+      r['padding'] / MB, r['tail'] / MB))
+  lines.append('items: {}, bytes per item: {:.1f} (mean key+value {:.1f}), efficiency: {:.3f}'
+               .format(model.nitem(slab_mem), model.bytes_per_item(), model.data,
+                       model.efficiency(slab_mem)))
+  if model.oversize:
+    lines.append('WARNING: {:.4f} of items are larger than the largest slab class'.format(
+      model.oversize))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Model twemcache slab classes for a distribution of key+value sizes: per-class
+    allocation, internal fragmentation, effective capacity, and the growth
+    factor and slab size that waste the least.
+    """)
+  parser.add_argument('sizes', help='csv of size,count (key+value bytes), or a keyspace json from klog/analyze.py')
+  parser.add_argument('--slab_mem', dest='slab_mem', type=int, default=4 * 1024 * MB, help='slab memory in bytes')
+  parser.add_argument('--slab_size', dest='slab_size', type=int, default=SLAB_SIZE, help='slab size in bytes')
+  parser.add_argument('--growth', dest='growth', type=float, default=ITEM_FACTOR, help='slab class growth factor')
+  parser.add_argument('--item_max', dest='item_max', type=int, default=ITEM_SIZE_MAX, help='slab_item_max, largest chunk in bytes')
+
+  args = parser.parse_args()
+
+  sizes = load_sizes(args.sizes)
+  try:
+    current = SlabModel(sizes, args.slab_size, args.growth, item_max=args.item_max)
+  except ValueError as e:
+    parser.error(str(e))
+  print(format_model(current, args.slab_mem))
+  rec = recommend(sizes, args.slab_mem)
+  if rec is None:
+    print('no candidate slab_size holds the largest items')
+  else:
+    print('\nrecommended:')
+    print(format_model(rec[2], args.slab_mem))
@@ -0,0 +1,175 @@
+"""Simulator of twemcache slab storage (src/storage/slab) on a workload.
+
+Each item takes a chunk of the smallest slab class that fits it (the profile
+slab.py computes). A class hands out chunks freed by deletes, overwrites and
+expired items found on access, then those of its slabs not yet used; when it
+has none left it takes a free slab, or evicts a whole slab of any class (at
+random, slab_evict_opt 1, or the least recently created one, 2) and reuses it,
+dropping every item in it. Expired items are only reclaimed when accessed or
+evicted, as item_get() does.
+
+Requests are processed in chunks with NumPy as in segsim.py: hits are decided
+from the state at the start of the chunk plus earlier requests to the same key
+in it, and only the last write of each key in a chunk takes a chunk, class by
+class, with slabs evicted as the class needs them.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from slab import ITEM_FACTOR, SLAB_HDR_SIZE, SLAB_SIZE, item_size, slab_profile
+import workload
+from workload import DELETE, GET, SEED
+
+
+POLICIES = ['random', 'lrc']
+
+
+class SlabCache(object):
+
+  def __init__(self, slab_mem, slab_size=SLAB_SIZE, growth=ITEM_FACTOR, policy='random',
+               set_on_miss=True, seed=SEED):
+    if policy not in POLICIES:
+      raise ValueError('unknown slab eviction policy {}'.format(policy))
+    self.profile = np.asarray(slab_profile(slab_size, growth), dtype=np.int64)
+    self.slab_size = slab_size
+    self.capacity = slab_size - SLAB_HDR_SIZE
+    self.per_slab = self.capacity // self.profile
+    self.nslab = int(slab_mem // slab_size)
+    if self.nslab < 1:
+      raise ValueError('slab_mem must hold at least one slab')
+    self.policy = policy
+    self.set_on_miss = set_on_miss
+    self.rng = np.random.default_rng(seed)
+    # per slab
+    self.slab_class = np.full(self.nslab, -1, dtype=np.int64)
+    self.slab_create = np.zeros(self.nslab, dtype=np.int64)  # order of (re)initialization
+    self.slab_live = np.zeros(self.nslab, dtype=np.int64)  # chunks holding an item
+    self.slab_items = [[] for _ in range(self.nslab)]  # [(keys, versions)] stored
+    self.free = list(range(self.nslab - 1, -1, -1))
+    self.ninit = 0
+    # per class: chunks available in its slabs
+    self.room = np.zeros(len(self.profile), dtype=np.int64)
+    # per key, grown on demand
+    self.key_slab = np.full(0, -1, dtype=np.int64)
+    self.key_ver = np.zeros(0, dtype=np.int64)
+    self.key_expire = np.zeros(0)
+    self.key_size = np.zeros(0, dtype=np.int64)  # item bytes, 0 if never known
+    self.next_ver = 0
+    # counters
+    self.stats = dict.fromkeys(['get', 'hit', 'set', 'delete', 'oversize', 'evict_slab',
+                                'evict_item', 'expire_item'], 0)
+
+
+  def _grow(self, nkey):
+    if nkey <= len(self.key_slab):
+      return
+    grow = max(nkey, 2 * len(self.key_slab)) - len(self.key_slab)
+    self.key_slab = np.concatenate([self.key_slab, np.full(grow, -1, dtype=np.int64)])
+    self.key_ver = np.concatenate([self.key_ver, np.zeros(grow, dtype=np.int64)])
+    self.key_expire = np.concatenate([self.key_expire, np.zeros(grow)])
+    self.key_size = np.concatenate([self.key_size, np.zeros(grow, dtype=np.int64)])
+
+
+  def _unlink(self, keys):
+    """free the chunks of stored keys"""
+    slabs = self.key_slab[keys]
+    np.subtract.at(self.slab_live, slabs, 1)
+    np.add.at(self.room, self.slab_class[slabs], 1)
+    self.key_slab[keys] = -1
+
+
+  def _evict(self):
+    """empty a slab in use, returns it"""
+    used = np.nonzero(self.slab_class >= 0)[0]
+    if self.policy == 'random':
+      s = int(used[self.rng.integers(len(used))])
+    else:
+      s = int(used[np.argmin(self.slab_create[used])])
+    keys = np.zeros(0, dtype=np.int64)
+    if self.slab_items[s]:
+      keys = np.concatenate([k for k, _ in self.slab_items[s]])
+      vers = np.concatenate([v for _, v in self.slab_items[s]])
+      keys = keys[(self.key_slab[keys] == s) & (self.key_ver[keys] == vers)]
+    self.key_slab[keys] = -1
+    c = self.slab_class[s]
+    self.room[c] -= self.per_slab[c] - self.slab_live[s]
+    self.stats['evict_slab'] += 1
+    self.stats['evict_item'] += len(keys)
+    return s
+
+
+  def _reserve(self, c, n):
+    """make room for n items of class c"""
+    if n > self.nslab * self.per_slab[c]:
+      raise ValueError('chunk stores {} items of {} bytes, more than fit, lower --chunk'
+                       .format(n, self.profile[c]))
+    while self.room[c] < n:
+      s = self.free.pop() if self.free else self._evict()
+      self.slab_class[s] = c
+      self.slab_live[s] = 0
+      self.slab_items[s] = []
+      self.slab_create[s] = self.ninit
+      self.ninit += 1
+      self.room[c] += self.per_slab[c]
+
+
+  def _store(self, c, keys, expire):
+    """place keys of class c into the chunks available"""
+    slabs = np.nonzero((self.slab_class == c) & (self.slab_live < self.per_slab[c]))[0]
+    avail = np.cumsum(self.per_slab[c] - self.slab_live[slabs])
+    dest = slabs[np.searchsorted(avail, np.arange(len(keys)), side='right')]
+    self.slab_live += np.bincount(dest, minlength=self.nslab)
+    self.room[c] -= len(keys)
+    vers = self.next_ver + np.arange(len(keys))
+    self.next_ver += len(keys)
+    self.key_slab[keys] = dest
+    self.key_ver[keys] = vers
+    self.key_expire[keys] = expire
+    for s in np.unique(dest):
+      mask = dest == s
+      self.slab_items[s].append((keys[mask], vers[mask]))
+
+
+  def process(self, op, key, klen, vlen, ttl, t):
+    """simulate one chunk of a workload (see workload.py)"""
+    if len(op) == 0:
+      return
+    self._grow(int(key.max()) + 1)
+    known = vlen >= 0
+    self.key_size[key[known]] = item_size(klen[known], vlen[known])
+    size = self.key_size[key]
+    cls = np.searchsorted(self.profile, size, side='left')
+    stored = self.key_slab[key] >= 0
+    before = stored & (self.key_expire[key] > t)
+    hit, write, order, first = workload.decide(op, key, before, self.set_on_miss)
+    self.stats['get'] += int((op == GET).sum())
+    self.stats['hit'] += int(hit.sum())
+    self.stats['set'] += int(write.sum())
+    self.stats['delete'] += int((op == DELETE).sum())
+    oversize = write & (cls >= len(self.profile))
+    self.stats['oversize'] += int(oversize.sum())
+    write &= ~oversize
+
+    # expired items are unlinked when accessed
+    expired = np.unique(key[stored & ~before])
+    self.stats['expire_item'] += len(expired)
+    self._unlink(expired)
+    # the last change per key replaces what is stored
+    fpos = workload.final_changes(write | (op == DELETE), order, first)
+    fkey = key[fpos]
+    self._unlink(fkey[self.key_slab[fkey] >= 0])
+    fpos = np.sort(fpos[op[fpos] != DELETE])
+    expire = np.where(ttl[fpos] > 0, t[fpos] + ttl[fpos], np.inf)
+    for c in np.unique(cls[fpos]):
+      mask = cls[fpos] == c
+      self._reserve(int(c), int(mask.sum()))
+      self._store(int(c), key[fpos[mask]], expire[mask])
+
+
+  def live_keys(self, now):
+    """keys stored and not expired"""
+    return np.nonzero((self.key_slab >= 0) & (self.key_expire > now))[0]
@@ -0,0 +1,447 @@
+"""Check the memory calculator.py predicts for a job against a running server.
+
+The calculator's output for the given requirements becomes a server config
+(slab_mem and slab_hash_power for twemcache, with the slab_size,
+slab_item_growth and slab_item_max it recommends given --sizes;
+cuckoo_item_size and cuckoo_nitem for slimcache; on free ports and in the
+foreground), which a PelikanServer starts, failing with the errors the server
+logged if it doesn't come up. Then, taking a snapshot of /proc/<pid>/smaps and the admin `stats`
+(procinfo's ru_maxrss among them) after each step:
+
+  start    nothing but the server itself
+  connect  --nconn connections opened, each setting a value and getting
+           about --conn_value bytes of it back, so both its buffers are in use
+  fill     keys of --size key+value bytes (or drawn from --sizes) set, the
+           predicted capacity and
+           then --fill_extra of it at a time, until the heap is full: it
+           evicts (slab_evict, item_evict) or item_curr stops growing
+
+each overhead term is compared with what was measured:
+
+  base     resident memory at start outside the data and hash allocations,
+           against BASE_OVERHEAD
+  conn     resident memory added by the connections, against CONN_OVERHEAD
+           per connection
+  hash     the hash table allocation, against HASH_OVERHEAD per bucket
+  data     the heap (slabs or cuckoo table) resident when full, against
+           slab_mem or nitem * item_size; reported together with hash as
+           data+hash when the kernel merged the two into one mapping
+  items    items held when full, found by getting every key set (twemcache's
+           item_curr doesn't drop when a slab is evicted), against what the
+           heap is sized for
+  item     heap memory per item held, over the mean key+value size:
+           ITEM_OVERHEAD and alignment (or slab class waste) for twemcache,
+           plus the free slots for slimcache
+  total    peak resident memory, against the sum of the above, and the
+           headroom left in the job's ram after SAFETY_BUF
+
+The data and hash allocations are the anonymous mappings closest in size to
+what the config asks for, within MATCH_ERROR. Needs a pelikan build (PELIKAN_BIN_PATH, as the
+integration tests), and Linux for /proc.
+"""
+
+from __future__ import print_function
+import argparse
+from math import ceil
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from client import AdminClient, DataClient
+from runner import free_ports
+from server import PelikanServer
+
+import calculator
+from calculator import BASE_OVERHEAD, CONN_OVERHEAD, GB, HASH_OVERHEAD, ITEM_OVERHEAD, MB, SAFETY_BUF
+
+
+ENGINES = ['twemcache', 'slimcache']
+KSIZE = 16  # in bytes, the rest of --size is value
+FILL_EXTRA = 0.05  # keys set per round beyond the predicted capacity, as a fraction of it
+FILL_ROUNDS = 40  # rounds beyond the predicted capacity before giving up on filling
+EVICT_METRIC = {'twemcache': 'slab_evict', 'slimcache': 'item_evict'}
+FILL_CONNECTIONS = 8
+BATCH_BYTES = 4000  # pipelined per connection, within one server read buffer
+SLAB_SIZE = 1048576  # as server_config.py
+LARGE_MAPPING = 1 * MB  # smaller anonymous mappings are never the heap or hash table
+MATCH_ERROR = 0.05  # relative size difference of a mapping and the allocation it holds
+CONN_VALUE = 12 * 1024  # in bytes, most of a 16KiB buf_init_size
+MAX_BATCH = 100  # keys per get, MAX_BATCH_SIZE in src/protocol/data/memcache
+SIZE_SAMPLE = 10000  # key+value sizes taken from --sizes, cycled through by the fill
+GET_DEPTH = 4  # gets of MAX_BATCH keys pipelined per connection when counting items held
+REQUEST_TIMEOUT = 10.0  # in seconds
+
+
+def server_config(engine, config, workdir, options=()):
+  """write the config calculator output config describes, returns its path"""
+  server_port, admin_port = free_ports(2)
+  lines = ['daemonize: no', 'server_port: {}'.format(server_port),
+           'admin_port: {}'.format(admin_port),
+           'debug_log_file: {}'.format(os.path.join(workdir, 'server.log'))]
+  if engine == 'twemcache':
+    lines += ['slab_evict_opt: 1', 'slab_prealloc: yes', 'slab_size: {}'.format(config.get('slab_size', SLAB_SIZE)),
+              'slab_mem: {}'.format(int(config['slab_mem'] * MB)),
+              'slab_hash_power: {}'.format(config['hash_power'])]
+    # the profile the calculator's item size was modelled on, if it recommended one
+    if 'slab_item_growth' in config:
+      lines += ['slab_item_growth: {}'.format(config['slab_item_growth']),
+                'slab_item_max: {}'.format(config['slab_item_max'])]
+  else:
+    lines += ['cuckoo_item_size: {}'.format(config['item_size']),
+              'cuckoo_nitem: {}'.format(config['nitem'])]
+  lines += list(options)
+  fname = os.path.join(workdir, '{}.config'.format(engine))
+  with open(fname, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return fname
+
+
+def log_errors(workdir):
+  """the ERROR and CRIT lines of the server log in workdir"""
+  try:
+    with open(os.path.join(workdir, 'server.log')) as f:
+      return [line.rstrip() for line in f if '[ERROR]' in line or '[CRIT]' in line]
+  except IOError:
+    return []
+
+
+def fill_sizes(args):
+  """key+value sizes of the keys set, cycled through: when the calculator
+     modelled slab classes on --sizes, SIZE_SAMPLE evenly spaced quantiles of
+     it in a fixed random order, else --size
+  """
+  if args.runnable != 'twemcache' or not getattr(args, 'sizes', None):
+    return [args.size]
+  import slab
+  dist = sorted(slab.load_sizes(args.sizes))
+  total = sum(w for _, w in dist)
+  sizes, cum, i = [], 0.0, 0
+  for q in range(SIZE_SAMPLE):
+    at = (q + 0.5) / SIZE_SAMPLE * total
+    while cum + dist[i][1] < at:
+      cum += dist[i][1]
+      i += 1
+    sizes.append(dist[i][0])
+  random.Random(0).shuffle(sizes)
+  return sizes
+
+
+def predict(engine, config, args):
+  """the calculator's terms for one job, in bytes; capacity is the keys that
+     fill the heap, items those it is sized to hold, size their mean
+     key+value bytes
+  """
+  size = args.size
+  if engine == 'twemcache':
+    hash_bytes = HASH_OVERHEAD[engine] * 2 ** config['hash_power']
+    data = int(config['slab_mem'] * MB)
+    item_size, _, model = calculator.item_model(args, config['ram'])
+    if model is None:
+      capacity = items = data // item_size
+    else:
+      capacity = items = model.nitem(data)
+      size = model.data
+  else:  # the calculator leaves slots free so inserts find room
+    hash_bytes = 0
+    data = config['nitem'] * config['item_size']
+    capacity = config['nitem']
+    items = int(capacity * config['load_factor'])
+  return {'base': BASE_OVERHEAD * MB, 'conn': CONN_OVERHEAD * args.nconn, 'hash': hash_bytes,
+          'data': data, 'capacity': capacity, 'items': items, 'size': size,
+          'budget': config['ram'] * GB - SAFETY_BUF * MB}
+
+
+def smaps(pid):
+  """[(start address, path, Size, Rss)] of every mapping, sizes in bytes"""
+  maps = []
+  with open('/proc/{}/smaps'.format(pid)) as f:
+    for line in f:
+      fields = line.split()
+      if '-' in fields[0] and not fields[0].endswith(':'):
+        maps.append([fields[0], fields[5] if len(fields) > 5 else '', 0, 0])
+      elif fields[0] in ('Size:', 'Rss:'):
+        maps[-1][2 if fields[0] == 'Size:' else 3] = int(fields[1]) * 1024
+  return [tuple(m) for m in maps]
+
+
+def peak_rss(pid):
+  """VmHWM, in bytes"""
+  with open('/proc/{}/status'.format(pid)) as f:
+    for line in f:
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+
+def server_stats(server):
+  admin = AdminClient(('localhost', server.admin_port))
+  try:
+    return admin.stats()
+  finally:
+    admin.close()
+
+
+def snapshot(server):
+  pid = server.server.pid
+  return {'maps': smaps(pid), 'stats': server_stats(server), 'peak': peak_rss(pid)}
+
+
+def find_mapping(maps, size, exclude=()):
+  """start address of the large anonymous mapping closest in size to size,
+     None if none is within MATCH_ERROR of it
+  """
+  anon = [m for m in maps if m[1] in ('', '[heap]') and m[2] >= LARGE_MAPPING and m[0] not in exclude]
+  if size <= 0 or not anon:
+    return None
+  best = min(anon, key=lambda m: abs(m[2] - size))
+  return best[0] if abs(best[2] - size) <= MATCH_ERROR * size else None
+
+
+def locate(maps, data, table):
+  """{term: mapping start} of the data and hash allocations; adjacent
+     anonymous mappings are merged by the kernel, so the two may share one,
+     found as data+hash
+  """
+  both = find_mapping(maps, data + table) if table else None
+  if both is not None and abs(mapping(maps, both)[2] - data - table) < \
+      abs(mapping(maps, both)[2] - data):
+    return {'data+hash': both}
+  found = {'data': find_mapping(maps, data)}
+  if table:
+    found['hash'] = find_mapping(maps, table, exclude=[found['data']])
+  return found
+
+
+def mapping(maps, start):
+  for m in maps:
+    if m[0] == start:
+      return m
+  return (start, '', 0, 0)
+
+
+def total(maps, col):
+  return sum(m[col] for m in maps)
+
+
+def connect(endpoint, nconn, vlen=CONN_VALUE, max_vlen=None):
+  """open nconn connections, each setting a value and getting it back, its
+     key repeated so about vlen bytes pass through both buffers; values are
+     capped at max_vlen (what a slimcache slot holds)
+  """
+  stored = min(vlen, max_vlen or vlen)
+  reps = min(MAX_BATCH, int(ceil(1.0 * vlen / stored)))
+  reqs = [[b'set validate 0 0 %d' % stored, b'x' * stored], [b'get' + b' validate' * reps]]
+  conns = []
+  for _ in range(nconn):
+    conns.append(DataClient(endpoint, request_timeout=REQUEST_TIMEOUT))
+    for req in reqs:  # one at a time, see fill()
+      conns[-1].request_pipelined([req])
+  return conns
+
+
+def fill(endpoint, nkey, sizes, connections=FILL_CONNECTIONS, max_bytes=BATCH_BYTES, first=0):
+  """set nkey keys numbered from first, key i of sizes[i % len(sizes)]
+     key+value bytes, up to max_bytes of them pipelined per connection (0:
+     one at a time); returns (stored, errors)
+  """
+  values = dict((size, b'x' * max(0, size - KSIZE)) for size in set(sizes))
+  clients = [DataClient(endpoint, request_timeout=REQUEST_TIMEOUT) for _ in range(connections)]
+  stored = errors = 0
+  try:
+    key, end = first, first + nkey
+    while key < end:
+      sent = []
+      for client in clients:
+        reqs, nbyte = [], 0
+        while key < end:
+          value = values[sizes[key % len(sizes)]]
+          req = [b'set %0*d 0 0 %d' % (KSIZE, key, len(value)), value]
+          req_bytes = len(req[0]) + len(value) + 4
+          if reqs and nbyte + req_bytes > max_bytes:
+            break
+          reqs.append(req)
+          nbyte += req_bytes
+          key += 1
+        if not reqs:
+          break
+        client.pipeline(reqs)
+        sent.append((client, len(reqs)))
+      for client, n in sent:
+        for rsp in client.responses(n):
+          if rsp[0] == b'STORED':
+            stored += 1
+          else:
+            errors += 1
+  finally:
+    for client in clients:
+      client.close()
+  return stored, errors
+
+
+def count_held(endpoint, nkey, connections=FILL_CONNECTIONS, depth=GET_DEPTH):
+  """how many of the nkey keys fill() set a get finds, up to depth gets of
+     MAX_BATCH keys pipelined per connection
+  """
+  clients = [DataClient(endpoint, request_timeout=REQUEST_TIMEOUT) for _ in range(connections)]
+  held = 0
+  try:
+    key = 0
+    while key < nkey:
+      sent = []
+      for client in clients:
+        reqs = []
+        while len(reqs) < depth and key < nkey:
+          n = min(MAX_BATCH, nkey - key)
+          reqs.append([b'get ' + b' '.join(b'%0*d' % (KSIZE, i) for i in range(key, key + n))])
+          key += n
+        if not reqs:
+          break
+        client.pipeline(reqs)
+        sent.append((client, len(reqs)))
+      for client, n in sent:
+        for rsp in client.responses(n):
+          held += (len(rsp) - 1) // 2  # VALUE line and data per hit, then END
+  finally:
+    for client in clients:
+      client.close()
+  return held
+
+
+def fill_until_full(server, engine, capacity, args, max_bytes=BATCH_BYTES):
+  """set capacity keys, then capacity * args.fill_extra at a time until the
+     heap evicts or item_curr stops growing, at most FILL_ROUNDS times;
+     returns (stored, errors, keys set, whether the heap was full)
+  """
+  endpoint = ('localhost', server.server_port)
+  step = max(1, int(ceil(capacity * args.fill_extra)))
+  sizes = fill_sizes(args)
+  stored = errors = nkey = 0
+  curr = -1
+  for rounds in range(FILL_ROUNDS + 1):
+    n = capacity if rounds == 0 else step
+    ok, failed = fill(endpoint, n, sizes, max_bytes=max_bytes, first=nkey)
+    stored, errors, nkey = stored + ok, errors + failed, nkey + n
+    stats = server_stats(server)
+    prev, curr = curr, int(stats.get('item_curr', 0))
+    if int(stats.get(EVICT_METRIC[engine], 0)) > 0 or curr <= prev:
+      return stored, errors, nkey, True
+  return stored, errors, nkey, False
+
+
+def measure(engine, config, args, options=()):
+  """run a server with config through start/connect/fill, returns the
+     snapshots, the fill counts and the items held after it
+  """
+  workdir = tempfile.mkdtemp(prefix='pelikan-validate-')
+  conns = []
+  server = None
+  try:
+    fname = server_config(engine, config, workdir, options)
+    server = PelikanServer('pelikan_' + engine, fname)
+    try:
+      server.ready()
+    except Exception as e:
+      with open(fname) as f:
+        lines = f.read().splitlines()
+      raise Exception('server did not come up ({}) with\n  {}\n{}'.format(
+        e, '\n  '.join(lines), '\n'.join(log_errors(workdir))))
+    endpoint = ('localhost', server.server_port)
+    result = {'start': snapshot(server)}
+    max_vlen = None
+    if engine == 'slimcache':
+      max_vlen = config['item_size'] - ITEM_OVERHEAD[engine] - len(b'validate')
+    conns = connect(endpoint, args.nconn, args.conn_value, max_vlen)
+    result['connect'] = snapshot(server)
+    start = time.time()
+    # slimcache_process_read() returns its request after the first one in a
+    # read and crashes parsing the next, so nothing is pipelined to it
+    max_bytes = 0 if engine == 'slimcache' else BATCH_BYTES
+    result['stored'], result['errors'], result['keys'], result['full'] = fill_until_full(
+      server, engine, predict(engine, config, args)['capacity'], args, max_bytes)
+    result['fill_time'] = time.time() - start
+    result['fill'] = snapshot(server)
+    result['held'] = count_held(endpoint, result['keys'],
+                                depth=1 if engine == 'slimcache' else GET_DEPTH)
+    return result
+  finally:
+    for conn in conns:
+      conn.close()
+    if server is not None:
+      server.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(engine, config, args, result):
+  """[(term, predicted, measured)] in bytes (items: a count, item: bytes per
+     item)
+  """
+  pred = predict(engine, config, args)
+  start, conn, full = result['start'], result['connect'], result['fill']
+  found = locate(full['maps'], pred['data'], pred['hash'])
+  outside = total(start['maps'], 3) - sum(mapping(start['maps'], at)[3] for at in found.values())
+  items = result['held']
+  terms = [
+    ('base', pred['base'], outside),
+    ('conn', pred['conn'], total(conn['maps'], 3) - total(start['maps'], 3))]
+  for name in sorted(found, reverse=True):  # hash after data
+    predicted = sum(pred[part] for part in name.split('+'))
+    terms.append((name, predicted, mapping(full['maps'], found[name])[3]))
+  terms += [
+    ('items', pred['items'], items),
+    ('item', 1.0 * pred['data'] / pred['items'] - pred['size'],
+     1.0 * pred['data'] / items - pred['size'] if items else 0)]
+  used = pred['base'] + pred['conn'] + pred['hash'] + pred['data']
+  # ru_maxrss is in KB on Linux
+  peak = max(full['peak'], int(full['stats'].get('ru_maxrss', 0)) * 1024)
+  terms.append(('total', used, peak))
+  terms.append(('headroom', pred['budget'] - used, pred['budget'] - peak))
+  return terms
+
+
+def format_terms(terms):
+  lines = ['{:<15} {:>14} {:>14} {:>14} {:>9}'.format('term', 'predicted', 'measured', 'error', 'error %')]
+  for name, pred, meas in terms:
+    if name in ('items', 'item'):
+      unit, scale = '' if name == 'items' else 'B', 1.0
+    else:
+      unit, scale = 'MB', 1.0 / MB
+    prec = 0 if name == 'items' else 1
+    lines.append('{:<15} {:>12.{p}f}{:>2} {:>12.{p}f}{:>2} {:>+12.{p}f}{:>2} {:>9}'.format(
+      name, pred * scale, unit, meas * scale, unit, (meas - pred) * scale, unit,
+      '{:+.1f}'.format(100.0 * (meas - pred) / pred) if pred and name != 'headroom' else '-',
+      p=prec))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(parents=[calculator.parser], conflict_handler='resolve',
+    description="""
+    Size a job with calculator.py, run one instance of it with nconn
+    connections, fill it to capacity, and report the error of each memory
+    overhead term the calculator assumes against smaps and procinfo stats.
+    """)
+  parser.add_argument('runnable', choices=ENGINES, help='flavor of backend')
+  parser.add_argument('--fill_extra', dest='fill_extra', type=float, default=FILL_EXTRA, help='keys set per round beyond the predicted capacity until the heap is full, as a fraction of it')
+  parser.add_argument('--conn_value', dest='conn_value', type=int, default=CONN_VALUE, help='bytes of the value every connection sets and gets')
+  parser.add_argument('--option', dest='option', nargs='*', default=[], help="extra server config lines, e.g. 'buf_init_size: 4096'")
+
+  args = parser.parse_args()
+
+  if args.size <= KSIZE:
+    parser.error('--size must exceed the {} bytes of the key'.format(KSIZE))
+  config = calculator.calculate(args)
+  print('job: {} GB ram, {} connections, {} instances'.format(config['ram'], args.nconn,
+                                                               config['instance']))
+  result = measure(args.runnable, config, args, args.option)
+  print('filled with {} keys ({} errors) in {:.1f}s'.format(result['stored'], result['errors'],
+                                                           result['fill_time']))
+  if not result['full']:
+    print('capacity not reached after {} keys: items and item are what the heap held then'.format(
+      result['keys']))
+  print()
+  print(format_terms(compare(args.runnable, config, args, result)))
@@ -0,0 +1,169 @@
+"""Request streams shared by the storage simulators.
+
+A workload is a sequence of chunks of NumPy arrays (op, key, klen, vlen, ttl,
+t): the operation (GET, SET or DELETE), a dense key id, key and value lengths
+in bytes (vlen is -1 where the request doesn't tell, i.e. gets and deletes in
+a klog), the ttl of sets in seconds (0: never expires) and the request time.
+It comes from a klog trace, read one record at a time, or from a synthetic
+Zipf workload, so a workload of any length is simulated in constant memory
+and can be regenerated in every worker of a process pool.
+
+decide() and final_changes() are the vectorized bookkeeping every simulator
+needs within a chunk: which gets hit given the state at the start of the chunk
+and earlier requests to the same key, and which request leaves each key in
+its final state.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../klog'))
+import klog
+
+
+GET, SET, DELETE = 0, 1, 2
+CHUNK = 16384
+SEED = 0
+
+# synthetic workload defaults
+NKEY = 1000000
+ALPHA = 1.0
+RATE = 100000  # requests per second of simulated time
+NREQ = 10000000
+GET_RATIO = 0.9
+VSIZE_MEAN = 200
+VSIZE_SIGMA = 1.0
+KSIZE = 32
+TTLS = [3600]
+
+
+def synthetic(nreq=NREQ, nkey=NKEY, alpha=ALPHA, get_ratio=GET_RATIO, ttls=TTLS,
+              rate=RATE, chunk=CHUNK, seed=SEED):
+  """yield chunks of a Zipf workload; each key has a fixed size and ttl"""
+  rng = np.random.default_rng(seed)
+  cdf = np.cumsum(1.0 / np.arange(1, nkey + 1) ** alpha)
+  cdf /= cdf[-1]
+  perm = rng.permutation(nkey)  # so popularity is not correlated with key id
+  vlen = np.maximum(1, rng.lognormal(np.log(VSIZE_MEAN), VSIZE_SIGMA, nkey)).astype(np.int64)
+  key_ttl = rng.choice(np.asarray(ttls, dtype=np.int64), nkey)
+  for start in range(0, nreq, chunk):
+    n = min(chunk, nreq - start)
+    key = perm[np.minimum(np.searchsorted(cdf, rng.random(n)), nkey - 1)]
+    op = np.where(rng.random(n) < get_ratio, GET, SET).astype(np.int8)
+    t = (start + np.arange(n)) / float(rate)
+    yield op, key, np.full(n, KSIZE, dtype=np.int64), vlen[key], key_ttl[key], t
+
+
+def from_klog(records, chunk=CHUNK):
+  """yield chunks of a klog trace, keys mapped to dense ids"""
+  ids = {}
+  ops = {b'get': GET, b'gets': GET, b'delete': DELETE}
+  buf = []
+  for rec in records:
+    op = ops.get(rec.cmd, SET if rec.vlen is not None else None)
+    if op is None:  # incr/decr
+      continue
+    key = ids.setdefault(rec.key, len(ids))
+    vlen = rec.vlen if op == SET else -1
+    buf.append((op, key, len(rec.key), vlen, klog.ttl(rec) if op == SET else 0, rec.time))
+    if len(buf) == chunk:
+      yield tuple(np.asarray(col) for col in zip(*buf))
+      buf = []
+  if buf:
+    yield tuple(np.asarray(col) for col in zip(*buf))
+
+
+def from_args(args):
+  """the workload the common options of a simulator describe: args.klog, or
+     the synthetic options
+  """
+  if args.klog:
+    return from_klog(klog.records(klog.klog_files(args.klog)), args.chunk)
+  return synthetic(args.nreq, args.nkey, args.alpha, args.get_ratio, args.ttl, args.rate,
+                   args.chunk, args.seed)
+
+
+def add_arguments(parser):
+  """options of from_args()"""
+  parser.add_argument('--klog', dest='klog', type=str, default=None, help='klog_file to replay (its .old backup is read first)')
+  parser.add_argument('--nreq', dest='nreq', type=int, default=NREQ, help='synthetic: number of requests')
+  parser.add_argument('--nkey', dest='nkey', type=int, default=NKEY, help='synthetic: number of keys')
+  parser.add_argument('--alpha', dest='alpha', type=float, default=ALPHA, help='synthetic: zipf exponent')
+  parser.add_argument('--get_ratio', dest='get_ratio', type=float, default=GET_RATIO, help='synthetic: fraction of gets')
+  parser.add_argument('--ttl', dest='ttl', type=int, nargs='+', default=TTLS, help='synthetic: ttls assigned uniformly to keys, 0 for none')
+  parser.add_argument('--rate', dest='rate', type=float, default=RATE, help='synthetic: requests per simulated second')
+  parser.add_argument('--no_set_on_miss', dest='no_set_on_miss', action='store_true', help='synthetic: do not set after a get miss')
+  parser.add_argument('--set_on_miss', dest='set_on_miss', action='store_true', help='klog: set after a get miss (klog has the sets already)')
+  parser.add_argument('--chunk', dest='chunk', type=int, default=CHUNK, help='requests simulated per vectorized step')
+  parser.add_argument('--seed', dest='seed', type=int, default=SEED, help='random seed')
+
+
+def set_on_miss(args):
+  """whether a get miss is followed by a set: klog has the sets already"""
+  return args.set_on_miss if args.klog else not args.no_set_on_miss
+
+
+def decide(op, key, before, set_on_miss):
+  """hits and writes of a chunk given, per request, whether the key was present
+     at the start of the chunk; returns (hit, write, order, first): order sorts
+     requests by key then position, first marks the first of each key in it
+  """
+  n = len(op)
+  is_get = op == GET
+  order = np.lexsort((np.arange(n), key))
+  k_s = key[order]
+  idx = np.arange(n)
+  first = np.ones(n, dtype=bool)
+  first[1:] = k_s[1:] != k_s[:-1]
+  group_start = np.maximum.accumulate(np.where(first, idx, 0))
+  # events that determine presence: sets, deletes, and gets (which either
+  # hit, or miss and are followed by a set when set_on_miss)
+  op_s = op[order]
+  ev = op_s != GET
+  if set_on_miss:
+    ev = np.ones(n, dtype=bool)
+  last_ev = np.maximum.accumulate(np.where(ev, idx, -1))
+  prev = np.concatenate([[-1], last_ev[:-1]])
+  has_prev = prev >= group_start
+  present_s = np.where(has_prev, op_s[np.maximum(prev, 0)] != DELETE, before[order])
+  hit = np.zeros(n, dtype=bool)
+  hit[order] = present_s & (op_s == GET)
+  hit &= is_get
+  write = (op == SET) | (is_get & ~hit & set_on_miss)
+  return hit, write, order, first
+
+
+def final_changes(change, order, first):
+  """positions of the last request per key among those with change set (the
+     key's state after the chunk), for the order and first of decide()
+  """
+  n = len(change)
+  change_s = change[order]
+  last = np.zeros(n, dtype=bool)
+  last[:-1] = first[1:]
+  last[-1] = True
+  idx = np.arange(n)
+  last_change = np.maximum.accumulate(np.where(change_s, idx, -1))
+  group_start = np.maximum.accumulate(np.where(first, idx, 0))
+  final = last & (last_change >= group_start)
+  return order[last_change[final]]
+
+
+def profile(chunks):
+  """(distinct keys, mean and max key+value bytes) of a workload, over the
+     requests that tell the value size
+  """
+  nkey = nset = 0
+  total = largest = 0
+  for op, key, klen, vlen, ttl, t in chunks:
+    nkey = max(nkey, int(key.max()) + 1)
+    kv = (klen + vlen)[vlen >= 0]
+    nset += len(kv)
+    total += int(kv.sum())
+    largest = max(largest, int(kv.max()) if len(kv) else 0)
+  return nkey, 1.0 * total / max(1, nset), largest
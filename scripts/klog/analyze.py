@@ -0,0 +1,318 @@
+"""Workload characterization from klog.
+
+One pass over the log computes the command mix, key/value size and TTL
+distributions, key popularity (Zipf exponent) and the reuse-distance
+distribution, from which an LRU hit-ratio curve follows.
+
+Per-key state is kept only for a spatially hashed sample of keys (fixed-size
+SHARDS, Waldspurger et al., FAST '15): a key is tracked iff hash(key) <
+threshold, and the threshold is lowered whenever more than --max_keys keys are
+tracked, so memory is bounded regardless of log size. Reuse distances measured
+on the sample are scaled up by the sampling rate, and the difference between
+expected and sampled gets is credited to the smallest distance (SHARDS_adj),
+which corrects most of the bias from whether or not hot keys were sampled.
+
+Note that klog itself samples commands (one in klog_sample), which thins out
+every key's accesses. Mix, sizes and TTLs are unaffected, but the popularity
+and hit-ratio curve are best measured on a capture taken with klog_sample: 1.
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import hashlib
+import heapq
+import json
+from math import log
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../load_testing'))
+from histogram import Histogram
+
+import klog
+
+
+MAX_KEYS = 1 << 18  # keys tracked by SHARDS, bounds memory
+HASH_SPACE = 1 << 64
+SAMPLE_RATE = 1.0  # initial SHARDS sampling rate, lowered as needed
+MRC_POINTS = 20
+ZIPF_MIN_COUNT = 2  # ignore keys seen once, the sampled tail flattens the fit
+
+
+class Fenwick(object):
+  """binary indexed tree of 0/1 marks over access times, for suffix counts"""
+
+  def __init__(self, size):
+    self.size = size
+    self.tree = [0] * (size + 1)
+
+
+  def add(self, pos, delta):
+    pos += 1
+    while pos <= self.size:
+      self.tree[pos] += delta
+      pos += pos & -pos
+
+
+  def prefix(self, pos):
+    """sum of marks in [0, pos)"""
+    total = 0
+    while pos > 0:
+      total += self.tree[pos]
+      pos -= pos & -pos
+    return total
+
+
+class ReuseDistance(object):
+  """SHARDS-sampled LRU stack distances, in constant memory"""
+
+  def __init__(self, max_keys=MAX_KEYS, rate=SAMPLE_RATE):
+    self.max_keys = max_keys
+    self.threshold = int(rate * HASH_SPACE)
+    self.keys = {}  # key -> [last access time, access count]
+    self.heap = []  # (-hash, key) of tracked keys, to find the largest hash
+    self.clock = 0
+    self.marks = Fenwick(4 * max_keys)
+    self.live = 0  # number of marks set
+    self.distance = Histogram()  # scaled distances of sampled gets that were reuses
+    self.cold = 0  # scaled sampled gets with no previous access
+    self.gets = 0  # scaled sampled gets
+    self.all_gets = 0  # every get, sampled or not
+
+
+  @staticmethod
+  def hash(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+
+  def rate(self):
+    return 1.0 * self.threshold / HASH_SPACE
+
+
+  def _compact(self):
+    """renumber live access times into a fresh tree"""
+    order = sorted(self.keys.items(), key=lambda kv: kv[1][0])
+    self.marks = Fenwick(self.marks.size)
+    t = 0
+    for _, state in order:
+      if state[0] >= 0:
+        state[0] = t
+        self.marks.add(t, 1)
+        t += 1
+    self.clock = t
+
+
+  def _shrink(self):
+    """lower the threshold until at most max_keys keys are tracked"""
+    while len(self.keys) > self.max_keys:
+      neg_hash, key = heapq.heappop(self.heap)
+      self.threshold = -neg_hash
+      state = self.keys.pop(key)
+      if state[0] >= 0:
+        self.marks.add(state[0], -1)
+        self.live -= 1
+
+
+  def access(self, key, is_get, is_delete=False):
+    if is_get:
+      self.all_gets += 1
+    h = ReuseDistance.hash(key)
+    if h >= self.threshold:
+      return
+    weight = int(round(1.0 / self.rate()))
+    state = self.keys.get(key)
+    if is_get:
+      self.gets += weight
+    if state is None:
+      state = self.keys[key] = [-1, 0]
+      heapq.heappush(self.heap, (-h, key))
+    if state[0] >= 0:
+      if is_get:
+        reuse = self.live - self.marks.prefix(state[0] + 1)
+        self.distance.record(int(reuse / self.rate()), weight)
+      self.marks.add(state[0], -1)
+      self.live -= 1
+    elif is_get:
+      self.cold += weight
+    state[1] += 1
+    if is_delete:
+      state[0] = -1
+    else:
+      if self.clock == self.marks.size:
+        self._compact()
+      state[0] = self.clock
+      self.marks.add(self.clock, 1)
+      self.live += 1
+      self.clock += 1
+    if len(self.keys) > self.max_keys:
+      self._shrink()
+
+
+  def hit_ratio(self, nobj):
+    """LRU get hit ratio with room for nobj objects"""
+    if self.all_gets == 0:
+      return 0.0
+    hits = self.all_gets - self.gets  # SHARDS_adj
+    for idx, count in enumerate(self.distance.counts):
+      if count:
+        low, high = self.distance.bucket_range(idx)
+        if high < nobj:
+          hits += count
+        elif low < nobj:  # assume uniform within the bucket
+          hits += count * (nobj - low) / (high - low + 1.0)
+    return min(1.0, max(0.0, 1.0 * hits / self.all_gets))
+
+
+  def distinct_keys(self):
+    return int(len(self.keys) / self.rate())
+
+
+  def zipf(self):
+    """least-squares Zipf exponent on log(count) vs. log(rank) of sampled keys"""
+    counts = sorted((s[1] for s in self.keys.values() if s[1] >= ZIPF_MIN_COUNT), reverse=True)
+    if len(counts) < 2:
+      return None
+    xs = [log((rank + 1) / self.rate()) for rank in range(len(counts))]
+    ys = [log(c) for c in counts]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mx) ** 2 for x in xs)
+    if var == 0:
+      return None
+    return -sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+
+
+class Workload(object):
+  """single-pass aggregate over klog records"""
+
+  def __init__(self, max_keys=MAX_KEYS, rate=SAMPLE_RATE):
+    self.cmds = {}
+    self.ksize = Histogram()
+    self.vsize = Histogram()
+    self.ttl = Histogram()
+    self.no_ttl = 0
+    self.hits = 0
+    self.reuse = ReuseDistance(max_keys, rate)
+    self.first = None
+    self.last = None
+
+
+  def add(self, rec):
+    cmd = rec.cmd.decode()
+    self.cmds[cmd] = self.cmds.get(cmd, 0) + 1
+    self.first = rec.time if self.first is None else self.first
+    self.last = rec.time
+    self.ksize.record(len(rec.key))
+    is_get = rec.cmd in klog.RETRIEVAL
+    if is_get and klog.is_hit(rec):
+      self.hits += 1
+    if rec.vlen is not None:
+      self.vsize.record(rec.vlen)
+      ttl = klog.ttl(rec)
+      if ttl:
+        self.ttl.record(ttl)
+      else:
+        self.no_ttl += 1
+    self.reuse.access(rec.key, is_get, rec.cmd == b'delete')
+
+
+  def item_size(self):
+    """mean key+value size in bytes, what calculator.py calls --size"""
+    return int(round(self.ksize.mean() + self.vsize.mean()))
+
+
+  def mrc(self, points=MRC_POINTS):
+    """[(cache bytes of key+value data, objects, hit ratio)], log-spaced"""
+    nkey = max(1, self.reuse.distinct_keys())
+    size = max(1, self.item_size())
+    curve = []
+    for i in range(1, points + 1):
+      nobj = int(round(nkey ** (1.0 * i / points)))
+      curve.append((nobj * size, nobj, self.reuse.hit_ratio(nobj)))
+    return curve
+
+
+  def keyspace(self):
+    """a keyspace description loadgen.py --keyspace understands"""
+    values = []
+    for idx, count in enumerate(self.vsize.counts):
+      if count:
+        low, high = self.vsize.bucket_range(idx)
+        values.append(((low + high) // 2, count))
+    return {
+      'ksize': int(round(self.ksize.mean())),
+      'nkey': self.reuse.distinct_keys(),
+      'commands': [(cmd, n) for cmd, n in sorted(self.cmds.items())
+                   if cmd in ('get', 'set', 'delete')],
+      'values': values or [(0, 1)],
+    }
+
+
+def format_sizes(name, h):
+  return '{:<16} mean: {:<10.1f} p50: {:<10} p99: {:<10} max: {}'.format(
+    name, h.mean(), h.percentile(50), h.percentile(99), h.max)
+
+
+def format_report(w):
+  total = sum(w.cmds.values())
+  gets = sum(w.cmds.get(c, 0) for c in ('get', 'gets'))
+  lines = ['records: {} over {}s'.format(total, (w.last or 0) - (w.first or 0))]
+  for cmd, n in sorted(w.cmds.items()):
+    lines.append('  {:<10} {:>12} {:>7.2f}%'.format(cmd, n, 100.0 * n / total))
+  if gets:
+    lines.append('captured get hit ratio: {:.4f}'.format(1.0 * w.hits / gets))
+  zipf = w.reuse.zipf()
+  lines.append('distinct keys (est.): {}, zipf exponent: {}'.format(
+    w.reuse.distinct_keys(), 'n/a' if zipf is None else '{:.3f}'.format(zipf)))
+  lines.append(format_sizes('key size', w.ksize))
+  lines.append(format_sizes('value size', w.vsize))
+  stores = w.ttl.total + w.no_ttl
+  if stores:
+    lines.append(format_sizes('ttl (s)', w.ttl) +
+                 '  no ttl: {:.2f}%'.format(100.0 * w.no_ttl / stores))
+  lines.append('LRU hit ratio curve (SHARDS rate {:.5f}):'.format(w.reuse.rate()))
+  for nbyte, nobj, ratio in w.mrc():
+    lines.append('  {:>14.1f} MB {:>14} objects  {:.4f}'.format(1.0 * nbyte / 2 ** 20, nobj, ratio))
+  lines.append('calculator.py: --size {} --nkey {}'.format(
+    w.item_size(), max(1, -(-w.reuse.distinct_keys() // 1000000))))
+  return '\n'.join(lines)
+
+
+def analyze(records, max_keys=MAX_KEYS, rate=SAMPLE_RATE):
+  w = Workload(max_keys, rate)
+  for rec in records:
+    w.add(rec)
+  return w
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Characterize the workload captured in a klog: command mix, sizes, TTLs,
+    key popularity and a SHARDS-approximated LRU hit-ratio curve.
+    """)
+  parser.add_argument('klog_file', help='klog_file as configured, e.g. log/twemcache-12300.cmd')
+  parser.add_argument('--backup', dest='backup', type=str, default=None, help='klog_backup, defaults to <klog_file>.old')
+  parser.add_argument('--mmap', dest='mmap', action='store_true', help='mmap klog files instead of buffered reads')
+  parser.add_argument('--max_keys', dest='max_keys', type=int, default=MAX_KEYS, help='keys tracked for reuse distance, bounds memory')
+  parser.add_argument('--rate', dest='rate', type=float, default=SAMPLE_RATE, help='initial key sampling rate')
+  parser.add_argument('--mrc', dest='mrc', type=str, default=None, help='write the hit ratio curve as csv (cache_bytes,objects,hit_ratio)')
+  parser.add_argument('--keyspace', dest='keyspace', type=str, default=None, help='write a keyspace json for loadgen.py --keyspace')
+
+  args = parser.parse_args()
+
+  fnames = klog.klog_files(args.klog_file, args.backup)
+  if not fnames:
+    parser.error('no klog found at {}'.format(args.klog_file))
+  w = analyze(klog.records(fnames, args.mmap), args.max_keys, args.rate)
+  print(format_report(w))
+  if args.mrc:
+    with open(args.mrc, 'w') as f:
+      writer = csv.writer(f)
+      writer.writerow(['cache_bytes', 'objects', 'hit_ratio'])
+      for row in w.mrc():
+        writer.writerow(row)
+  if args.keyspace:
+    with open(args.keyspace, 'w') as f:
+      json.dump(w.keyspace(), f, indent=2)
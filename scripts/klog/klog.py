@@ -0,0 +1,165 @@
+"""Streaming reader for the memcache command log (klog).
+
+src/protocol/data/memcache/klog.c writes one line per sampled command (one per
+key for multi-key gets), for example:
+
+  - - [18/Oct/2026:04:44:54 +0000] "get foo" 4 24
+  - - [18/Oct/2026:04:44:54 +0000] "set foo 0 3600 3" 5 8
+  - - [18/Oct/2026:04:44:54 +0000] "cas foo 0 0 3 42" 6 8
+  - - [18/Oct/2026:04:44:54 +0000] "incr foo 1" 12 3
+  - - [18/Oct/2026:04:44:54 +0000] "delete foo" 7 9
+
+i.e. the peer (a placeholder for now), KLOG_TIME_FMT, then one of
+KLOG_GET_FMT/KLOG_STORE_FMT/KLOG_CAS_FMT/KLOG_DELTA_FMT: the quoted request,
+the response type (see RSP_TYPES) and the response length in bytes. When the log reaches klog_max it is rotated into
+klog_backup (`<klog_file>.old` in the load testing configs), so a complete
+capture is the backup followed by the current file.
+
+Records are yielded one at a time, so arbitrarily large logs are processed in
+constant memory.
+"""
+
+from __future__ import print_function
+import argparse
+from collections import namedtuple
+from datetime import datetime
+import mmap
+import os
+
+# mirrors RSP_TYPE_MSG in src/protocol/data/memcache/response.h
+RSP_TYPES = ['UNKNOWN', 'OK', 'END', 'STAT', 'VALUE', 'STORED', 'EXISTS',
+             'DELETED', 'NOT_FOUND', 'NOT_STORED', 'CLIENT_ERROR', 'SERVER_ERROR',
+             'NUMERIC']
+RSP_UNKNOWN = 0
+RSP_VALUE = 4
+
+KLOG_SAMPLE = 100  # default klog_sample, see klog.h
+KLOG_TIME_FMT = '%d/%b/%Y:%H:%M:%S %z'
+BACKUP_SUFFIX = '.old'
+TIME_MEMCACHE_MAXDELTA_SEC = 60 * 60 * 24 * 30  # expiry above this is a unix time
+
+RETRIEVAL = (b'get', b'gets')
+STORAGE = (b'set', b'add', b'replace', b'append', b'prepend')
+DELTA = (b'incr', b'decr')
+
+# cmd and key are bytes; fields that don't apply to a command are None
+Record = namedtuple('Record', 'time cmd key flag expiry vlen cas delta status rsp_len')
+
+
+class KlogParser(object):
+  """parse klog lines into Records, caching timestamp conversion"""
+
+  def __init__(self):
+    self.last_ts = None
+    self.last_time = 0
+    self.invalid = 0
+
+
+  def timestamp(self, ts):
+    if ts != self.last_ts:  # most consecutive lines share the same second
+      self.last_time = int(datetime.strptime(ts.decode(), KLOG_TIME_FMT).timestamp())
+      self.last_ts = ts
+    return self.last_time
+
+
+  def parse(self, line):
+    """returns a Record, or None (and counts it) if the line is malformed"""
+    try:
+      lb = line.index(b'[')
+      rb = line.index(b']', lb)
+      q1 = line.index(b'"', rb)
+      q2 = line.rindex(b'"')
+      req = line[q1 + 1:q2].split()
+      status, rsp_len = line[q2 + 1:].split()
+      cmd = req[0]
+      common = dict(time=self.timestamp(line[lb + 1:rb]), cmd=cmd, key=req[1],
+                    flag=None, expiry=None, vlen=None, cas=None, delta=None,
+                    status=int(status), rsp_len=int(rsp_len))
+      if cmd in STORAGE or cmd == b'cas':
+        common.update(flag=int(req[2]), expiry=int(req[3]), vlen=int(req[4]))
+        if cmd == b'cas':
+          common['cas'] = int(req[5])
+      elif cmd in DELTA:
+        common['delta'] = int(req[2])
+      elif cmd not in RETRIEVAL and cmd != b'delete':
+        raise ValueError('unknown command')
+      return Record(**common)
+    except (ValueError, IndexError):
+      self.invalid += 1
+      return None
+
+
+def klog_files(klog_file, backup=None):
+  """existing files of a (possibly rotated) klog, oldest first"""
+  backup = backup or klog_file + BACKUP_SUFFIX
+  return [f for f in [backup, klog_file] if os.path.exists(f)]
+
+
+def lines(fname, use_mmap=False):
+  """yield raw lines (bytes, newline stripped) of one file"""
+  if use_mmap:
+    with open(fname, 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        return
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        pos, end = 0, len(mm)
+        while pos < end:
+          nl = mm.find(b'\n', pos)
+          if nl < 0:
+            nl = end
+          yield mm[pos:nl]
+          pos = nl + 1
+      finally:
+        mm.close()
+  else:
+    with open(fname, 'rb') as f:
+      for line in f:
+        yield line.rstrip(b'\n')
+
+
+def records(fnames, use_mmap=False, parser=None):
+  """yield Records from files in order, skipping malformed lines"""
+  parser = parser or KlogParser()
+  for fname in fnames:
+    for line in lines(fname, use_mmap):
+      rec = parser.parse(line)
+      if rec is not None:
+        yield rec
+
+
+def ttl(rec):
+  """expiry of a storage record as a relative TTL in seconds (0: never)"""
+  if not rec.expiry:
+    return 0
+  if rec.expiry > TIME_MEMCACHE_MAXDELTA_SEC:  # absolute unix time
+    return max(1, rec.expiry - rec.time)
+  return rec.expiry
+
+
+def is_hit(rec):
+  return rec.cmd in RETRIEVAL and rec.status == RSP_VALUE
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Print a per-command summary of a klog, including its rotated backup.
+    """)
+  parser.add_argument('klog_file', help='klog_file as configured, e.g. log/twemcache-12300.cmd')
+  parser.add_argument('--backup', dest='backup', type=str, default=None, help='klog_backup, defaults to <klog_file>.old')
+  parser.add_argument('--mmap', dest='mmap', action='store_true', help='mmap files instead of buffered reads')
+
+  args = parser.parse_args()
+
+  p = KlogParser()
+  count = {}
+  first = last = None
+  for rec in records(klog_files(args.klog_file, args.backup), args.mmap, p):
+    key = (rec.cmd.decode(), RSP_TYPES[rec.status] if rec.status < len(RSP_TYPES) else rec.status)
+    count[key] = count.get(key, 0) + 1
+    first = rec.time if first is None else first
+    last = rec.time
+  for (cmd, status), n in sorted(count.items()):
+    print('{:<10} {:<14} {}'.format(cmd, status, n))
+  if first is not None:
+    print('span: {}s, malformed lines: {}'.format(last - first, p.invalid))
@@ -0,0 +1,186 @@
+"""Replay a klog capture against a memcache server.
+
+Commands are re-issued at their original inter-arrival timing, or N times
+faster with --speedup. klog timestamps have one-second resolution, so records
+within the same second are spread evenly across it. Since klog only keeps one
+in klog_sample commands, each record is upscaled back into --upscale requests,
+either by repeating the key (keeps per-key rates and the hot spots) or by
+cloning it into distinct keyspaces (keeps the key count growing with rate).
+
+Requests are sharded over connections by key, so commands on the same key
+stay ordered. Latency and hit/miss accounting reuse loadgen.py.
+"""
+
+from __future__ import print_function
+import argparse
+import asyncio
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../load_testing'))
+from loadgen import LoadProtocol, CONNECT_TIMEOUT, DRAIN_TIMEOUT, MAX_INFLIGHT, \
+  encode_requests, format_result, new_latency, new_stats
+import histogram
+
+import klog
+
+
+CONNECTIONS = 16
+SPEEDUP = 1.0
+UPSCALE_MODES = ['repeat', 'clone']
+SLEEP_MIN = 1e6  # in ns, requests due sooner than this are sent right away
+REPLAY_CMDS = ['get', 'gets', 'set', 'add', 'replace', 'append', 'prepend',
+               'cas', 'incr', 'decr', 'delete']
+
+
+def to_request(rec, clone=0):
+  """klog record -> (cmd, request lines); clone > 0 prefixes the key"""
+  key = rec.key if clone == 0 else str(clone).encode() + b':' + rec.key
+  cmd = rec.cmd
+  if cmd in klog.RETRIEVAL or cmd == b'delete':
+    return cmd.decode(), [cmd + b' ' + key]
+  if cmd in klog.DELTA:
+    return cmd.decode(), [b' '.join([cmd, key, str(rec.delta).encode()])]
+  # storage; cas tokens from the capture are meaningless now, replay as set
+  if cmd == b'cas':
+    cmd = b'set'
+  header = b' '.join([cmd, key, str(rec.flag).encode(), str(klog.ttl(rec)).encode(),
+                      str(rec.vlen).encode()])
+  return cmd.decode(), [header, b'x' * rec.vlen]
+
+
+def seconds(records):
+  """group a record stream into (timestamp, [records]) one second at a time"""
+  batch, current = [], None
+  for rec in records:
+    if rec.time != current and batch:
+      yield current, batch
+      batch = []
+    current = rec.time
+    batch.append(rec)
+  if batch:
+    yield current, batch
+
+
+def expand(batch, upscale, mode):
+  """upscale one second of records, interleaving copies across the second"""
+  for copy in range(upscale):
+    for rec in batch:
+      yield to_request(rec, copy if mode == 'clone' else 0)
+
+
+class Replayer(object):
+
+  def __init__(self, endpoint, nconn, speedup, upscale, mode):
+    self.endpoint = endpoint
+    self.nconn = nconn
+    self.speedup = speedup
+    self.upscale = upscale
+    self.mode = mode
+    self.stats = new_stats(REPLAY_CMDS)
+    self.latency = new_latency(REPLAY_CMDS)
+    self.conns = []
+    self.behind = 0.0  # worst lag of the dispatcher behind schedule, in seconds
+
+
+  async def connect(self):
+    loop = asyncio.get_running_loop()
+    for _ in range(self.nconn):
+      transport, proto = await asyncio.wait_for(
+        loop.create_connection(lambda: LoadProtocol(self.stats, self.latency), *self.endpoint),
+        CONNECT_TIMEOUT)
+      self.conns.append((transport, proto, bytearray()))
+
+
+  def flush(self, queued, now):
+    for idx, reqs in enumerate(queued):
+      if reqs:
+        transport, proto, wbuf = self.conns[idx]
+        for cmd, _, intended in reqs:
+          proto.pending.append((cmd, min(intended, now), now))
+          self.stats[cmd]['request'] += 1
+        wbuf, n = encode_requests([req for _, req, _ in reqs], wbuf)
+        self.conns[idx] = (transport, proto, wbuf)
+        proto.drained.clear()
+        transport.write(wbuf[:n])
+        del reqs[:]
+
+
+  async def run(self, records):
+    await self.connect()
+    start = time.monotonic_ns()
+    t0 = None
+    queued = [[] for _ in self.conns]
+    for ts, batch in seconds(records):
+      t0 = ts if t0 is None else t0
+      step = 1e9 / (len(batch) * self.upscale) / self.speedup
+      base = start + (ts - t0) * 1e9 / self.speedup
+      for i, (cmd, req) in enumerate(expand(batch, self.upscale, self.mode)):
+        intended = int(base + i * step)
+        now = time.monotonic_ns()
+        if intended - now > SLEEP_MIN:  # send what is due before waiting
+          self.flush(queued, now)
+          await asyncio.sleep((intended - now) / 1e9)
+        elif now > intended:
+          self.behind = max(self.behind, (now - intended) / 1e9)
+        idx = zlib.crc32(req[0].split()[1]) % len(self.conns)
+        queued[idx].append((cmd, req, intended))
+        proto = self.conns[idx][1]
+        if len(proto.pending) + len(queued[idx]) >= MAX_INFLIGHT:
+          self.flush(queued, time.monotonic_ns())
+          proto.room.clear()
+          await proto.room.wait()
+    self.flush(queued, time.monotonic_ns())
+    for transport, proto, _ in self.conns:
+      if proto.pending and not proto.lost:
+        try:
+          await asyncio.wait_for(proto.drained.wait(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+          pass
+      transport.close()
+    return {'stats': self.stats, 'latency': {self.endpoint[1]: self.latency},
+            'elapsed': (time.monotonic_ns() - start) / 1e9}
+
+
+def replay(records, endpoint, nconn=CONNECTIONS, speedup=SPEEDUP,
+           upscale=klog.KLOG_SAMPLE, mode='repeat'):
+  replayer = Replayer(endpoint, nconn, speedup, upscale, mode)
+  result = asyncio.run(replayer.run(records))
+  result['behind'] = replayer.behind
+  return result
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Replay the get/set/delete stream captured in a klog (and its rotated
+    backup) against a server, at original timing or sped up.
+    """)
+  parser.add_argument('klog_file', help='klog_file as configured, e.g. log/twemcache-12300.cmd')
+  parser.add_argument('--backup', dest='backup', type=str, default=None, help='klog_backup, defaults to <klog_file>.old')
+  parser.add_argument('--server_ip', dest='server_ip', type=str, default='127.0.0.1', help='server ip')
+  parser.add_argument('--port', dest='port', type=int, default=12321, help='server port')
+  parser.add_argument('--connections', dest='connections', type=int, default=CONNECTIONS, help='number of connections')
+  parser.add_argument('--speedup', dest='speedup', type=float, default=SPEEDUP, help='replay N times faster than captured')
+  parser.add_argument('--upscale', dest='upscale', type=int, default=klog.KLOG_SAMPLE, help='requests per klog record, normally klog_sample')
+  parser.add_argument('--upscale_mode', dest='upscale_mode', choices=UPSCALE_MODES, default='repeat', help='repeat keys, or clone them into distinct keyspaces')
+  parser.add_argument('--mmap', dest='mmap', action='store_true', help='mmap klog files instead of buffered reads')
+  parser.add_argument('--output', dest='output', type=str, default=None, help='folder to write latency_<port>.json into, for report.py')
+
+  args = parser.parse_args()
+
+  fnames = klog.klog_files(args.klog_file, args.backup)
+  if not fnames:
+    parser.error('no klog found at {}'.format(args.klog_file))
+  records = klog.records(fnames, args.mmap)
+  result = replay(records, (args.server_ip, args.port), args.connections, args.speedup,
+                  args.upscale, args.upscale_mode)
+  print(format_result(result))
+  print('dispatcher fell behind schedule by up to {:.3f}s'.format(result['behind']))
+  if args.output:
+    if not os.path.exists(args.output):
+      os.makedirs(args.output)
+    histogram.dump(result['latency'][args.port],
+                   os.path.join(args.output, 'latency_{}.json'.format(args.port)))
@@ -0,0 +1,151 @@
+"""Measure the qps ceiling of a single pelikan instance.
+
+A server is started locally through test/integration's PelikanServer, and for
+every value size and connection count loadgen.py offers increasing rates
+(x --step each time) until the latency SLO is violated or the server can no
+longer keep up, then bisects between the last passing and first failing rate.
+The highest passing rate is the ceiling for that point; the search is the one
+saturate.py runs against already running instances. A rate the server can't
+be reached at, e.g. after it crashed, fails, and the server is restarted for
+the next point. Slimcache is driven with one request in flight per connection,
+see loadgen.ENGINE_MAX_INFLIGHT.
+
+The resulting profile is what `calculator.py --calibration` uses in place of
+the KQPS guess:
+
+  {"engine": ..., "slo": {"percentile": 99.9, "latency_us": 1000}, ...,
+   "points": [{"size": 64, "vsize": 32, "nconn": 16, "kqps": 210.5}, ...]}
+
+where size is key+value bytes, as calculator.py --size. Each point also keeps
+the server's startup times (seconds to listen and to prefill).
+"""
+
+from __future__ import print_function
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from server import PelikanServer
+
+import loadgen
+import saturate
+from client_config import KSIZE
+
+
+ENGINE = 'pelikan_twemcache'
+SERVER_PORT = 12321
+ADMIN_PORT = 9999
+SLAB_MEM = 256 * 1024 * 1024  # in bytes, small so prefill is quick
+VSIZES = [32, 256, 2048]
+NCONNS = [16, 256]
+START_RATE = 10000
+STEP = 2.0
+REFINE = 3  # bisection rounds after the first failing rate
+DURATION = 10  # in seconds, per rate
+SLO_PERCENTILE = 99.9
+SLO_LATENCY = 1000  # in us
+
+
+def server_config(engine, workdir, vsize, slab_mem=SLAB_MEM,
+                  server_port=SERVER_PORT, admin_port=ADMIN_PORT):
+  """write a config sized for one value size, returns its path"""
+  item_size = vsize + KSIZE + loadgen.client_config.PELIKAN_ITEM_OVERHEAD
+  nkey = slab_mem // item_size
+  lines = ['server_port: {}'.format(server_port),
+           'admin_port: {}'.format(admin_port),
+           'debug_log_file: {}'.format(os.path.join(workdir, 'pelikan.log')),
+           'debug_log_level: 4']
+  if engine == 'pelikan_slimcache':
+    lines += ['cuckoo_item_size: {}'.format(item_size), 'cuckoo_nitem: {}'.format(nkey)]
+  else:
+    lines += ['slab_mem: {}'.format(slab_mem),
+              'slab_hash_power: {}'.format(max(16, nkey.bit_length())),
+              'prefill: yes', 'prefill_ksize: {}'.format(KSIZE),
+              'prefill_vsize: {}'.format(vsize), 'prefill_nkey: {}'.format(nkey)]
+  fname = os.path.join(workdir, 'calibrate-{}.conf'.format(vsize))
+  with open(fname, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return fname
+
+
+def ceiling(endpoint, nconn, keyspace, args, log=print):
+  """highest rate (requests/s) meeting the SLO for one configuration"""
+  def attempt(rate):
+    try:
+      result = loadgen.run([endpoint], nconn, rate, args.duration, keyspace, args.processes,
+                           max_inflight=loadgen.engine_max_inflight(args.engine))
+    except (OSError, asyncio.TimeoutError) as e:  # e.g. the server is gone
+      log('  nconn {:>5} rate {:>10.0f}/s FAIL: {}'.format(nconn, rate, str(e) or type(e).__name__))
+      return False, 0.0
+    point = saturate.measure(result, rate, args.slo_percentile)
+    ok = saturate.passes(point, args.slo_latency, max_error_rate=0)
+    log('  nconn {:>5} rate {:>10.0f}/s served {:>10.0f}/s p{} {:>9.1f}us {}'.format(
+      nconn, rate, point['served'], args.slo_percentile, point['slo'], 'ok' if ok else 'FAIL'))
+    return ok, point['served']
+
+  return saturate.search(attempt, args.start_rate, args.step, args.refine)
+
+
+def calibrate(args, log=print):
+  workdir = tempfile.mkdtemp(prefix='pelikan-calibrate-')
+  points = []
+  try:
+    for vsize in args.vsize:
+      config = server_config(args.engine, workdir, vsize)
+      server = PelikanServer(args.engine, config)
+      try:
+        server.ready()
+        keyspace = loadgen.client_config.keyspace(vsize, SLAB_MEM)
+        log('vsize {}:'.format(vsize))
+        for nconn in args.nconn:
+          if server.server.poll() is not None:  # the next point needs a server
+            log('  server exited (code {}), restarting it'.format(server.server.returncode))
+            server.stop()
+            server = PelikanServer(args.engine, config)
+            server.ready()
+          qps = ceiling(('127.0.0.1', SERVER_PORT), nconn, keyspace, args, log)
+          points.append({'size': KSIZE + vsize, 'vsize': vsize, 'nconn': nconn,
+                         'kqps': qps / 1000.0, 'startup': dict(server.startup)})
+      finally:
+        server.stop()
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+  return {'engine': args.engine,
+          'slo': {'percentile': args.slo_percentile, 'latency_us': args.slo_latency},
+          'duration': args.duration, 'processes': args.processes,
+          'host': socket.gethostname(), 'points': points}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Find the qps ceiling of a local pelikan server under a latency SLO, across
+    value sizes and connection counts, and write a calibration profile for
+    calculator.py --calibration.
+    """)
+  parser.add_argument('--engine', dest='engine', choices=['pelikan_twemcache', 'pelikan_slimcache'], default=ENGINE, help='server binary, from PELIKAN_BIN_PATH or _build/_bin')
+  parser.add_argument('--vsize', dest='vsize', type=int, nargs='+', default=VSIZES, help='value sizes')
+  parser.add_argument('--nconn', dest='nconn', type=int, nargs='+', default=NCONNS, help='connection counts')
+  parser.add_argument('--start_rate', dest='start_rate', type=float, default=START_RATE, help='first rate offered, requests/s')
+  parser.add_argument('--step', dest='step', type=float, default=STEP, help='rate multiplier while the SLO holds')
+  parser.add_argument('--refine', dest='refine', type=int, default=REFINE, help='bisection rounds')
+  parser.add_argument('--duration', dest='duration', type=float, default=DURATION, help='seconds per rate')
+  parser.add_argument('--processes', dest='processes', type=int, default=loadgen.PROCESSES, help='load generating processes')
+  parser.add_argument('--slo_percentile', dest='slo_percentile', type=float, default=SLO_PERCENTILE, help='latency percentile of the SLO')
+  parser.add_argument('--slo_latency', dest='slo_latency', type=float, default=SLO_LATENCY, help='latency bound of the SLO, in us')
+  parser.add_argument('--output', dest='output', type=str, default='calibration.json', help='profile to write')
+
+  args = parser.parse_args()
+
+  profile = calibrate(args)
+  with open(args.output, 'w') as f:
+    json.dump(profile, f, indent=2)
+  print('{:>8} {:>8} {:>10}'.format('size', 'nconn', 'kqps'))
+  for p in profile['points']:
+    print('{:>8} {:>8} {:>10.1f}'.format(p['size'], p['nconn'], p['kqps']))
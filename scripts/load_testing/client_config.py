@@ -15,11 +15,25 @@ PELIKAN_ITEM_OVERHEAD = 48
 KSIZE = 32
 VSIZE = 32
 PELIKAN_SERVER_PORT = 12300
+PELIKAN_ADMIN_PORT = 9900
+DRIVER = 'rpc-perf'
+LOADGEN_DURATION = 120  # matches windows x interval in rpcperf.toml
+STATS_INTERVAL = 1  # in seconds, server stats and client latency timeline
+
+
+def keyspace(vsize, slab_mem):
+  """the [[keyspace]] knobs shared by rpcperf.toml and loadgen.py"""
+  return {
+      'ksize': KSIZE,
+      'nkey': int(ceil(1.0 * slab_mem / (vsize + KSIZE + PELIKAN_ITEM_OVERHEAD))),
+      'commands': [('get', RPCPERF_GET_WEIGHT), ('set', RPCPERF_SET_WEIGHT)],
+      'values': [(vsize, 1)],
+  }
 
 
 def generate_config(rate, connections, vsize, slab_mem, threads):
 # create rpcperf.toml
-  nkey = int(ceil(1.0 * slab_mem / (vsize + KSIZE + PELIKAN_ITEM_OVERHEAD)))
+  nkey = keyspace(vsize, slab_mem)['nkey']
   conn_per_thread = connections / threads
 
   config_str = '''
@@ -63,11 +77,40 @@ def generate_runscript(binary, server_ip, instances):
   os.chmod(fname, 0o777)
 
 
+def generate_loadgen_runscript(server_ip, instances, rate, connections, vsize, slab_mem, threads):
+  # create test.sh driving each port with loadgen.py while statsmon.py polls
+  # every instance, then merge latencies and line them up with server stats
+  script_dir = os.path.dirname(os.path.abspath(__file__))
+  fname = 'test.sh'
+  with open(fname, 'w') as the_file:
+    the_file.write('python3 {statsmon} --server_ip {server_ip} --admin_port {admin_port} --instances {instances}'.format(
+        statsmon=os.path.join(script_dir, 'statsmon.py'), server_ip=server_ip,
+        admin_port=PELIKAN_ADMIN_PORT, instances=instances))
+    the_file.write(' --interval {interval} --duration {duration} --output stats.bin > statsmon.log 2>&1 &\n'.format(
+        interval=STATS_INTERVAL, duration=LOADGEN_DURATION))
+    for i in range(instances):
+      server_port = PELIKAN_SERVER_PORT + i
+      the_file.write('python3 {loadgen} --server_ip {server_ip} --port {server_port} --instances 1'.format(
+          loadgen=os.path.join(script_dir, 'loadgen.py'), server_ip=server_ip, server_port=server_port))
+      the_file.write(' --rate {rate} --connections {connections} --vsize {vsize} --slab_mem {slab_mem}'.format(
+          rate=rate, connections=connections, vsize=vsize, slab_mem=slab_mem))
+      the_file.write(' --processes {threads} --duration {duration} --output . --interval {interval}'.format(
+          threads=threads, duration=LOADGEN_DURATION, interval=STATS_INTERVAL))
+      the_file.write(' > loadgen_{server_port}.log 2>&1 &\n'.format(server_port=server_port))
+    the_file.write('wait\n')
+    the_file.write('python3 {report} --per_port . > latency_report.txt\n'.format(
+        report=os.path.join(script_dir, 'report.py')))
+    the_file.write('python3 {statsmon} --report stats.bin --timeline . > stats_report.txt\n'.format(
+        statsmon=os.path.join(script_dir, 'statsmon.py')))
+  os.chmod(fname, 0o777)
+
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="""
     Generate all the client-side scripts/configs needed for a test run.
     """)
-  parser.add_argument('--binary', dest='binary', type=str, help='location of rpc-perf binary', required=True)
+  parser.add_argument('--binary', dest='binary', type=str, help='location of rpc-perf binary, required by the rpc-perf driver')
+  parser.add_argument('--driver', dest='driver', type=str, default=DRIVER, choices=['rpc-perf', 'loadgen'], help='load generator to run')
   parser.add_argument('--prefix', dest='prefix', type=str, default=PREFIX, help='folder that contains all the other files to be generated')
   parser.add_argument('--instances', dest='instances', type=int, default=INSTANCES, help='number of instances')
   parser.add_argument('--server_ip', dest='server_ip', type=str, help='server ip', required=True)
@@ -78,10 +121,16 @@ if __name__ == "__main__":
   parser.add_argument('--threads', dest='threads', type=int, default=RPCPERF_THREADS, help='number of worker threads per rpc-perf')
 
   args = parser.parse_args()
+  if args.driver == 'rpc-perf' and not args.binary:
+    parser.error('--binary is required by the rpc-perf driver')
 
   if not os.path.exists(args.prefix):
     os.makedirs(args.prefix)
   os.chdir(args.prefix)
 
-  generate_config(args.rate, args.connections, args.vsize, args.slab_mem, args.threads)
-  generate_runscript(args.binary, args.server_ip, args.instances)
+  if args.driver == 'loadgen':
+    generate_loadgen_runscript(args.server_ip, args.instances, args.rate, args.connections,
+        args.vsize, args.slab_mem, args.threads)
+  else:
+    generate_config(args.rate, args.connections, args.vsize, args.slab_mem, args.threads)
+    generate_runscript(args.binary, args.server_ip, args.instances)
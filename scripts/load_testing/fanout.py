@@ -0,0 +1,166 @@
+"""Measure shard imbalance and multiget fan-out across pelikan instances.
+
+loadgen.py and rpc-perf drive every instance on its own, so each sees the
+same, uniform share of the traffic. Production clients instead shard keys
+over the instances with consistent hashing and fan multigets out to all the
+instances holding part of them. This drives instances on consecutive ports
+the same way, through test/integration/sharded.py: a ketama continuum, a pool
+of connections per instance, and one pipelined write per instance per
+multiget.
+
+The key set is warmup.py's: the keys of a klog trace, or --nkey keys read
+following a Zipf distribution. Every key is set once (unless --no_load), then
+--requests multigets of --batch keys each are issued back to back. Reported
+per instance are its share of the hash ring, of the keys requested and of the
+multigets it took part in, its hit ratio and the latency of its part of the
+multigets; overall, the imbalance (busiest instance over the mean) and how
+much the multiget, which waits for its slowest instance, stretches the tail
+over that of a single instance's part.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from sharded import POOL_SIZE, ShardedClient
+
+import client_config
+from histogram import Histogram, PERCENTILES
+import warmup
+
+
+NKEY = 100000
+BATCH = 32  # keys per multiget
+REQUESTS = 10000  # multigets
+LOAD_STEP = 1024  # keys set per round trip while loading
+
+
+def load(client, keys, step=LOAD_STEP):
+  """set every key once, in load order, each to its instance"""
+  stored = errors = 0
+  start = time.monotonic()
+  for pos in range(0, len(keys.load_order), step):
+    groups = {}
+    for i in keys.load_order[pos:pos + step]:
+      groups.setdefault(client.continuum.index(keys.key(i)), []).append(i)
+    conns = [client.connection(idx) for idx in groups]
+    rsps = warmup.round_trip(conns, [[keys.set_request(i) for i in ids] for ids in groups.values()])
+    for rs in rsps:
+      for rsp in rs:
+        if rsp[0] == b'STORED':
+          stored += 1
+        else:
+          errors += 1
+  return {'stored': stored, 'errors': errors, 'elapsed': time.monotonic() - start}
+
+
+def fan_out(client, keys, requests=REQUESTS, batch=BATCH):
+  """issue multigets of batch keys drawn from the key distribution; returns
+     per instance and overall counts and latency histograms (ns)
+  """
+  nserver = len(client.continuum.servers)
+  shards = [{'keys': 0, 'requests': 0, 'hits': 0, 'latency': Histogram()} for _ in range(nserver)]
+  multiget = Histogram()
+  touched = 0
+  start = time.monotonic()
+  for _ in range(requests):
+    # a client asks for a key once, however many times it is wanted
+    names = list(dict.fromkeys(keys.key(int(i)) for i in keys.draw(batch)))
+    timings = {}
+    t0 = time.monotonic()
+    values = client.get_multi(names, timings)
+    multiget.record(int((time.monotonic() - t0) * 1e9))
+    touched += len(timings)
+    for idx, group in client.group(names).items():
+      s = shards[idx]
+      s['keys'] += len(group)
+      s['requests'] += 1
+      s['hits'] += sum(1 for key in group if key in values)
+      s['latency'].record(int(timings[idx] * 1e9))
+  return {'shards': shards, 'multiget': multiget, 'requests': requests,
+          'fan_out': 1.0 * touched / max(1, requests), 'elapsed': time.monotonic() - start}
+
+
+def imbalance(counts):
+  """busiest over mean, 1.0 when perfectly even"""
+  mean = 1.0 * sum(counts) / len(counts)
+  return max(counts) / mean if mean else 0.0
+
+
+def format_results(client, result):
+  shards = result['shards']
+  nkey = sum(s['keys'] for s in shards)
+  lines = ['{:<22} {:>7} {:>7} {:>8} {:>9} {:>10} {:>10}'.format(
+    'instance', 'ring', 'keys', 'mgets', 'hit', 'p50 us', 'p99 us')]
+  for server, share, s in zip(client.continuum.servers, client.continuum.shares(), shards):
+    lines.append('{:<22} {:>7.3f} {:>7.3f} {:>8.3f} {:>9.4f} {:>10.1f} {:>10.1f}'.format(
+      '{}:{}'.format(*server), share, 1.0 * s['keys'] / max(1, nkey),
+      1.0 * s['requests'] / max(1, result['requests']), 1.0 * s['hits'] / max(1, s['keys']),
+      s['latency'].percentile(50) / 1000.0, s['latency'].percentile(99) / 1000.0))
+  lines.append('imbalance (max/mean)  ring: {:.3f} keys: {:.3f}'.format(
+    imbalance(client.continuum.shares()), imbalance([s['keys'] for s in shards])))
+  lines.append('{} multigets in {:.1f}s, {:.2f} instances each'.format(
+    result['requests'], result['elapsed'], result['fan_out']))
+  part = Histogram()
+  for s in shards:
+    part.merge(s['latency'])
+  for name, h in [('multiget', result['multiget']), ('instance', part)]:
+    lines.append('{:<8} latency (us) '.format(name) + ' '.join(
+      'p{}: {:.1f}'.format(p, h.percentile(p) / 1000.0) for p in PERCENTILES))
+  lines.append('tail amplification   ' + ' '.join(
+    'p{}: {:.2f}'.format(p, 1.0 * result['multiget'].percentile(p) / max(1, part.percentile(p)))
+    for p in PERCENTILES))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Shard a key set over pelikan instances on consecutive ports with ketama
+    consistent hashing, issue multigets fanned out to the instances holding
+    their keys, and report per-instance imbalance and the multiget tail.
+    """)
+  parser.add_argument('--server_ip', dest='server_ip', type=str, default='127.0.0.1', help='server ip')
+  parser.add_argument('--port', dest='port', type=int, default=client_config.PELIKAN_SERVER_PORT, help='port of the first instance')
+  parser.add_argument('--instances', dest='instances', type=int, default=client_config.INSTANCES, help='number of instances')
+  parser.add_argument('--weights', dest='weights', type=float, nargs='+', default=None, help='ketama weight of each instance, equal by default')
+  parser.add_argument('--pool', dest='pool', type=int, default=POOL_SIZE, help='connections per instance')
+  parser.add_argument('--klog', dest='klog', nargs='*', default=[], help='klog files to take keys and sizes from, oldest first')
+  parser.add_argument('--nkey', dest='nkey', type=int, default=NKEY, help='keys without --klog')
+  parser.add_argument('--alpha', dest='alpha', type=float, default=warmup.ALPHA, help='Zipf exponent of the gets without --klog')
+  parser.add_argument('--vsize', dest='vsize', type=str, default=warmup.VSIZE_DIST, help='value sizes without --klog, lognormal:MEDIAN:SIGMA or SIZE:WEIGHT,...')
+  parser.add_argument('--batch', dest='batch', type=int, default=BATCH, help='keys drawn per multiget (repeats are asked for once)')
+  parser.add_argument('--requests', dest='requests', type=int, default=REQUESTS, help='number of multigets')
+  parser.add_argument('--no_load', dest='no_load', action='store_true', help='do not set the keys first, e.g. after warmup.py')
+  parser.add_argument('--seed', dest='seed', type=int, default=warmup.SEED, help='random seed')
+  parser.add_argument('--output', dest='output', type=str, default=None, help='also write per-instance counts and latency histograms as JSON')
+
+  args = parser.parse_args()
+
+  spec = {'klog': args.klog, 'nkey': args.nkey, 'alpha': args.alpha, 'vsize': args.vsize,
+          'ksize': client_config.KSIZE, 'seed': args.seed}
+  keys = warmup.key_set(spec)
+  endpoints = [(args.server_ip, args.port + i) for i in range(args.instances)]
+  client = ShardedClient(endpoints, args.weights, args.pool, request_timeout=warmup.REQUEST_TIMEOUT)
+  try:
+    if not args.no_load:
+      loaded = load(client, keys)
+      print('loaded {} keys in {:.1f}s, {} errors'.format(loaded['stored'], loaded['elapsed'],
+                                                          loaded['errors']))
+    result = fan_out(client, keys, args.requests, args.batch)
+  finally:
+    client.close()
+  print(format_results(client, result))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({
+        'instances': ['{}:{}'.format(*e) for e in endpoints], 'ring': client.continuum.shares(),
+        'requests': result['requests'], 'fan_out': result['fan_out'],
+        'multiget': result['multiget'].to_dict(),
+        'shards': [dict(s, latency=s['latency'].to_dict()) for s in result['shards']]}, f, indent=2)
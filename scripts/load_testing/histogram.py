@@ -0,0 +1,146 @@
+"""Compact log-linear latency histogram, in the spirit of HdrHistogram.
+
+Values (nanoseconds by convention) are bucketed with a fixed number of
+significant bits: every power-of-two range is split into 2^(SUB_BITS-1)
+equal-width buckets, so the relative error is bounded by 2^-(SUB_BITS-1)
+regardless of magnitude. Counts live in a flat array('Q'), which makes
+histograms cheap to pickle across processes and exact to merge: adding two
+histograms bucket by bucket is the same as recording both sample sets into one.
+"""
+
+from __future__ import print_function
+from array import array
+import json
+
+
+SUB_BITS = 8  # significant bits kept, relative error < 2^-(SUB_BITS-1) (0.8%)
+MAX_BITS = 40  # values are clamped to 2^40-1 (~18 minutes in nanoseconds)
+PERCENTILES = [50, 99, 99.9, 99.99]
+
+
+class Histogram(object):
+
+  def __init__(self, sub_bits=SUB_BITS, max_bits=MAX_BITS):
+    if sub_bits < 1 or max_bits < sub_bits:
+      raise ValueError('invalid histogram precision {}/{}'.format(sub_bits, max_bits))
+    self.sub_bits = sub_bits
+    self.max_bits = max_bits
+    self.half = 1 << (sub_bits - 1)
+    self.max_value = (1 << max_bits) - 1
+    self.counts = array('Q', [0]) * self.index(self.max_value) + array('Q', [0])
+    self.total = 0
+    self.min = None
+    self.max = None
+
+
+  def index(self, value):
+    """bucket index of a (non-negative integer) value"""
+    shift = max(0, value.bit_length() - self.sub_bits)
+    return shift * self.half + (value >> shift)
+
+
+  def bucket_range(self, idx):
+    """[low, high] values covered by bucket idx"""
+    if idx < 2 * self.half:
+      shift, sub = 0, idx
+    else:
+      shift = idx // self.half - 1
+      sub = idx - shift * self.half
+    return sub << shift, ((sub + 1) << shift) - 1
+
+
+  def record(self, value, count=1):
+    value = min(max(0, int(value)), self.max_value)
+    self.counts[self.index(value)] += count
+    self.total += count
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+
+  def merge(self, other):
+    """add other's samples into this histogram (exact)"""
+    if (other.sub_bits, other.max_bits) != (self.sub_bits, self.max_bits):
+      raise ValueError('cannot merge histograms of different precision')
+    if other.total == 0:
+      return self
+    counts = self.counts
+    for idx, count in enumerate(other.counts):
+      if count:
+        counts[idx] += count
+    self.total += other.total
+    self.min = other.min if self.min is None else min(self.min, other.min)
+    self.max = other.max if self.max is None else max(self.max, other.max)
+    return self
+
+
+  def percentile(self, p):
+    """value at percentile p (0-100), reported as the bucket's upper bound"""
+    if self.total == 0:
+      return 0
+    rank = max(1, int(-(-self.total * p // 100)))  # ceil without float error
+    seen = 0
+    for idx, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return min(self.bucket_range(idx)[1], self.max)
+    return self.max
+
+
+  def mean(self):
+    if self.total == 0:
+      return 0.0
+    acc = 0
+    for idx, count in enumerate(self.counts):
+      if count:
+        low, high = self.bucket_range(idx)
+        acc += count * (low + high) / 2.0
+    return acc / self.total
+
+
+  def to_dict(self):
+    """sparse, JSON-friendly representation"""
+    return {'sub_bits': self.sub_bits, 'max_bits': self.max_bits,
+            'min': self.min, 'max': self.max,
+            'counts': [[idx, count] for idx, count in enumerate(self.counts) if count]}
+
+
+  @staticmethod
+  def from_dict(d):
+    h = Histogram(d['sub_bits'], d['max_bits'])
+    for idx, count in d['counts']:
+      h.counts[idx] = count
+      h.total += count
+    h.min = d['min']
+    h.max = d['max']
+    return h
+
+
+def dump(hists, fname):
+  """write a (possibly nested) dict of histograms to a JSON file"""
+  def encode(obj):
+    if isinstance(obj, Histogram):
+      return {'histogram': obj.to_dict()}
+    return dict((str(k), encode(v)) for k, v in obj.items())
+  with open(fname, 'w') as f:
+    json.dump(encode(hists), f)
+
+
+def load(fname):
+  """read back what dump() wrote"""
+  def decode(obj):
+    if 'histogram' in obj:
+      return Histogram.from_dict(obj['histogram'])
+    return dict((k, decode(v)) for k, v in obj.items())
+  with open(fname) as f:
+    return decode(json.load(f))
+
+
+def merge_all(hists):
+  """merge a sequence of histograms into a new one"""
+  hists = list(hists)
+  if not hists:
+    return Histogram()
+  out = Histogram(hists[0].sub_bits, hists[0].max_bits)
+  for h in hists:
+    out.merge(h)
+  return out
@@ -0,0 +1,435 @@
+"""asyncio load driver for pelikan memcache servers (twemcache/segcache/slimcache).
+
+A dependency-free alternative to rpc-perf: each event loop opens many
+connections and drives them open-loop, i.e. requests are issued on a fixed
+schedule whether or not earlier ones have been answered. Requests due at the
+same tick are pipelined into a single write, and responses are framed with
+the same logic as the integration DataClient. Optionally one loop runs per
+process to use more than one core.
+
+Latency is recorded per port and command into mergeable histograms, both as
+service time (from when the request was written) and corrected for coordinated
+omission (from when the schedule intended it to be written). Use --output to
+keep them for report.py. With --interval, corrected latency is also recorded
+per port and wall-clock interval, and server stats are collected alongside
+by statsmon.py, so the two can be lined up.
+
+The keyspace mirrors what client_config.py writes into rpcperf.toml.
+"""
+
+from __future__ import print_function
+import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from client import AdminClient, DataClient
+from codec import encode_requests, frame_memcache as frame_response
+
+import client_config
+from histogram import Histogram, PERCENTILES
+import histogram
+
+
+DURATION = 60  # in seconds
+PROCESSES = 1
+MAX_INFLIGHT = 1024  # per connection, bounds memory if the server falls behind
+# slimcache_process_read() returns its request after the first one in a read
+# and crashes parsing the next, so slimcache gets one request at a time
+ENGINE_MAX_INFLIGHT = {'slimcache': 1}
+PIPELINE_DEPTH = 16  # per connection, outstanding requests when rate is unlimited
+DRAIN_TIMEOUT = 5.0  # in seconds, wait for outstanding responses at the end
+CONNECT_TIMEOUT = 5.0
+UNSOLICITED = 'unsolicited'  # stats of responses with no request outstanding
+
+
+class Workload(object):
+  """generate requests following a [[keyspace]] description"""
+
+  def __init__(self, ksize, nkey, commands, values, seed=None):
+    self.ksize = ksize
+    self.nkey = nkey
+    self.rng = random.Random(seed)
+    self.cmds, self.cmd_cdf = Workload._cdf(commands)
+    vsizes, self.val_cdf = Workload._cdf(values)
+    self.vals = [b'x' * v for v in vsizes]
+
+
+  @staticmethod
+  def _cdf(weighted):
+    """turn [(choice, weight), ...] into choices and a cumulative distribution"""
+    choices, cdf, total = [], [], 0
+    for choice, weight in weighted:
+      if weight <= 0:
+        continue
+      total += weight
+      choices.append(choice)
+      cdf.append(total)
+    if not choices:
+      raise ValueError('at least one entry must have a positive weight')
+    return choices, [1.0 * c / total for c in cdf]
+
+
+  @staticmethod
+  def from_keyspace(ks, seed=None):
+    return Workload(ks['ksize'], ks['nkey'], ks['commands'], ks['values'], seed)
+
+
+  def _pick(self, choices, cdf):
+    return choices[min(bisect.bisect_right(cdf, self.rng.random()), len(choices) - 1)]
+
+
+  def key(self):
+    return '{:0{w}d}'.format(self.rng.randrange(self.nkey), w=self.ksize).encode()
+
+
+  def next(self):
+    """return (command, request lines) for the next request"""
+    cmd = self._pick(self.cmds, self.cmd_cdf)
+    key = self.key()
+    if cmd == 'get':
+      return cmd, [b'get ' + key]
+    if cmd == 'set':
+      val = self._pick(self.vals, self.val_cdf)
+      return cmd, [b'set ' + key + b' 0 0 ' + str(len(val)).encode(), val]
+    if cmd == 'delete':
+      return cmd, [b'delete ' + key]
+    raise ValueError('unsupported command {}'.format(cmd))
+
+
+def new_stats(cmds):
+  return dict((cmd, {'request': 0, 'response': 0, 'hit': 0, 'miss': 0, 'error': 0})
+              for cmd in cmds)
+
+
+def new_latency(cmds):
+  return dict((cmd, {'corrected': Histogram(), 'service': Histogram()}) for cmd in cmds)
+
+
+def record(stats, latency, cmd, rsp, corrected, service, interval_hist=None):
+  """classify a framed response and account for it, latencies in ns"""
+  s = stats[cmd]
+  s['response'] += 1
+  latency[cmd]['corrected'].record(corrected)
+  latency[cmd]['service'].record(service)
+  if interval_hist is not None:
+    interval_hist.record(corrected)
+  first = rsp[0]
+  if first.startswith(DataClient.RETRIEVAL):
+    s['hit'] += 1
+  elif first == DataClient.RETRIEVAL_END or first == b'NOT_FOUND':
+    s['miss'] += 1
+  elif first.endswith(b'ERROR') or first.startswith(b'CLIENT_ERROR') or \
+      first.startswith(b'SERVER_ERROR'):
+    s['error'] += 1
+
+
+class LoadProtocol(asyncio.BufferedProtocol):
+  """receive side of a load connection: recv_into a reused buffer and frame"""
+
+  def __init__(self, stats, latency, timeline=None, interval=0):
+    self.stats = stats
+    self.latency = latency
+    self.timeline = timeline  # {wall-clock interval index: Histogram}, or None
+    self.interval = interval
+    self.pending = collections.deque()  # (cmd, intended, actual send time), FIFO
+    self.rbuf = bytearray(DataClient.RBUF_SIZE)
+    self.rpos = 0
+    self.rend = 0
+    self.need = 1  # bytes needed past rpos before framing can make progress
+    self.room = asyncio.Event()
+    self.room.set()
+    self.drained = asyncio.Event()
+    self.lost = False
+
+
+  def get_buffer(self, sizehint):
+    if self.rpos == self.rend:
+      self.rpos = self.rend = 0
+    if self.rend == len(self.rbuf) or self.rpos + self.need > len(self.rbuf):
+      size = self.rend - self.rpos
+      self.rbuf[:size] = bytes(self.rbuf[self.rpos:self.rend])
+      self.rpos, self.rend = 0, size
+      if self.need > len(self.rbuf) or size == len(self.rbuf):
+        self.rbuf.extend(bytearray(max(self.need, len(self.rbuf))))
+    return memoryview(self.rbuf)[self.rend:]
+
+
+  def buffer_updated(self, nbytes):
+    self.rend += nbytes
+    now = time.monotonic_ns()
+    hist = None
+    if self.timeline is not None:
+      bucket = int(time.time() // self.interval)
+      hist = self.timeline.get(bucket)
+      if hist is None:
+        hist = self.timeline[bucket] = Histogram()
+    while self.rend > self.rpos:
+      rsp, pos = frame_response(self.rbuf, self.rpos, self.rend)
+      if rsp is None:
+        self.need = pos - self.rpos
+        break
+      self.rpos = pos
+      self.need = 1
+      if not self.pending:  # e.g. an ERROR after the server misparsed a request
+        s = self.stats.setdefault(UNSOLICITED, new_stats([UNSOLICITED])[UNSOLICITED])
+        s['response'] += 1
+        s['error'] += 1
+        continue
+      cmd, intended, sent = self.pending.popleft()
+      record(self.stats, self.latency, cmd, rsp, now - intended, now - sent, hist)
+    self.room.set()
+    if not self.pending:
+      self.drained.set()
+
+
+  def connection_lost(self, exc):
+    self.lost = True
+    self.room.set()
+    self.drained.set()
+
+
+async def drive(endpoint, workload, rate, duration, stats, latency, timeline=None, interval=0,
+                max_inflight=MAX_INFLIGHT):
+  """run one connection open-loop at rate (req/s, 0 for as fast as possible),
+     with at most max_inflight requests outstanding
+  """
+  loop = asyncio.get_running_loop()
+  transport, proto = await asyncio.wait_for(
+    loop.create_connection(lambda: LoadProtocol(stats, latency, timeline, interval), *endpoint),
+    CONNECT_TIMEOUT)
+  wbuf = bytearray(DataClient.WBUF_SIZE)
+  start = time.monotonic_ns()
+  duration = int(duration * 1e9)
+  sent = 0
+  limit = min(max_inflight, MAX_INFLIGHT if rate > 0 else PIPELINE_DEPTH)
+  while not proto.lost:
+    now = time.monotonic_ns()
+    if now - start >= duration:
+      break
+    room = limit - len(proto.pending)
+    due = int((now - start) * rate / 1e9) + 1 - sent if rate > 0 else room
+    nreq = min(due, room)
+    if nreq > 0:
+      reqs = []
+      for i in range(nreq):
+        cmd, req = workload.next()
+        # the schedule, not the actual send time, is what a user would see
+        intended = start + int((sent + i) * 1e9 / rate) if rate > 0 else now
+        proto.pending.append((cmd, intended, now))
+        stats[cmd]['request'] += 1
+        reqs.append(req)
+      wbuf, n = encode_requests(reqs, wbuf)
+      proto.drained.clear()
+      transport.write(wbuf[:n])
+      sent += nreq
+    if rate > 0 and len(proto.pending) < limit:
+      await asyncio.sleep(max(0.0, (start + sent * 1e9 / rate - time.monotonic_ns()) / 1e9))
+    else:  # wait for responses to make room
+      proto.room.clear()
+      await proto.room.wait()
+  if proto.pending and not proto.lost:
+    try:
+      await asyncio.wait_for(proto.drained.wait(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+      pass
+  transport.close()
+
+
+async def run_loop(endpoints, nconn, rate, duration, keyspace, seed, interval=0,
+                   max_inflight=MAX_INFLIGHT):
+  """drive nconn connections spread round-robin over endpoints from one loop"""
+  cmds = [cmd for cmd, _ in keyspace['commands']]
+  stats = new_stats(cmds)
+  latency = dict((port, new_latency(cmds)) for _, port in endpoints)
+  timeline = dict((port, {}) for _, port in endpoints)
+  rng = random.Random(seed)
+  tasks = []
+  for i in range(nconn):
+    endpoint = endpoints[i % len(endpoints)]
+    workload = Workload.from_keyspace(keyspace, rng.getrandbits(64))
+    tasks.append(drive(endpoint, workload, 1.0 * rate / nconn, duration, stats,
+                       latency[endpoint[1]], timeline[endpoint[1]] if interval > 0 else None,
+                       interval, max_inflight))
+  start = time.monotonic()
+  await asyncio.gather(*tasks)
+  return {'stats': stats, 'latency': latency, 'timeline': timeline,
+          'elapsed': time.monotonic() - start}
+
+
+def run_process(endpoints, nconn, rate, duration, keyspace, seed, interval=0,
+                max_inflight=MAX_INFLIGHT):
+  """entry point for one worker process: one event loop"""
+  return asyncio.run(run_loop(endpoints, nconn, rate, duration, keyspace, seed, interval,
+                              max_inflight))
+
+
+def merge(results):
+  """combine per-process results into one"""
+  stats = {}
+  latency = {}
+  timeline = {}
+  for result in results:
+    for cmd, s in result['stats'].items():
+      total = stats.setdefault(cmd, dict.fromkeys(s, 0))
+      for k, v in s.items():
+        total[k] += v
+    for port, per_cmd in result['latency'].items():
+      for cmd, hists in per_cmd.items():
+        total = latency.setdefault(port, {}).setdefault(cmd, {})
+        for kind, h in hists.items():
+          if kind in total:
+            total[kind].merge(h)
+          else:
+            total[kind] = h
+    for port, per_bucket in result['timeline'].items():
+      total = timeline.setdefault(port, {})
+      for bucket, h in per_bucket.items():
+        if bucket in total:
+          total[bucket].merge(h)
+        else:
+          total[bucket] = h
+  return {'stats': stats, 'latency': latency, 'timeline': timeline,
+          'elapsed': max(r['elapsed'] for r in results)}
+
+
+def run(endpoints, connections, rate, duration, keyspace, processes=PROCESSES, seed=0,
+        interval=0, max_inflight=MAX_INFLIGHT):
+  """run the load, splitting connections and rate evenly across processes;
+     with interval > 0, corrected latency is also kept per wall-clock interval.
+     Each connection has at most max_inflight requests outstanding (see
+     ENGINE_MAX_INFLIGHT)
+  """
+  processes = max(1, min(processes, connections))
+  shares = [(connections * (p + 1) // processes - connections * p // processes)
+            for p in range(processes)]
+  if processes == 1:
+    return merge([run_process(endpoints, connections, rate, duration, keyspace, seed, interval,
+                              max_inflight)])
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+    futures = [pool.submit(run_process, endpoints, share, 1.0 * rate * share / connections,
+                           duration, keyspace, seed + p, interval, max_inflight)
+               for p, share in enumerate(shares)]
+    return merge([f.result() for f in futures])
+
+
+def engine_max_inflight(engine):
+  """outstanding requests per connection an engine (slimcache or
+     pelikan_slimcache, say) can take
+  """
+  return ENGINE_MAX_INFLIGHT.get(engine.replace('pelikan_', ''), MAX_INFLIGHT)
+
+
+def admin_snapshot(admin_endpoints):
+  """stats from every instance, or None for instances that can't be reached"""
+  snapshots = []
+  for endpoint in admin_endpoints:
+    try:
+      admin = AdminClient(endpoint)
+      snapshots.append(admin.stats())
+      admin.close()
+    except Exception:
+      snapshots.append(None)
+  return snapshots
+
+
+def format_result(result, before=None, after=None):
+  lines = []
+  elapsed = result['elapsed']
+  for cmd, s in sorted(result['stats'].items()):
+    if s['request'] == 0:
+      continue
+    lines.append('{:<8} request: {:<10} response: {:<10} rate: {:>10.1f}/s '
+                 'hit: {:<10} miss: {:<10} error: {:<6}'
+                 .format(cmd, s['request'], s['response'], s['response'] / elapsed,
+                         s['hit'], s['miss'], s['error']))
+    for kind in ['corrected', 'service']:
+      h = histogram.merge_all(per_cmd[cmd][kind] for per_cmd in result['latency'].values())
+      lines.append('{:<8} {:<9} latency (us) '.format('', kind) + ' '.join(
+        'p{}: {:.1f}'.format(p, h.percentile(p) / 1000.0) for p in PERCENTILES))
+  extra = result['stats'].get(UNSOLICITED)
+  if extra:
+    lines.append('{:<8} response: {:<10} counted as errors'.format(UNSOLICITED, extra['response']))
+  total = sum(s['response'] for s in result['stats'].values())
+  lines.append('total    {:.1f} responses/s over {:.1f}s'.format(total / elapsed, elapsed))
+  if before and after:
+    for metric in ['get_key_hit', 'get_key_miss', 'item_evict', 'slab_evict', 'seg_evict']:
+      deltas = [int(a[metric]) - int(b[metric]) for b, a in zip(before, after)
+                if a and b and metric in a and metric in b]
+      if deltas:
+        lines.append('server   {:<16} {}'.format(metric, sum(deltas)))
+  return '\n'.join(lines)
+
+
+def parse_endpoints(server_ip, port, instances):
+  return [(server_ip, port + i) for i in range(instances)]
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Drive memcache load against one or more pelikan instances on consecutive
+    ports, using the same knobs as client_config.py.
+    """)
+  parser.add_argument('--server_ip', dest='server_ip', type=str, default='127.0.0.1', help='server ip')
+  parser.add_argument('--port', dest='port', type=int, default=client_config.PELIKAN_SERVER_PORT, help='port of the first instance')
+  parser.add_argument('--instances', dest='instances', type=int, default=client_config.INSTANCES, help='number of instances')
+  parser.add_argument('--rate', dest='rate', type=int, default=client_config.RPCPERF_RATE, help='request rate per instance, 0 for unlimited')
+  parser.add_argument('--connections', dest='connections', type=int, default=client_config.RPCPERF_CONNS, help='number of connections per instance')
+  parser.add_argument('--vsize', dest='vsize', type=int, default=client_config.VSIZE, help='value size')
+  parser.add_argument('--slab_mem', dest='slab_mem', type=int, default=client_config.PELIKAN_SLAB_MEM, help='slab memory, determines key count')
+  parser.add_argument('--get_weight', dest='get_weight', type=int, default=client_config.RPCPERF_GET_WEIGHT, help='relative weight of get')
+  parser.add_argument('--set_weight', dest='set_weight', type=int, default=client_config.RPCPERF_SET_WEIGHT, help='relative weight of set')
+  parser.add_argument('--keyspace', dest='keyspace', type=str, default=None, help='keyspace json (e.g. from klog/analyze.py), overrides the size/weight options')
+  parser.add_argument('--duration', dest='duration', type=float, default=DURATION, help='test duration in seconds')
+  parser.add_argument('--processes', dest='processes', type=int, default=PROCESSES, help='number of event loops, one per process (0 for one per core)')
+  parser.add_argument('--admin_port', dest='admin_port', type=int, default=0, help='admin port of the first instance, to report server-side stats')
+  parser.add_argument('--output', dest='output', type=str, default=None, help='folder to write latency_<port>.json histograms into, for report.py')
+  parser.add_argument('--max_inflight', dest='max_inflight', type=int, default=MAX_INFLIGHT, help='outstanding requests per connection, 1 for slimcache')
+  parser.add_argument('--interval', dest='interval', type=float, default=0, help='also write timeline_<port>.json latency per this many seconds into --output, and with --admin_port collect server stats into stats.bin')
+
+  args = parser.parse_args()
+
+  if args.keyspace:
+    with open(args.keyspace) as f:
+      keyspace = json.load(f)
+  else:
+    keyspace = client_config.keyspace(args.vsize, args.slab_mem)
+    keyspace['commands'] = [('get', args.get_weight), ('set', args.set_weight)]
+  endpoints = parse_endpoints(args.server_ip, args.port, args.instances)
+  admin_endpoints = parse_endpoints(args.server_ip, args.admin_port, args.instances) \
+    if args.admin_port else []
+  processes = args.processes or os.cpu_count() or 1
+  if args.output and not os.path.exists(args.output):
+    os.makedirs(args.output)
+  interval = args.interval if args.output else 0
+
+  collector = None
+  if interval > 0 and admin_endpoints:  # in its own process, off the load loop
+    import statsmon  # needs numpy, which the load itself doesn't
+    collector = multiprocessing.Process(target=statsmon.run_collector, args=(
+      admin_endpoints, interval, args.duration, os.path.join(args.output, 'stats.bin')))
+    collector.start()
+  before = admin_snapshot(admin_endpoints)
+  result = run(endpoints, args.connections * args.instances, args.rate * args.instances,
+               args.duration, keyspace, processes, interval=interval,
+               max_inflight=args.max_inflight)
+  after = admin_snapshot(admin_endpoints)
+  if collector:
+    collector.join()
+  print(format_result(result, before, after))
+  if args.output:
+    for port, per_cmd in result['latency'].items():
+      histogram.dump(per_cmd, os.path.join(args.output, 'latency_{}.json'.format(port)))
+    if interval > 0:
+      for port, per_bucket in result['timeline'].items():
+        histogram.dump({port: per_bucket},
+                       os.path.join(args.output, 'timeline_{}.json'.format(port)))
@@ -0,0 +1,139 @@
+"""Run a load test on this host, without ssh.
+
+Takes the folders server_config.py and client_config.py generated, starts
+every instance configured under <server>/config/ in the foreground (a copy of
+each config with `daemonize: no` goes to <server>/local/), placed with the same
+numactl options bring-up.sh uses, waits until all of them answer on their admin
+port, runs the client folder's test.sh pinned to the CPUs no instance is bound
+to, then stops and reaps exactly the instances it started, whatever the
+engine.
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from server import PelikanServer
+
+import server_config
+from topology import parse_cpulist
+
+
+re_config = re.compile(r'(\w+)-(\d+)\.config$')
+
+
+def server_cpus(numactl):
+  """cpus a placement from server_config.numactl_args() confines to"""
+  cpus = set()
+  for arg in numactl:
+    name, _, value = arg.partition('=')
+    if name == '--physcpubind':
+      cpus |= parse_cpulist(value)
+  return cpus
+
+
+def local_config(prefix, fname):
+  """copy of a generated config that keeps the server in the foreground"""
+  dest = os.path.join(prefix, 'local', os.path.basename(fname))
+  if not os.path.exists(os.path.dirname(dest)):
+    os.makedirs(os.path.dirname(dest))
+  with open(fname) as f:
+    lines = [line for line in f if not line.startswith('daemonize:')]
+  with open(dest, 'w') as f:
+    f.write('daemonize: no\n')
+    f.writelines(lines)
+  return dest
+
+
+def start_servers(prefix, binary, pmem_paths=(), numactl='numactl', log=print):
+  """start every instance configured in prefix, returns [(PelikanServer, cpus)]"""
+  fnames = sorted(glob.glob(os.path.join(prefix, 'config', '*.config')),
+                  key=lambda f: int(re_config.search(f).group(2)))
+  if not fnames:
+    raise Exception('no configs under {}/config'.format(prefix))
+  os.environ['PELIKAN_BIN_PATH'] = os.path.dirname(os.path.abspath(binary))
+  executable = os.path.basename(binary)
+  wrapper = numactl.split()
+  if not shutil.which(wrapper[-1]):
+    log('{} not found, instances are not pinned'.format(wrapper[-1]))
+    wrapper = None
+  placement = server_config.numactl_args(len(fnames), list(pmem_paths)) if wrapper else []
+  servers = []
+  try:
+    for i, fname in enumerate(fnames):
+      args = placement[i] if placement else []
+      server = PelikanServer(executable, local_config(prefix, fname), wrapper + args if args else None,
+                             cwd=prefix)
+      servers.append((server, server_cpus(args)))
+    for server, _ in servers:
+      server.ready()
+      log('{} ready in {:.2f}s'.format(os.path.basename(server.config), server.startup['listen']))
+  except BaseException:
+    stop_servers(servers, log)
+    raise
+  return servers
+
+
+def stop_servers(servers, log=print):
+  for server, _ in reversed(servers):
+    code = server.stop()
+    if code not in (0, -15):  # -15: exited on our SIGTERM
+      log('{} exited with {}'.format(os.path.basename(server.config), code))
+
+
+def client_cpus(servers):
+  """cpus this process may use that no instance is bound to, None if unpinned"""
+  taken = set().union(*[cpus for _, cpus in servers]) if servers else set()
+  if not taken:
+    return None
+  free = os.sched_getaffinity(0) - taken
+  return free or None
+
+
+def run_clients(client, cpus, log=print):
+  """run test.sh in the client folder and wait for everything it started"""
+  if cpus is None:
+    log('clients are not pinned')
+    preexec = None
+  else:
+    log('clients pinned to cpus {}'.format(','.join(str(c) for c in sorted(cpus))))
+    preexec = lambda: os.sched_setaffinity(0, cpus)
+  # sourced, so `wait` covers the clients test.sh puts in the background
+  return subprocess.call(['bash', '-c', 'source ./test.sh; wait'], cwd=client, preexec_fn=preexec)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Run a load test entirely on this host: start the instances configured by
+    server_config.py, run the client test.sh generated by client_config.py
+    on the remaining cpus, and tear the instances down.
+    """)
+  parser.add_argument('--binary', dest='binary', type=str, help='location of the pelikan_twemcache|pelikan_slimcache binary', required=True)
+  parser.add_argument('--server_config', dest='server_config', type=str, help='folder generated by server_config.py', required=True)
+  parser.add_argument('--client_config', dest='client_config', type=str, help='folder generated by client_config.py', required=True)
+  parser.add_argument('--pmem_paths', dest='pmem_paths', nargs='*', default=[], help='pmem mount points the configs were generated with')
+  parser.add_argument('--bind', dest='bind', choices=['nodes', 'cores', 'none'], default=None, help='override BIND_TO_NODES/BIND_TO_CORES of server_config.py')
+  parser.add_argument('--numactl', dest='numactl', type=str, default='numactl', help='numactl command, e.g. "sudo numactl"')
+
+  args = parser.parse_args()
+
+  if args.bind:
+    server_config.BIND_TO_NODES = args.bind == 'nodes'
+    server_config.BIND_TO_CORES = args.bind == 'cores'
+  start = time.time()
+  servers = start_servers(os.path.abspath(args.server_config), args.binary, args.pmem_paths,
+                          args.numactl)
+  try:
+    code = run_clients(os.path.abspath(args.client_config), client_cpus(servers))
+  finally:
+    stop_servers(servers)
+  print('done in {:.1f}s'.format(time.time() - start))
+  sys.exit(code)
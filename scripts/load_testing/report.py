@@ -0,0 +1,88 @@
+"""Merge latency histograms written by loadgen.py and report tail latency.
+
+Each input file holds the histograms of one port (as written by
+`loadgen.py --output`). Merging is exact, so the cluster-wide percentiles are
+the same as if every request had been recorded into a single histogram.
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import os
+import re
+
+import histogram
+from histogram import PERCENTILES
+
+re_port = re.compile(r'latency_(\d+)\.json$')
+
+
+def load_all(fnames):
+  """returns {source: {cmd: {kind: Histogram}}}, source being port or file name"""
+  data = {}
+  for fname in fnames:
+    m = re_port.search(fname)
+    source = m.group(1) if m else fname
+    per_cmd = histogram.load(fname)
+    if source in data:  # e.g. the same port driven from several hosts
+      for cmd, hists in per_cmd.items():
+        for kind, h in hists.items():
+          data[source].setdefault(cmd, {}).setdefault(kind, histogram.Histogram()).merge(h)
+    else:
+      data[source] = per_cmd
+  return data
+
+
+def merge_sources(data):
+  """collapse all sources into {cmd: {kind: Histogram}}"""
+  merged = {}
+  for per_cmd in data.values():
+    for cmd, hists in per_cmd.items():
+      for kind, h in hists.items():
+        merged.setdefault(cmd, {}).setdefault(kind, histogram.Histogram()).merge(h)
+  return merged
+
+
+def format_row(name, kind, h):
+  return '{:<12} {:<10} {:>10} '.format(name, kind, h.total) + ' '.join(
+    '{:>10.1f}'.format(h.percentile(p) / 1000.0) for p in PERCENTILES) + \
+    ' {:>10.1f}'.format((h.max or 0) / 1000.0)
+
+
+def format_report(data, per_source=False):
+  header = '{:<12} {:<10} {:>10} '.format('command', 'latency', 'count') + ' '.join(
+    '{:>10}'.format('p{}'.format(p)) for p in PERCENTILES) + ' {:>10}'.format('max')
+  lines = ['all latencies in microseconds', header]
+  if per_source:
+    for source in sorted(data):
+      for cmd, hists in sorted(data[source].items()):
+        for kind, h in sorted(hists.items()):
+          lines.append(format_row('{}:{}'.format(source, cmd), kind, h))
+  for cmd, hists in sorted(merge_sources(data).items()):
+    for kind, h in sorted(hists.items()):
+      lines.append(format_row(cmd, kind, h))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Merge loadgen.py latency histograms (one file per port) into a single
+    cluster-wide report of p50/p99/p999/p9999 per command.
+    """)
+  parser.add_argument('inputs', nargs='+', help='latency_<port>.json files, or folders containing them')
+  parser.add_argument('--per_port', dest='per_port', action='store_true', help='also report each port separately')
+  parser.add_argument('--merged', dest='merged', type=str, default=None, help='write the merged histograms to this file')
+
+  args = parser.parse_args()
+
+  fnames = []
+  for path in args.inputs:
+    if os.path.isdir(path):
+      fnames.extend(sorted(glob.glob(os.path.join(path, 'latency_*.json'))))
+    else:
+      fnames.append(path)
+
+  data = load_all(fnames)
+  print(format_report(data, args.per_port))
+  if args.merged:
+    histogram.dump(merge_sources(data), args.merged)
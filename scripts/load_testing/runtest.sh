@@ -7,15 +7,17 @@
 client_config=""
 server_config=""
 target=""
+local_binary=""
 
 show_help()
 {
     echo "runtest.sh -c <client_config_path> -s <server_config_path> -t <target: host where servers run>"
+    echo "runtest.sh -c <client_config_path> -s <server_config_path> -l <pelikan binary: run everything on this host>"
 }
 
 get_args()
 {
-    while getopts ":c:s:t:h" opt; do
+    while getopts ":c:s:t:l:h" opt; do
         case "$opt" in
         c)  client_config=$OPTARG
             ;;
@@ -23,6 +25,8 @@ get_args()
             ;;
         t)  target=$OPTARG
             ;;
+        l)  local_binary=$OPTARG
+            ;;
         h)
             show_help
             exit 0
@@ -59,12 +63,32 @@ client_run()
     cd - > /dev/null || exit 1
 }
 
+# engines the instances run, from the config names server_config.py generates
+engines()
+{
+    for f in "$server_config"/config/*.config
+    do
+        f=$(basename "$f")
+        echo "${f%-*}"
+    done | sort -u
+}
+
 wrap_up()
 {
-    ssh -C "$target" "pkill -f pelikan_twemcache"
+    local name
+    for engine in $(engines)
+    do
+        # exact process name, which the kernel truncates to 15 characters
+        name="pelikan_$engine"
+        ssh -C "$target" "pkill -x ${name:0:15}"
+    done
 }
 
 get_args "${@}"
+if [ -n "$local_binary" ]; then
+    python3 "$(dirname "$0")/local.py" --binary "$local_binary" --server_config "$server_config" --client_config "$client_config"
+    exit $?
+fi
 server_launch
 client_run
 wrap_up
@@ -0,0 +1,192 @@
+"""Find where pelikan instances saturate, one throughput/latency curve per
+configuration.
+
+For every combination of --vsize, --connections and --processes, loadgen.py
+offers increasing rates (x --step each time) to the instances until p999
+latency (--slo_percentile, --slo_latency), the error rate or the served rate
+gives out, then bisects between the last passing and first failing rate.
+Every rate tried is a point on the curve; the results for all configurations
+go into one JSON file:
+
+  [{"config": {"engine": ..., "vsize": 32, "connections": 100, "processes": 1},
+    "points": [{"rate": ..., "served": ..., "error_rate": ..., "p50": ...,
+                "p99": ..., "p999": ..., "ok": true}, ...],
+    "ceiling": ..., "knee": ...}, ...]
+
+ceiling is the highest served rate that met the thresholds; knee is where
+latency starts to climb faster than throughput (the point of the curve
+farthest from the line between its ends), which can come well before it.
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import itertools
+import json
+
+import client_config
+import histogram
+import loadgen
+
+
+START_RATE = 10000  # requests/s per instance
+STEP = 2.0
+REFINE = 3  # bisection rounds after the first failing rate
+DURATION = 30  # in seconds, per rate
+SLO_PERCENTILE = 99.9
+SLO_LATENCY = 1000  # in us
+MAX_ERROR_RATE = 0.001  # fraction of responses
+MIN_THROUGHPUT = 0.95  # fraction of the offered rate that must be served
+CURVE_PERCENTILES = [50, 99, 99.9]
+
+
+def measure(result, rate, percentile=SLO_PERCENTILE):
+  """one point of the curve from a loadgen.run() result, latencies in us;
+     slo is the latency at the given percentile
+  """
+  stats = result['stats']
+  responses = sum(s['response'] for s in stats.values())
+  errors = sum(s['error'] for s in stats.values())
+  h = histogram.merge_all(per_cmd[cmd]['corrected'] for per_cmd in result['latency'].values()
+                          for cmd in per_cmd)
+  point = {'rate': rate, 'served': responses / result['elapsed'],
+           'error_rate': 1.0 * errors / responses if responses else 1.0}
+  for p in CURVE_PERCENTILES:
+    point['p{:g}'.format(p).replace('.', '')] = h.percentile(p) / 1000.0
+  point['slo'] = h.percentile(percentile) / 1000.0
+  return point
+
+
+def passes(point, latency_us, max_error_rate=MAX_ERROR_RATE, min_throughput=MIN_THROUGHPUT):
+  """whether a point meets the latency, error and throughput thresholds"""
+  return (point['error_rate'] <= max_error_rate and
+          point['served'] >= min_throughput * point['rate'] and point['slo'] <= latency_us)
+
+
+def search(attempt, start_rate, step, refine):
+  """ramp geometrically from start_rate until attempt(rate) fails, then bisect.
+     attempt returns (ok, served); returns the highest served rate that passed
+  """
+  good, bad, best = 0.0, None, 0.0
+  rate = float(start_rate)
+  while bad is None:
+    ok, served = attempt(rate)
+    if ok:
+      good, best = rate, served
+      rate *= step
+    else:
+      bad = rate
+  for _ in range(refine):
+    rate = (good + bad) / 2
+    ok, served = attempt(rate)
+    if ok:
+      good, best = rate, served
+    else:
+      bad = rate
+  return best
+
+
+def knee(points):
+  """served rate at the point farthest from the chord between the first and
+     last point of the (served, latency) curve, both normalized; None if the
+     curve is too short to tell
+  """
+  curve = sorted((p['served'], p['slo']) for p in points)
+  if len(curve) < 3:
+    return None
+  (x0, y0), (x1, y1) = curve[0], curve[-1]
+  if x1 <= x0 or y1 <= y0:
+    return None
+  # distance below the chord, in the unit square
+  dist = [((x - x0) / (x1 - x0)) - ((y - y0) / (y1 - y0)) for x, y in curve]
+  i = max(range(len(curve)), key=lambda i: dist[i])
+  return curve[i][0] if dist[i] > 0 else None
+
+
+def saturate(endpoints, config, args, log=print):
+  """the curve for one configuration against endpoints"""
+  keyspace = client_config.keyspace(config['vsize'], args.slab_mem)
+  keyspace['commands'] = [('get', args.get_weight), ('set', args.set_weight)]
+  points = []
+
+  def attempt(rate):
+    result = loadgen.run(endpoints, config['connections'] * len(endpoints), rate * len(endpoints),
+                         args.duration, keyspace, config['processes'])
+    point = measure(result, rate * len(endpoints), args.slo_percentile)
+    point['ok'] = passes(point, args.slo_latency, args.max_error_rate)
+    points.append(point)
+    log('  rate {:>10.0f}/s served {:>10.0f}/s errors {:>7.3%} p{} {:>9.1f}us {}'.format(
+      point['rate'], point['served'], point['error_rate'], args.slo_percentile, point['slo'],
+      'ok' if point['ok'] else 'FAIL'))
+    return point['ok'], point['served']
+
+  ceiling = search(attempt, args.start_rate, args.step, args.refine)
+  points.sort(key=lambda p: p['rate'])
+  return {'config': config, 'points': points, 'ceiling': ceiling, 'knee': knee(points)}
+
+
+def configs(args):
+  return [{'engine': args.engine, 'vsize': vsize, 'connections': nconn, 'processes': nproc}
+          for vsize, nconn, nproc in itertools.product(args.vsize, args.connections, args.processes)]
+
+
+def format_curves(curves):
+  lines = ['{:>8} {:>12} {:>10} {:>14} {:>14}'.format(
+    'vsize', 'connections', 'processes', 'knee req/s', 'ceiling req/s')]
+  for c in curves:
+    lines.append('{:>8} {:>12} {:>10} {:>14} {:>14.0f}'.format(
+      c['config']['vsize'], c['config']['connections'], c['config']['processes'],
+      '-' if c['knee'] is None else '{:.0f}'.format(c['knee']), c['ceiling']))
+  return '\n'.join(lines)
+
+
+def write_csv(curves, fname):
+  cols = ['rate', 'served', 'error_rate', 'p50', 'p99', 'p999', 'ok']
+  with open(fname, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(['engine', 'vsize', 'connections', 'processes'] + cols)
+    for c in curves:
+      cfg = c['config']
+      for p in c['points']:
+        writer.writerow([cfg['engine'], cfg['vsize'], cfg['connections'], cfg['processes']] +
+                        [p[k] for k in cols])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Search for the saturation point of running pelikan instances for every
+    combination of value size, connections and load processes, and write
+    the throughput/latency curves.
+    """)
+  parser.add_argument('--server_ip', dest='server_ip', type=str, default='127.0.0.1', help='server ip')
+  parser.add_argument('--port', dest='port', type=int, default=client_config.PELIKAN_SERVER_PORT, help='port of the first instance')
+  parser.add_argument('--instances', dest='instances', type=int, default=client_config.INSTANCES, help='number of instances')
+  parser.add_argument('--engine', dest='engine', type=str, default='twemcache', help='what the servers run, recorded with each curve')
+  parser.add_argument('--vsize', dest='vsize', type=int, nargs='+', default=[client_config.VSIZE], help='value sizes')
+  parser.add_argument('--connections', dest='connections', type=int, nargs='+', default=[client_config.RPCPERF_CONNS], help='connections per instance')
+  parser.add_argument('--processes', dest='processes', type=int, nargs='+', default=[loadgen.PROCESSES], help='load generating processes')
+  parser.add_argument('--slab_mem', dest='slab_mem', type=int, default=client_config.PELIKAN_SLAB_MEM, help='slab memory, determines key count')
+  parser.add_argument('--get_weight', dest='get_weight', type=int, default=client_config.RPCPERF_GET_WEIGHT, help='relative weight of get')
+  parser.add_argument('--set_weight', dest='set_weight', type=int, default=client_config.RPCPERF_SET_WEIGHT, help='relative weight of set')
+  parser.add_argument('--start_rate', dest='start_rate', type=float, default=START_RATE, help='first rate offered per instance, requests/s')
+  parser.add_argument('--step', dest='step', type=float, default=STEP, help='rate multiplier while the thresholds hold')
+  parser.add_argument('--refine', dest='refine', type=int, default=REFINE, help='bisection rounds')
+  parser.add_argument('--duration', dest='duration', type=float, default=DURATION, help='seconds per rate')
+  parser.add_argument('--slo_percentile', dest='slo_percentile', type=float, default=SLO_PERCENTILE, help='latency percentile of the threshold')
+  parser.add_argument('--slo_latency', dest='slo_latency', type=float, default=SLO_LATENCY, help='latency threshold, in us')
+  parser.add_argument('--max_error_rate', dest='max_error_rate', type=float, default=MAX_ERROR_RATE, help='highest tolerated fraction of error responses')
+  parser.add_argument('--output', dest='output', type=str, default='saturation.json', help='curves to write')
+  parser.add_argument('--csv', dest='csv', type=str, default=None, help='also write every point to this file')
+
+  args = parser.parse_args()
+
+  endpoints = loadgen.parse_endpoints(args.server_ip, args.port, args.instances)
+  curves = []
+  for config in configs(args):
+    print('vsize {vsize} connections {connections} processes {processes}:'.format(**config))
+    curves.append(saturate(endpoints, config, args))
+    with open(args.output, 'w') as f:  # after each, so an interrupted sweep keeps its curves
+      json.dump(curves, f, indent=2)
+  if args.csv:
+    write_csv(curves, args.csv)
+  print(format_curves(curves))
@@ -4,6 +4,8 @@ import os
 import subprocess
 import sys
 
+import topology
+
 INSTANCES = 3
 PREFIX = 'test'
 PELIKAN_ADMIN_PORT = 9900
@@ -12,12 +14,17 @@ PELIKAN_SLAB_MEM = 4294967296
 PELIKAN_ITEM_OVERHEAD = 48
 KSIZE = 32
 VSIZE = 32
-THREAD_PER_SOCKET = 48
+CORES_PER_INSTANCE = 1  # physical cores, hyperthreads included, under BIND_TO_CORES
 BIND_TO_CORES = False
 BIND_TO_NODES = True
 ENGINE = "twemcache"
+PREFILL = True  # twemcache's built-in uniform prefill, see warmup.py for the alternative
+WARM_UP_TIMEOUT = 3600  # in seconds, prefilling large heaps takes a while
+# polls admin `stats` until every instance answers, which is after prefill
+READY_PROBE = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            '../../test/integration/server.py'))
 
-def generate_config(instances, vsize, slab_mem, pmem_paths, engine):
+def generate_config(instances, vsize, slab_mem, pmem_paths, engine, prefill=PREFILL):
   # create top-level folders under prefix
   try:
     os.makedirs('config')
@@ -50,6 +57,8 @@ buf_init_size: 4096
 
 buf_sock_poolsize: 16384
 
+pid_filename: {pid_file}
+
 debug_log_level: 5
 debug_log_file: log/{engine}-{server_port}.log
 debug_log_nbuf: 1048576
@@ -59,16 +68,12 @@ klog_backup: log/{engine}-{server_port}.cmd.old
 klog_sample: 100
 klog_max: 1073741824
 
-prefill: yes
-prefill_ksize: 32
-prefill_vsize: {vsize}
-prefill_nkey: {nkey}
-
 request_poolsize: 16384
 response_poolsize: 32768
 
 time_type: 2
-""".format(admin_port=admin_port, server_port=server_port, vsize=vsize, nkey=nkey, engine=engine)
+""".format(admin_port=admin_port, server_port=server_port, vsize=vsize, nkey=nkey, engine=engine,
+           pid_file=pid_name(engine, i))
 
     # String with options specific for either twemcache or slimcache
     pmem_path_str = ""
@@ -95,6 +100,14 @@ slab_datapool_prefault: yes
 stats_intvl: 10000
 stats_log_file: log/twemcache-{server_port}.stats
 """.format(hash_power=hash_power, slab_mem=slab_mem, server_port=server_port)
+      if prefill:
+        engine_str += """\
+
+prefill: yes
+prefill_ksize: {ksize}
+prefill_vsize: {vsize}
+prefill_nkey: {nkey}
+""".format(ksize=KSIZE, vsize=vsize, nkey=nkey)
 
     # String with option specific for PMEM usage
     if len(pmem_paths) > 0:
@@ -108,40 +121,65 @@ stats_log_file: log/twemcache-{server_port}.stats
     with open(os.path.join('config', config_file),'w') as the_file:
       the_file.write(config_str)
 
-def generate_runscript(binary, instances, pmem_paths_count, engine):
+def instance_nodes(instances, pmem_paths, topo):
+  """NUMA node of each instance: that of its pmem path when the device says,
+     else round robin over the nodes with cpus, as the pmem paths are
+  """
+  nodes = sorted(topo['nodes'])
+  if pmem_paths:
+    path_nodes = [topology.path_node(path) for path in pmem_paths]
+    path_nodes = [n if n in topo['nodes'] else nodes[j % len(nodes)] for j, n in enumerate(path_nodes)]
+    return [path_nodes[i % len(pmem_paths)] for i in range(instances)]
+  return [nodes[i % len(nodes)] for i in range(instances)]
+
+
+def numactl_args(instances, pmem_paths, topo=None):
+  """numactl options placing each instance, empty if instances aren't bound;
+     topo defaults to this host's
+  """
+  if not (BIND_TO_NODES or BIND_TO_CORES):
+    return [[] for _ in range(instances)]
+  topo = topo or topology.discover()
+  nodes = instance_nodes(instances, pmem_paths, topo)
+  placement = topology.place(topo, nodes, CORES_PER_INSTANCE if BIND_TO_CORES else 0)
+  return [['--physcpubind={}'.format(topology.format_cpulist(cpus)), '--preferred={}'.format(node)]
+          for node, cpus in zip(nodes, placement)]
+
+
+def config_name(engine, i):
+  return os.path.join('config', '{engine}-{server_port}.config'.format(engine=engine, server_port=PELIKAN_SERVER_PORT+i))
+
+
+def pid_name(engine, i):
+  return os.path.join('log', '{engine}-{server_port}.pid'.format(engine=engine, server_port=PELIKAN_SERVER_PORT+i))
+
+
+def generate_runscript(binary, instances, pmem_paths, engine, topo=None):
   # create bring-up.sh
   fname = 'bring-up.sh'
-  numa_node_count = pmem_paths_count if pmem_paths_count > 0 else 2
+  placement = numactl_args(instances, pmem_paths, topo)
   with open(fname, 'w') as the_file:
-    for i in range(instances):
-      config_file = os.path.join('config', '{engine}-{server_port}.config'.format(engine=engine, server_port=PELIKAN_SERVER_PORT+i))
-      if BIND_TO_NODES:
-        the_file.write('sudo numactl --cpunodebind={numa_node} --preferred={numa_node} '.format(
-            numa_node=i%numa_node_count))
-      elif BIND_TO_CORES:
-        the_file.write('sudo numactl --physcpubind={physical_thread},{logical_thread} '.format(
-            physical_thread=i,
-            logical_thread=i+THREAD_PER_SOCKET))
+    the_file.write('set -e\n')  # stop at the first instance that fails to start
+    for i, numactl in enumerate(placement):
+      if numactl:
+        the_file.write('sudo numactl {} '.format(' '.join(numactl)))
       the_file.write('{binary_file} {config_file}\n'.format(
           binary_file=binary,
-          config_file=config_file))
+          config_file=config_name(engine, i)))
   os.chmod(fname, 0o777)
 
-  # create warm-up.sh
+  # create warm-up.sh; the probe gives up as soon as an instance exits, as
+  # told by the pid files, rather than wait out the timeout
   fname = 'warm-up.sh'
-  prefill_opt = "prefilling cuckoo" if engine == "slimcache" else "prefilling slab"
+  pid_files = ' '.join(pid_name(engine, i) for i in range(instances))
   with open(fname, 'w') as the_file:
     the_file.write("""
-./bring-up.sh
-
-nready=0
-while [ $nready -lt {instances} ]
-do
-    nready=$(grep -l "{prefill_opt}" log/{engine}-*.log | wc -l)
-    echo "$(date): $nready out of {instances} servers are warmed up"
-    sleep 10
-done
-""".format(instances=instances, prefill_opt=prefill_opt, engine=engine))
+rm -f {pid_files}
+./bring-up.sh || exit 1
+
+python3 {probe} --admin_port {admin_port} --instances {instances} --timeout {timeout} --pid_files {pid_files}
+""".format(probe=READY_PROBE, admin_port=PELIKAN_ADMIN_PORT, instances=instances,
+           timeout=WARM_UP_TIMEOUT, pid_files=pid_files))
   os.chmod(fname, 0o777)
 
 
@@ -154,15 +192,18 @@ if __name__ == "__main__":
   parser.add_argument('--instances', dest='instances', type=int, default=INSTANCES, help='number of instances')
   parser.add_argument('--vsize', dest='vsize', type=int, default=VSIZE, help='value size')
   parser.add_argument('--slab_mem', dest='slab_mem', type=int, default=PELIKAN_SLAB_MEM, help='total capacity of slab memory, in bytes')
-  parser.add_argument('--pmem_paths', dest='pmem_paths', nargs='*', help='list of pmem mount points')
+  parser.add_argument('--pmem_paths', dest='pmem_paths', nargs='*', default=[], help='list of pmem mount points')
+  parser.add_argument('--no_prefill', dest='prefill', action='store_false', help='start instances empty, to be loaded by warmup.py')
+  parser.add_argument('--topology', dest='topology', type=str, default=None, help='topology.py --output of the server host, if not this one')
 
   args = parser.parse_args()
 
+  topo = topology.load(args.topology) if args.topology else None
   if not os.path.exists(args.prefix):
     os.makedirs(args.prefix)
   os.chdir(args.prefix)
 
-  binary_help_out = subprocess.check_output([args.binary, '--help'])
+  binary_help_out = subprocess.check_output([args.binary, '--help']).decode()
   if binary_help_out.find("twemcache") != -1:
     engine = "twemcache"
   elif binary_help_out.find("slimcache") != -1:
@@ -171,5 +212,5 @@ if __name__ == "__main__":
     print('Provided binary is not twemcache|slimcache. Only these engines are valid. Exiting...')
     sys.exit()
 
-  generate_config(args.instances, args.vsize, args.slab_mem, args.pmem_paths, engine)
-  generate_runscript(args.binary, args.instances, len(args.pmem_paths), engine)
+  generate_config(args.instances, args.vsize, args.slab_mem, args.pmem_paths, engine, args.prefill)
+  generate_runscript(args.binary, args.instances, args.pmem_paths, engine, topo)
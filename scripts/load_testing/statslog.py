@@ -0,0 +1,296 @@
+"""Read pelikan stats_log files and flag what went wrong during a load test.
+
+With `stats_intvl` and `stats_log_file` set (server_config.py does both), each
+instance appends one line of `name: value, ` pairs every stats_intvl ms. The
+files are read line by line, keeping only the metrics asked for, into the
+same columns statsmon.py collects over the admin port, so its rates() and
+series() apply as is. Lines carry `time` in whole seconds only, so samples are
+placed at the first `time` of their process life (a segment, which starts
+anew whenever the pid changes, i.e. the instance restarted) plus the `uptime`
+(ms) they were taken at since. Lines without `uptime` are placed stats_intvl
+apart instead (inferred from `time` unless given).
+
+The analyzer splits the cluster-wide series into phases:
+
+  prefill / idle  before any requests, prefill if items were already stored
+  warm-up         until throughput and hit ratio settle near their steady level
+  steady          until throughput falls off at the end of the run
+  drain           after that
+
+and reports, per phase, throughput plateaus, eviction storms and hit-ratio
+dips, both cluster-wide and per instance.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import array
+import glob
+import os
+
+import numpy as np
+
+import statsmon
+
+
+# metrics kept by default: what statsmon.SERIES and the analyzer use
+METRICS = sorted(set(['time', 'pid', 'item_curr'] +
+                     [m for _, num, den in statsmon.SERIES for m in num + (den or [])]))
+ACTIVE = 0.05  # fraction of peak throughput above which the cluster is under load
+SETTLED = 0.9  # fraction of steady throughput that ends warm-up
+HIT_SETTLED = 0.02  # hit ratio within this of its steady level ends warm-up
+PLATEAU_TOL = 0.05  # relative spread of throughput within a plateau
+PLATEAU_MIN = 5  # samples
+STORM_FACTOR = 5.0  # eviction rate over this many times its steady median is a storm
+STORM_MIN = 100.0  # evictions/s, below which nothing is a storm
+DIP = 0.05  # drop in hit ratio below its steady level that counts as a dip
+
+
+def parse_line(line, metrics=None):
+  """{name: float} from one stats_log line, optionally only the given metrics"""
+  out = {}
+  for field in line.split(','):
+    name, sep, value = field.partition(':')
+    name = name.strip()
+    if not sep or (metrics is not None and name not in metrics):
+      continue
+    try:
+      out[name] = float(value)
+    except ValueError:
+      pass
+  return out
+
+
+def read(fname, metrics=None, interval=None):
+  """(times, {metric: array}) for one file, streamed a line at a time.
+     interval is stats_intvl in seconds, for lines without `uptime`; inferred
+     from `time` if not given.
+  """
+  keep = set(metrics) | set(['time', 'pid', 'uptime']) if metrics is not None else None
+  stamp = array.array('d')
+  pid = array.array('d')
+  cols = {}
+  n = 0
+  with open(fname, 'rb') as f:
+    for line in f:
+      sample = parse_line(line.decode('ascii', 'replace'), keep)
+      if 'time' not in sample:  # e.g. a line torn by a crash
+        continue
+      for name, value in sample.items():
+        col = cols.get(name)
+        if col is None:  # metric first seen now, earlier samples lack it
+          col = cols[name] = array.array('d', [float('nan')] * n)
+        col.append(value)
+      n += 1
+      for col in cols.values():
+        if len(col) < n:
+          col.append(float('nan'))
+      stamp.append(sample['time'])
+      pid.append(sample.get('pid', 0))
+  stamp = np.frombuffer(stamp, dtype=np.float64)
+  pid = np.frombuffer(pid, dtype=np.float64)
+  cols = dict((name, np.frombuffer(col, dtype=np.float64)) for name, col in cols.items())
+  # segments of one process life each: from their first `time`, by uptime
+  start = np.concatenate([[0], np.nonzero(pid[1:] != pid[:-1])[0] + 1])
+  seg = np.cumsum(np.isin(np.arange(n), start)) - 1
+  times = np.full(n, np.nan)
+  uptime = cols.get('uptime')
+  if uptime is not None:
+    times = stamp[start][seg] + (uptime - uptime[start][seg]) / 1000.0
+  spaced = np.isnan(times)
+  if spaced.any():  # evenly spaced instead
+    if interval is None:
+      interval = infer_interval(stamp, seg)
+    pos = np.arange(n) - start[seg]
+    times[spaced] = (stamp[start][seg] + pos * interval)[spaced]
+  return times, cols
+
+
+def infer_interval(stamp, seg):
+  """stats_intvl from whole-second stamps: elapsed over samples, longest segment"""
+  best = (0, 1.0)
+  for s in np.unique(seg):
+    t = stamp[seg == s]
+    if len(t) > 1 and t[-1] > t[0]:
+      best = max(best, (len(t), (t[-1] - t[0]) / (len(t) - 1)))
+  return best[1]
+
+
+def load_all(paths, metrics=METRICS, interval=None):
+  """read every file into statsmon's (header, cols) layout, one instance per file"""
+  fnames = []
+  for path in paths:
+    if os.path.isdir(path):
+      fnames.extend(sorted(glob.glob(os.path.join(path, '*.stats'))))
+    else:
+      fnames.append(path)
+  parsed = [read(fname, metrics, interval) for fname in fnames]
+  names = sorted(set().union(*[cols.keys() for _, cols in parsed])) if parsed else []
+  if interval is None:  # the grid statsmon buckets on, from the files themselves
+    spacing = [np.median(np.diff(t)) for t, _ in parsed if len(t) > 1]
+    interval = float(np.median(spacing)) if spacing else 1.0
+  header = {'format': statsmon.FORMAT, 'version': statsmon.VERSION, 'interval': interval,
+            'files': fnames, 'metrics': names}
+  nan = lambda t: np.full(len(t), np.nan)
+  cols = {'time': np.concatenate([t for t, _ in parsed] or [[]]),
+          'instance': np.concatenate([np.full(len(t), i, dtype=int)
+                                      for i, (t, _) in enumerate(parsed)] or [[]]).astype(int),
+          'metrics': dict((name, np.concatenate([c.get(name, nan(t)) for t, c in parsed]))
+                          for name in names)}
+  return header, cols
+
+
+def runs(mask):
+  """[(start, end)] of consecutive True in mask, end exclusive"""
+  edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+  return list(zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]))
+
+
+def phases(req, hit, items0):
+  """phase name per sample of the cluster-wide series"""
+  label = np.array(['prefill' if items0 > 0 else 'idle'] * len(req), dtype=object)
+  active = np.nan_to_num(req) > ACTIVE * np.nanmax(req) if len(req) and np.nanmax(req) > 0 \
+    else np.zeros(len(req), dtype=bool)
+  if not active.any():
+    return label
+  first = np.argmax(active)
+  last = len(active) - 1 - np.argmax(active[::-1])
+  tail = slice(first + (last - first + 1) // 2, last + 1)  # steady by the second half
+  req_ref = np.median(req[tail])
+  hit_ref = np.nanmedian(hit[tail]) if hit is not None and np.isfinite(hit[tail]).any() else None
+  settled = req >= SETTLED * req_ref
+  if hit_ref is not None:
+    settled &= np.abs(hit - hit_ref) <= HIT_SETTLED
+  warm_end = first + np.argmax(settled[first:last + 1]) if settled[first:last + 1].any() \
+    else last + 1
+  label[first:warm_end] = 'warm-up'
+  label[warm_end:last + 1] = 'steady'
+  label[last + 1:] = 'drain'
+  return label
+
+
+def detect(req, hit, evict, label):
+  """[(kind, start, end, detail)] for one series, end exclusive"""
+  events = []
+  steady = label == 'steady'
+  active = np.isin(label, ['warm-up', 'steady'])
+
+  # plateaus: grow a run while throughput stays within PLATEAU_TOL of its mean
+  i = 0
+  while i < len(req):
+    j = i + 1
+    while j < len(req) and active[j] and active[i] and \
+        np.ptp(req[i:j + 1]) <= PLATEAU_TOL * np.mean(req[i:j + 1]):
+      j += 1
+    if j - i >= PLATEAU_MIN:
+      level = np.mean(req[i:j])
+      events.append(('plateau', i, j, '{:.1f} req/s{}'.format(
+        level, ', peak' if level >= (1 - PLATEAU_TOL) * np.nanmax(req) else '')))
+      i = j
+    else:
+      i += 1
+
+  if evict is not None:
+    base = np.median(evict[steady]) if steady.any() else np.median(evict)
+    threshold = max(STORM_MIN, STORM_FACTOR * base)
+    for s, e in runs(evict > threshold):
+      events.append(('eviction storm', s, e, 'peak {:.1f}/s vs {:.1f}/s steady'.format(
+        np.max(evict[s:e]), base)))
+
+  if hit is not None and steady.any() and np.isfinite(hit[steady]).any():
+    base = np.nanmedian(hit[steady])  # warm-up is expected to miss, so only steady dips
+    for s, e in runs(steady & (np.nan_to_num(hit, nan=base) < base - DIP)):
+      events.append(('hit-ratio dip', s, e, 'low {:.4f} vs {:.4f} steady'.format(
+        np.nanmin(hit[s:e]), base)))
+  return events
+
+
+def analyze(header, cols):
+  """(buckets, cluster-wide {series: array}, phase labels, events); events are
+     (kind, start, end, detail, instances) by bucket. Instance events during a
+     cluster-wide one of the same kind are listed as its instances; other
+     instance events stand alone, instances None meaning none stood out.
+  """
+  r = statsmon.rates(header, cols)
+  buckets, total = statsmon.aggregate(r)
+  cluster = dict(statsmon.series(total))
+  first = np.unique(cols['instance'], return_index=True)[1]
+  items0 = np.nansum(cols['metrics']['item_curr'][first]) if 'item_curr' in cols['metrics'] else 0
+  req = cluster.get('req/s', np.zeros(len(buckets)))
+  label = phases(req, cluster.get('hit_ratio'), items0)
+  events = [list(e) + [[]] for e in detect(req, cluster.get('hit_ratio'), cluster.get('evict/s'), label)]
+
+  # per instance, on the cluster's buckets and phases
+  for inst in np.unique(r['instance']):
+    mask = r['instance'] == inst
+    sub = {'bucket': r['bucket'][mask], 'instance': r['instance'][mask], 'dt': r['dt'][mask],
+           'metrics': dict((m, v[mask]) for m, v in r['metrics'].items())}
+    b, t = statsmon.aggregate(sub)
+    s = dict(statsmon.series(t))
+    idx = np.searchsorted(buckets, b)
+    for kind, start, end, detail in detect(s.get('req/s', np.zeros(len(b))), s.get('hit_ratio'),
+                                           s.get('evict/s'), label[idx]):
+      if kind == 'plateau':  # per instance plateaus are noise next to the cluster's
+        continue
+      start, end = idx[start], idx[end - 1] + 1
+      for e in events:
+        if e[0] == kind and e[1] < end and start < e[2] and e[4] is not None:
+          e[4].append(int(inst))
+          break
+      else:
+        events.append([kind, start, end, detail, [int(inst)]])
+  for e in events:
+    e[4] = e[4] or None
+  return buckets, cluster, label, [tuple(e) for e in events]
+
+
+def format_analysis(header, buckets, cluster, label, events):
+  interval = header['interval']
+  offset = lambda i: (buckets[min(i, len(buckets) - 1)] - buckets[0]) * interval
+  lines = ['{} instances, {:.0f}s at {:g}s intervals'.format(
+    len(header['files']), len(buckets) * interval, interval)]
+  lines.append('{:<8} {:>9} {:>9} {:>12} {:>10} {:>10}'.format(
+    'phase', 'from (s)', 'to (s)', 'req/s', 'hit_ratio', 'evict/s'))
+  cuts = np.concatenate([[0], np.nonzero(label[1:] != label[:-1])[0] + 1, [len(label)]])
+  for s, e in zip(cuts[:-1], cuts[1:]):
+    def mean(name):
+      v = cluster[name][s:e] if name in cluster else []
+      return np.nanmean(v) if np.isfinite(v).any() else float('nan')
+    lines.append('{:<8} {:>9.0f} {:>9.0f} {:>12.1f} {:>10.4f} {:>10.1f}'.format(
+      label[s], offset(s), offset(e - 1) + interval, mean('req/s'), mean('hit_ratio'),
+      mean('evict/s')))
+  lines.append('')
+  for kind, start, end, detail, instances in sorted(events, key=lambda e: e[1]):
+    line = '{:<9} {:>15} {:<15} {}'.format(
+      '[' + label[start] + ']', '{:.0f}s-{:.0f}s'.format(offset(start), offset(end - 1) + interval),
+      kind, detail)
+    if instances:
+      names = [os.path.basename(header['files'][i]) for i in sorted(instances)]
+      line += ' on ' + ', '.join(names) if len(names) < len(header['files']) else ' on every instance'
+    lines.append(line)
+  if not events:
+    lines.append('nothing flagged')
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Parse pelikan stats_log files (e.g. log/*.stats as configured by
+    server_config.py), line up all instances, and flag throughput plateaus,
+    eviction storms and hit-ratio dips by run phase.
+    """)
+  parser.add_argument('paths', nargs='+', help='stats_log files, or folders of *.stats files')
+  parser.add_argument('--stats_intvl', dest='stats_intvl', type=float, default=None, help='stats_intvl the servers ran with, in ms, the bucket width; inferred from the logs if not given')
+  parser.add_argument('--series', dest='series', action='store_true', help='also print the cluster-wide series')
+  parser.add_argument('--all', dest='all', action='store_true', help='keep every metric, not only those the analysis needs')
+
+  args = parser.parse_args()
+
+  header, cols = load_all(args.paths, None if args.all else METRICS,
+                          args.stats_intvl / 1000.0 if args.stats_intvl else None)
+  buckets, cluster, label, events = analyze(header, cols)
+  if args.series:
+    print(statsmon.format_report(header, cols))
+    print()
+  print(format_analysis(header, buckets, cluster, label, events))
@@ -0,0 +1,274 @@
+"""Collect admin stats from many pelikan instances as a time series.
+
+All instances are polled concurrently from one event loop over persistent
+admin connections. Polls happen every --interval seconds on a wall-clock grid
+(multiples of the interval since the epoch), so samples line up with the
+latency timeline loadgen.py --interval records, across processes and hosts.
+
+Samples are appended to a binary file as they arrive, so a long run can be
+read while it is still going and little is lost if it is killed:
+
+  one JSON header line  {"format": "pelikan-stats", "version": 1, "interval": 1.0,
+                         "endpoints": [[host, port], ...], "metrics": [...]}
+  then float64 records  time, instance, one value per metric
+
+The metrics are those in the first round of replies; a metric an instance
+doesn't report, or a poll that timed out, is NaN. load() returns the columns
+as NumPy arrays and rates() turns them into per-second rates per interval.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+import argparse
+import asyncio
+import glob
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from client import AdminClient, parse_stats
+
+import client_config
+import histogram
+
+
+FORMAT = 'pelikan-stats'
+VERSION = 1
+INTERVAL = 1.0  # in seconds
+DURATION = 60  # in seconds
+POLL_TIMEOUT = 0.8  # fraction of the interval a poll may take before it counts as missed
+READ_LIMIT = 1024 * 1024  # in bytes, largest stats reply expected
+STATS_REQ = (AdminClient.STATS_CMD + AdminClient.DELIM).encode()
+
+# (name, metrics summed for the numerator, metrics summed for the denominator);
+# names missing from an engine's stats are skipped
+SERIES = [
+  ('req/s', ['request_parse'], None),
+  ('hit_ratio', ['get_key_hit'], ['get_key']),
+  ('evict/s', ['item_evict', 'slab_evict', 'seg_evict'], None),
+  ('alloc/s', ['item_alloc', 'cuckoo_insert'], None),
+  ('mem B/s', ['item_keyval_byte', 'item_curr_bytes'], None),
+]
+TIMELINE_PERCENTILES = [99, 99.9]
+
+
+class StatsPoller(object):
+  """one persistent admin connection, reconnected after any failure"""
+
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+    self.reader = None
+    self.writer = None
+
+
+  async def poll(self):
+    """(time the reply arrived, stats)"""
+    try:
+      if self.writer is None:
+        self.reader, self.writer = await asyncio.open_connection(
+          *self.endpoint, limit=READ_LIMIT)
+      self.writer.write(STATS_REQ)
+      buf = await self.reader.readuntil(AdminClient.STATS_END)
+      return time.time(), parse_stats(buf)
+    except BaseException:  # incl. cancellation on timeout: the reply may still come
+      self.close()
+      raise
+
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = self.writer = None
+
+
+def to_float(value):
+  try:
+    return float(value)
+  except ValueError:
+    return float('nan')
+
+
+async def collect(endpoints, interval, duration, fname, log=None):
+  """poll endpoints every interval for duration seconds, appending to fname;
+     returns the number of rounds written
+  """
+  pollers = [StatsPoller(endpoint) for endpoint in endpoints]
+  metrics = None
+  rounds = 0
+  start = math.ceil(time.time() / interval) * interval
+  tick = 0
+  with open(fname, 'wb') as f:
+    while tick * interval <= duration:
+      await asyncio.sleep(max(0.0, start + tick * interval - time.time()))
+      replies = await asyncio.gather(
+        *[asyncio.wait_for(p.poll(), interval * POLL_TIMEOUT) for p in pollers],
+        return_exceptions=True)
+      ok = [r for r in replies if not isinstance(r, BaseException)]
+      if metrics is None and ok:
+        metrics = sorted(set().union(*[stats.keys() for _, stats in ok]))
+        header = {'format': FORMAT, 'version': VERSION, 'interval': interval,
+                  'endpoints': [list(e) for e in endpoints], 'metrics': metrics}
+        f.write((json.dumps(header) + '\n').encode())
+      if metrics is not None and ok:
+        rows = np.full((len(ok), 2 + len(metrics)), np.nan)
+        for row, (i, reply) in zip(rows, [(i, r) for i, r in enumerate(replies)
+                                          if not isinstance(r, BaseException)]):
+          t, stats = reply
+          row[0], row[1] = t, i
+          row[2:] = [to_float(stats[m]) if m in stats else np.nan for m in metrics]
+        f.write(rows.tobytes())
+        f.flush()
+        rounds += 1
+      if log and len(ok) < len(pollers):
+        log('{:.3f}: {} of {} instances missed'.format(time.time(), len(pollers) - len(ok),
+                                                        len(pollers)))
+      # if a round overran, skip the ticks it missed rather than bunch up polls
+      tick = max(tick + 1, int(math.floor((time.time() - start) / interval)) + 1)
+  for p in pollers:
+    p.close()
+  return rounds
+
+
+def run_collector(endpoints, interval, duration, fname):
+  """entry point for running the collector in its own process"""
+  return asyncio.run(collect(endpoints, interval, duration, fname, log=print))
+
+
+def load(fname):
+  """(header, {'time', 'instance', 'metrics': {metric: array}}); kept apart
+     since pelikan has metrics named e.g. `time`
+  """
+  with open(fname, 'rb') as f:
+    header = json.loads(f.readline().decode())
+    offset = f.tell()
+  if header.get('format') != FORMAT:
+    raise ValueError('{} is not a stats file'.format(fname))
+  ncol = 2 + len(header['metrics'])
+  data = np.fromfile(fname, dtype=np.float64, offset=offset)
+  data = data[:len(data) // ncol * ncol].reshape(-1, ncol)  # drop a torn last record
+  metrics = dict((metric, data[:, 2 + i]) for i, metric in enumerate(header['metrics']))
+  return header, {'time': data[:, 0], 'instance': data[:, 1].astype(int), 'metrics': metrics}
+
+
+def rates(header, cols):
+  """per instance and interval: {'bucket', 'instance', 'dt', 'metrics': {metric: delta/dt}}.
+     bucket is the interval's index on the wall-clock grid. Gauges give their
+     net change per second, which may be negative
+  """
+  order = np.lexsort((cols['time'], cols['instance']))
+  inst = cols['instance'][order]
+  t = cols['time'][order]
+  same = inst[1:] == inst[:-1]
+  dt = (t[1:] - t[:-1])[same]
+  out = {'bucket': np.floor(t[:-1][same] / header['interval']).astype(np.int64),
+         'instance': inst[1:][same], 'dt': dt, 'metrics': {}}
+  for metric, values in cols['metrics'].items():
+    v = values[order]
+    delta = (v[1:] - v[:-1])[same]
+    out['metrics'][metric] = delta / dt
+  return out
+
+
+def aggregate(r):
+  """sum per-instance rates by bucket: (buckets, {metric: array}). An instance
+     with more than one interval starting in a bucket (samples not taken on
+     the grid, e.g. from stats_log) counts their mean weighted by dt
+  """
+  buckets, idx = np.unique(r['bucket'], return_inverse=True)
+  group = np.unique(idx * (int(r['instance'].max()) + 1) + r['instance'], return_inverse=True)[1] \
+    if len(idx) else idx
+  weight = r['dt'] / np.bincount(group, weights=r['dt'])[group]
+  total = {}
+  for metric, values in r['metrics'].items():
+    total[metric] = np.bincount(idx, weights=np.nan_to_num(values) * weight, minlength=len(buckets))
+  return buckets, total
+
+
+def series(total):
+  """the SERIES this engine supports: [(name, array)]"""
+  def add(metrics):
+    present = [total[m] for m in metrics if m in total]
+    return np.sum(present, axis=0) if present else None
+
+  out = []
+  for name, num, den in SERIES:
+    n = add(num)
+    if n is None:
+      continue
+    if den is not None:
+      d = add(den)
+      if d is None:
+        continue
+      with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.where(d > 0, n / d, np.nan)
+    out.append((name, n))
+  return out
+
+
+def load_timeline(paths):
+  """merge loadgen.py timeline_<port>.json files into {bucket: Histogram}"""
+  fnames = []
+  for path in paths:
+    if os.path.isdir(path):
+      fnames.extend(sorted(glob.glob(os.path.join(path, 'timeline_*.json'))))
+    else:
+      fnames.append(path)
+  timeline = {}
+  for fname in fnames:
+    for _, per_bucket in histogram.load(fname).items():
+      for bucket, h in per_bucket.items():
+        timeline.setdefault(int(bucket), histogram.Histogram()).merge(h)
+  return timeline
+
+
+def format_report(header, cols, timeline=None):
+  buckets, total = aggregate(rates(header, cols))
+  cols_out = series(total)
+  names = ['t (s)'] + [name for name, _ in cols_out]
+  if timeline:
+    names += ['p{} us'.format(p) for p in TIMELINE_PERCENTILES]
+  lines = [' '.join('{:>12}'.format(n) for n in names)]
+  for i, bucket in enumerate(buckets):
+    row = ['{:>12.1f}'.format((bucket - buckets[0]) * header['interval'])]
+    row += ['{:>12.4f}'.format(v[i]) if name == 'hit_ratio' else '{:>12.1f}'.format(v[i])
+            for name, v in cols_out]
+    if timeline:
+      h = timeline.get(int(bucket))
+      row += ['{:>12.1f}'.format(h.percentile(p) / 1000.0) if h and h.total else
+              '{:>12}'.format('-') for p in TIMELINE_PERCENTILES]
+    lines.append(' '.join(row))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Poll `stats` from pelikan instances on consecutive admin ports every
+    interval and append the samples to a binary file, or (with --report)
+    print per-interval rates from such a file, aligned with loadgen.py
+    latency timelines.
+    """)
+  parser.add_argument('--server_ip', dest='server_ip', type=str, default='127.0.0.1', help='server ip')
+  parser.add_argument('--admin_port', dest='admin_port', type=int, default=client_config.PELIKAN_ADMIN_PORT, help='admin port of the first instance')
+  parser.add_argument('--instances', dest='instances', type=int, default=client_config.INSTANCES, help='number of instances')
+  parser.add_argument('--interval', dest='interval', type=float, default=INTERVAL, help='seconds between polls')
+  parser.add_argument('--duration', dest='duration', type=float, default=DURATION, help='seconds to collect for')
+  parser.add_argument('--output', dest='output', type=str, default='stats.bin', help='file to write samples to')
+  parser.add_argument('--report', dest='report', type=str, default=None, help='print rates from this stats file instead of collecting')
+  parser.add_argument('--timeline', dest='timeline', nargs='*', default=[], help='loadgen.py timeline_<port>.json files or folders to align with --report')
+
+  args = parser.parse_args()
+
+  if args.report:
+    header, cols = load(args.report)
+    print(format_report(header, cols, load_timeline(args.timeline)))
+  else:
+    endpoints = [(args.server_ip, args.admin_port + i) for i in range(args.instances)]
+    rounds = run_collector(endpoints, args.interval, args.duration, args.output)
+    print('{} rounds from {} instances written to {}'.format(rounds, len(endpoints), args.output))
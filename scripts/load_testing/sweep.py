@@ -0,0 +1,277 @@
+"""Run a matrix of load tests and keep the results in one SQLite database.
+
+Every point of the matrix (engine, CPU binding, DRAM or pmem, value size, slab
+memory, instances, connections, load processes, rate) is run the way
+runtest.sh runs a single one: server configs and scripts are generated with
+server_config.py into a folder of their own, warm-up.sh brings the instances
+up (over ssh when --target is another host, in which case the folder must be
+at the same path there), loadgen.py drives them, and the servers are killed.
+Slimcache instances are driven with one request in flight per connection, see
+loadgen.ENGINE_MAX_INFLIGHT.
+
+A matrix is a JSON object of lists, e.g.
+
+  {"engine": ["twemcache", "slimcache"], "binding": ["nodes", "cores"],
+   "memory": ["dram", "pmem"], "vsize": [32, 1024], "connections": [100, 1000]}
+
+with MATRIX supplying whatever is left out. Runs are recorded under a --build
+label (a release tag, a commit) with their parameters, and per command
+throughput, hit/miss/error counts, tail latency and the full latency
+histogram, so `--compare BASE NEW` can line up two builds point by point and
+exit non-zero on a regression.
+"""
+
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import client_config
+import histogram
+from histogram import Histogram
+import loadgen
+import server_config
+import topology
+
+
+MATRIX = {
+  'engine': ['twemcache'],
+  'binding': ['nodes'],  # nodes, cores or none, as BIND_TO_NODES/BIND_TO_CORES in server_config.py
+  'memory': ['dram'],  # dram or pmem (needs --pmem_paths)
+  'vsize': [client_config.VSIZE],
+  'slab_mem': [client_config.PELIKAN_SLAB_MEM],
+  'instances': [client_config.INSTANCES],
+  'connections': [client_config.RPCPERF_CONNS],  # per instance
+  'threads': [client_config.RPCPERF_THREADS],  # load generating processes
+  'rate': [client_config.RPCPERF_RATE],  # per instance, 0 for unlimited
+}
+PARAMS = sorted(MATRIX)
+DURATION = 60  # in seconds, per point
+REPEAT = 1
+THROUGHPUT_TOL = 0.05  # relative drop in throughput that is a regression
+LATENCY_TOL = 0.10  # relative rise in p999 that is a regression
+MIN_ELAPSED = 0.9  # fraction of --duration a run must last, else the servers went away
+ALL = '*'  # cmd of the rows covering every command
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY, build TEXT, started REAL, duration REAL, host TEXT,
+  {params});
+CREATE INDEX IF NOT EXISTS runs_build ON runs (build);
+CREATE TABLE IF NOT EXISTS results (
+  run_id INTEGER REFERENCES runs (id), cmd TEXT, request INTEGER, response INTEGER,
+  hit INTEGER, miss INTEGER, error INTEGER, rate REAL,
+  p50 REAL, p99 REAL, p999 REAL, p9999 REAL, histogram TEXT);
+""".format(params=', '.join('{} {}'.format(p, 'TEXT' if p in ('engine', 'binding', 'memory')
+                                           else 'INTEGER') for p in PARAMS))
+
+
+def load_matrix(fname=None):
+  matrix = dict(MATRIX)
+  if fname:
+    with open(fname) as f:
+      given = json.load(f)
+    unknown = set(given) - set(MATRIX)
+    if unknown:
+      raise ValueError('unknown matrix parameters: {}'.format(', '.join(sorted(unknown))))
+    matrix.update((k, v if isinstance(v, list) else [v]) for k, v in given.items())
+  return matrix
+
+
+def points(matrix):
+  return [dict(zip(PARAMS, values)) for values in itertools.product(*[matrix[p] for p in PARAMS])]
+
+
+def point_name(point):
+  return '{engine}_{binding}_{memory}_{vsize}_{slab_mem}_{instances}_{connections}_{threads}_{rate}' \
+    .format(**point)
+
+
+def connect(fname):
+  db = sqlite3.connect(fname)
+  db.executescript(SCHEMA)
+  return db
+
+
+def shell(cmd, cwd, target=None):
+  """run cmd in cwd, on target over ssh if given"""
+  if target:
+    return subprocess.call(['ssh', '-C', target, 'cd {} && {}'.format(cwd, cmd)])
+  return subprocess.call(cmd, shell=True, cwd=cwd)
+
+
+def generate(point, workdir, bin_path, pmem_paths, topo=None):
+  """server configs and scripts for one point, returns (folder, binary)"""
+  prefix = os.path.join(workdir, point_name(point))
+  binary = os.path.join(bin_path, 'pelikan_' + point['engine'])
+  pmem = pmem_paths if point['memory'] == 'pmem' else []
+  server_config.BIND_TO_NODES = point['binding'] == 'nodes'
+  server_config.BIND_TO_CORES = point['binding'] == 'cores'
+  if not os.path.exists(prefix):
+    os.makedirs(prefix)
+  cwd = os.getcwd()
+  os.chdir(prefix)  # server_config.py writes relative to where it runs
+  try:
+    server_config.generate_config(point['instances'], point['vsize'], point['slab_mem'], pmem,
+                                  point['engine'])
+    server_config.generate_runscript(binary, point['instances'], pmem, point['engine'], topo)
+  finally:
+    os.chdir(cwd)
+  return prefix, binary
+
+
+def run_point(point, args, log=print):
+  """bring up, drive and tear down one point, returns the loadgen result"""
+  prefix, binary = generate(point, args.workdir, args.bin_path, args.pmem_paths, args.topo)
+  try:
+    if shell('./warm-up.sh', prefix, args.target) != 0:
+      raise Exception('{} did not come up'.format(point_name(point)))
+    keyspace = client_config.keyspace(point['vsize'], point['slab_mem'])
+    endpoints = loadgen.parse_endpoints(args.target or '127.0.0.1',
+                                        server_config.PELIKAN_SERVER_PORT, point['instances'])
+    result = loadgen.run(endpoints, point['connections'] * point['instances'],
+                         point['rate'] * point['instances'], args.duration, keyspace,
+                         point['threads'],
+                         max_inflight=loadgen.engine_max_inflight(point['engine']))
+    if result['elapsed'] < MIN_ELAPSED * args.duration:
+      raise Exception('connections lost after {:.1f}s'.format(result['elapsed']))
+    return result
+  finally:
+    shell('pkill -f {}'.format(binary), prefix, args.target)
+
+
+def rows(result):
+  """(cmd, request, response, hit, miss, error, rate, p50, p99, p999, p9999, histogram)
+     per command and for all commands together
+  """
+  out = []
+  per_cmd = {}
+  for latency in result['latency'].values():
+    for cmd, hists in latency.items():
+      per_cmd.setdefault(cmd, Histogram()).merge(hists['corrected'])
+  per_cmd[ALL] = histogram.merge_all(per_cmd.values())
+  stats = dict(result['stats'])
+  stats[ALL] = dict((k, sum(s[k] for s in result['stats'].values()))
+                    for k in ['request', 'response', 'hit', 'miss', 'error'])
+  for cmd, h in sorted(per_cmd.items()):
+    s = stats[cmd]
+    out.append((cmd, s['request'], s['response'], s['hit'], s['miss'], s['error'],
+                s['response'] / result['elapsed']) +
+               tuple(h.percentile(p) / 1000.0 for p in [50, 99, 99.9, 99.99]) +
+               (json.dumps(h.to_dict()),))
+  return out
+
+
+def record(db, build, point, started, result):
+  cur = db.execute('INSERT INTO runs (build, started, duration, host, {}) VALUES ({})'.format(
+    ', '.join(PARAMS), ', '.join(['?'] * (4 + len(PARAMS)))),
+    [build, started, result['elapsed'], socket.gethostname()] + [point[p] for p in PARAMS])
+  db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 [(cur.lastrowid,) + row for row in rows(result)])
+  db.commit()
+
+
+def sweep(db, matrix, args, log=print):
+  todo = points(matrix)
+  for i, point in enumerate(todo):
+    if point['memory'] == 'pmem' and not args.pmem_paths:
+      log('skip {}: pmem needs --pmem_paths'.format(point_name(point)))
+      continue
+    for r in range(args.repeat):
+      log('[{}/{}] {} run {}'.format(i + 1, len(todo), point_name(point), r + 1))
+      started = time.time()
+      try:
+        result = run_point(point, args, log)
+      except Exception as e:
+        log('  failed: {}'.format(e))
+        continue
+      record(db, args.build, point, started, result)
+      log('  ' + loadgen.format_result(result).replace('\n', '\n  '))
+
+
+def summary(db, build):
+  """{params tuple: (median rate, median p999, runs)} over every cmd for build"""
+  by_point = {}
+  for row in db.execute(
+      'SELECT {}, r.rate, r.p999 FROM runs JOIN results r ON r.run_id = runs.id '
+      'WHERE runs.build = ? AND r.cmd = ?'.format(', '.join('runs.' + p for p in PARAMS)),
+      (build, ALL)):
+    by_point.setdefault(tuple(row[:len(PARAMS)]), []).append(row[len(PARAMS):])
+
+  def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+  return dict((key, (median([r for r, _ in runs]), median([p for _, p in runs]), len(runs)))
+              for key, runs in by_point.items())
+
+
+def compare(db, base, new, throughput_tol=THROUGHPUT_TOL, latency_tol=LATENCY_TOL):
+  """[(params, base (rate, p999, n), new (rate, p999, n), regressions)] for
+     points both builds ran
+  """
+  old, cur = summary(db, base), summary(db, new)
+  out = []
+  for key in sorted(set(old) & set(cur)):
+    (r0, l0, _), (r1, l1, _) = old[key], cur[key]
+    regressions = []
+    if r1 < (1 - throughput_tol) * r0:
+      regressions.append('throughput')
+    if l1 > (1 + latency_tol) * l0:
+      regressions.append('p999')
+    out.append((dict(zip(PARAMS, key)), old[key], cur[key], regressions))
+  return out
+
+
+def format_compare(base, new, diffs):
+  lines = ['{:<50} {:>12} {:>12} {:>8} {:>10} {:>10} {:>8}  {}'.format(
+    'point', base + ' req/s', new + ' req/s', 'change', 'p999 us', 'p999 us', 'change', '')]
+  for point, (r0, l0, _), (r1, l1, _), regressions in diffs:
+    lines.append('{:<50} {:>12.0f} {:>12.0f} {:>+7.1f}% {:>10.1f} {:>10.1f} {:>+7.1f}%  {}'.format(
+      point_name(point), r0, r1, 100.0 * (r1 - r0) / r0 if r0 else 0.0, l0, l1,
+      100.0 * (l1 - l0) / l0 if l0 else 0.0,
+      'REGRESSION: ' + ', '.join(regressions) if regressions else ''))
+  nreg = sum(1 for d in diffs if d[3])
+  lines.append('{} points compared, {} regressed'.format(len(diffs), nreg))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Run every point of a load test matrix, recording results in a SQLite
+    database under a build label, or compare two builds already recorded.
+    """)
+  parser.add_argument('--db', dest='db', type=str, default='sweep.db', help='result database')
+  parser.add_argument('--matrix', dest='matrix', type=str, default=None, help='json object of parameter lists, see MATRIX')
+  parser.add_argument('--build', dest='build', type=str, default=None, help='label the results are recorded under, e.g. a release')
+  parser.add_argument('--bin_path', dest='bin_path', type=str, default=None, help='folder with the pelikan_<engine> binaries of that build')
+  parser.add_argument('--target', dest='target', type=str, default=None, help='host the servers run on (over ssh), default is this one')
+  parser.add_argument('--pmem_paths', dest='pmem_paths', nargs='*', default=[], help='pmem mount points, for pmem points')
+  parser.add_argument('--topology', dest='topology', type=str, default=None, help='topology.py --output of --target, placements use this host\'s otherwise')
+  parser.add_argument('--workdir', dest='workdir', type=str, default='sweep', help='folder for the generated configs and server logs')
+  parser.add_argument('--duration', dest='duration', type=float, default=DURATION, help='seconds per point')
+  parser.add_argument('--repeat', dest='repeat', type=int, default=REPEAT, help='runs per point, compared by their median')
+  parser.add_argument('--compare', dest='compare', nargs=2, metavar=('BASE', 'NEW'), default=None, help='compare two recorded builds instead of running')
+  parser.add_argument('--throughput_tol', dest='throughput_tol', type=float, default=THROUGHPUT_TOL, help='relative throughput drop flagged as a regression')
+  parser.add_argument('--latency_tol', dest='latency_tol', type=float, default=LATENCY_TOL, help='relative p999 rise flagged as a regression')
+
+  args = parser.parse_args()
+
+  db = connect(args.db)
+  if args.compare:
+    diffs = compare(db, args.compare[0], args.compare[1], args.throughput_tol, args.latency_tol)
+    print(format_compare(args.compare[0], args.compare[1], diffs))
+    sys.exit(1 if any(d[3] for d in diffs) else 0)
+  if not args.build or not args.bin_path:
+    parser.error('--build and --bin_path are required to run a sweep')
+  args.workdir = os.path.abspath(os.path.join(args.workdir, args.build))
+  args.bin_path = os.path.abspath(args.bin_path)
+  args.topo = topology.load(args.topology) if args.topology else None
+  sweep(db, load_matrix(args.matrix), args)
@@ -0,0 +1,221 @@
+"""CPU and NUMA topology of a Linux host, and instance placement on it.
+
+discover() reads which cpus each NUMA node has (/sys/devices/system/node),
+which cpus are hyperthreads of the same physical core
+(/sys/devices/system/cpu/cpu*/topology) and how many device interrupts each
+cpu has handled (/proc/interrupts): only numbered IRQ lines count, not the
+local timer, rescheduling, function call or TLB shootdown lines, and of those
+only the NIC and NVMe queues' (DEVICE_IRQ) if the host has any. place() turns
+that into cpus for every instance:
+on the node it is asked for, either one share of the node or dedicated
+physical cores with all their hyperthread siblings, never on the cores of
+each node that handle the most interrupts.
+
+A topology can be saved as JSON on the host the servers run on and loaded
+where the configs are generated.
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import itertools
+import json
+import os
+import re
+
+
+SYS_PATH = '/sys/devices/system'
+BLOCK_PATH = '/sys/dev/block'
+INTERRUPTS = '/proc/interrupts'
+IRQ_CORES = 1  # physical cores per node left to interrupt handling
+re_node = re.compile(r'node(\d+)$')
+re_cpu = re.compile(r'CPU(\d+)')
+# names of NIC and NVMe queue IRQs, the ones a cache server competes with
+DEVICE_IRQ = re.compile(r'nvme|eth|en[ops]\d|ib\d|mlx|ixgbe|i40e|bnxt|virtio\d+-(input|output)|TxRx')
+
+
+def parse_cpulist(text):
+  """set of cpus from a kernel cpulist, e.g. 0-3,8,10-11"""
+  cpus = set()
+  for part in text.strip().split(','):
+    if not part:
+      continue
+    low, _, high = part.partition('-')
+    cpus.update(range(int(low), int(high or low) + 1))
+  return cpus
+
+
+def format_cpulist(cpus):
+  """inverse of parse_cpulist, with ranges collapsed"""
+  ranges = []
+  for cpu in sorted(cpus):
+    if ranges and cpu == ranges[-1][1] + 1:
+      ranges[-1][1] = cpu
+    else:
+      ranges.append([cpu, cpu])
+  return ','.join(str(low) if low == high else '{}-{}'.format(low, high) for low, high in ranges)
+
+
+def read_cpulist(fname):
+  with open(fname) as f:
+    return parse_cpulist(f.read())
+
+
+def read_interrupts(fname=INTERRUPTS, devices=DEVICE_IRQ):
+  """{cpu: device interrupts handled since boot}, empty if unreadable: the
+     numbered IRQs named like devices, or all numbered IRQs if none is
+  """
+  rows = []
+  try:
+    with open(fname) as f:
+      cpus = [int(c) for c in re_cpu.findall(f.readline())]
+      for line in f:
+        fields = line.split()
+        if not fields or not fields[0].rstrip(':').isdigit():  # LOC, RES, CAL, TLB, ...
+          continue
+        counts = [int(field) for field in
+                  itertools.takewhile(str.isdigit, fields[1:1 + len(cpus)])]
+        rows.append((' '.join(fields[1 + len(counts):]), counts))
+  except IOError:
+    pass
+  named = [row for row in rows if devices.search(row[0])]
+  counts = {}
+  for _, row in named or rows:
+    for cpu, count in zip(cpus, row):
+      counts[cpu] = counts.get(cpu, 0) + count
+  return counts
+
+
+def discover(sys_path=SYS_PATH, interrupts=INTERRUPTS):
+  """{'nodes': {node: [cpu]}, 'cores': [[cpu]], 'interrupts': {cpu: count}};
+     every entry of cores is one physical core, its hyperthreads together
+  """
+  online = read_cpulist(os.path.join(sys_path, 'cpu', 'online'))
+  nodes = {}
+  for path in glob.glob(os.path.join(sys_path, 'node', 'node*')):
+    m = re_node.search(path)
+    if m:
+      cpus = read_cpulist(os.path.join(path, 'cpulist')) & online
+      if cpus:
+        nodes[int(m.group(1))] = sorted(cpus)
+  if not nodes:  # kernel without NUMA
+    nodes[0] = sorted(online)
+  cores = {}
+  for cpu in online:
+    fname = os.path.join(sys_path, 'cpu', 'cpu{}'.format(cpu), 'topology', 'thread_siblings_list')
+    try:
+      siblings = read_cpulist(fname) & online
+    except IOError:
+      siblings = set([cpu])
+    cores[min(siblings)] = sorted(siblings)
+  return {'nodes': nodes, 'cores': [cores[c] for c in sorted(cores)],
+          'interrupts': read_interrupts(interrupts)}
+
+
+def save(topo, fname):
+  with open(fname, 'w') as f:
+    json.dump(topo, f, indent=2, sort_keys=True)
+
+
+def load(fname):
+  with open(fname) as f:
+    topo = json.load(f)
+  topo['nodes'] = dict((int(node), cpus) for node, cpus in topo['nodes'].items())
+  topo['interrupts'] = dict((int(cpu), n) for cpu, n in topo.get('interrupts', {}).items())
+  return topo
+
+
+def node_cores(topo):
+  """{node: [core]}, a core belonging to the node of its first cpu"""
+  node_of = dict((cpu, node) for node, cpus in topo['nodes'].items() for cpu in cpus)
+  out = dict((node, []) for node in topo['nodes'])
+  for core in topo['cores']:
+    if core[0] in node_of:
+      out[node_of[core[0]]].append(core)
+  return out
+
+
+def irq_cores(topo, per_node=IRQ_CORES):
+  """the per_node cores of each node handling the most interrupts (the lowest
+     numbered when there are no counts), never all of a node's cores
+  """
+  irq = topo.get('interrupts', {})
+  reserved = []
+  for node, cores in node_cores(topo).items():
+    if len(cores) > per_node:
+      ranked = sorted(cores, key=lambda core: (-sum(irq.get(cpu, 0) for cpu in core), core[0]))
+      reserved.extend(ranked[:per_node])
+  return reserved
+
+
+def path_node(path, block_path=BLOCK_PATH):
+  """NUMA node of the block device (e.g. /dev/pmem0) a path is on, None if the
+     device doesn't say
+  """
+  try:
+    dev = os.stat(path).st_dev
+  except OSError:
+    return None
+  sysdev = os.path.realpath(os.path.join(block_path, '{}:{}'.format(os.major(dev), os.minor(dev))))
+  for d in [sysdev, os.path.dirname(sysdev)]:  # a partition's device is its disk's
+    try:
+      with open(os.path.join(d, 'device', 'numa_node')) as f:
+        node = int(f.read())
+      return node if node >= 0 else None
+    except (IOError, ValueError):
+      continue
+  return None
+
+
+def place(topo, nodes, cores_per_instance=0, irq_per_node=IRQ_CORES):
+  """cpus for instances on the given nodes, one node per instance. With
+     cores_per_instance, each instance gets that many physical cores of its
+     node to itself, hyperthreads included; otherwise every instance may use
+     all of its node. Cores handling interrupts are left out either way
+  """
+  reserved = set(cpu for core in irq_cores(topo, irq_per_node) for cpu in core)
+  free = dict((node, [core for core in cores if core[0] not in reserved])
+              for node, cores in node_cores(topo).items())
+  placement = []
+  for i, node in enumerate(nodes):
+    if node not in free:
+      raise ValueError('instance {} placed on node {}, which has no cpus'.format(i, node))
+    if cores_per_instance:
+      if len(free[node]) < cores_per_instance:
+        raise ValueError('node {} is out of physical cores for instance {} ({} per instance, {} '
+                         'per node left to interrupts)'.format(node, i, cores_per_instance,
+                                                               irq_per_node))
+      cores, free[node] = free[node][:cores_per_instance], free[node][cores_per_instance:]
+    else:
+      cores = free[node]
+    placement.append(sorted(cpu for core in cores for cpu in core))
+  return placement
+
+
+def format_topology(topo, irq_per_node=IRQ_CORES):
+  reserved = set(cpu for core in irq_cores(topo, irq_per_node) for cpu in core)
+  lines = []
+  for node, cores in sorted(node_cores(topo).items()):
+    lines.append('node {}: {} physical cores, cpus {}'.format(
+      node, len(cores), format_cpulist(topo['nodes'][node])))
+    for core in cores:
+      lines.append('  core {:<12} {:>12} interrupts{}'.format(
+        format_cpulist(core), sum(topo['interrupts'].get(cpu, 0) for cpu in core),
+        ' (left to interrupts)' if core[0] in reserved else ''))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Print the NUMA nodes, physical cores and interrupt load of this host, and
+    optionally save them for server_config.py --topology on another host.
+    """)
+  parser.add_argument('--output', dest='output', type=str, default=None, help='save the topology to this JSON file')
+  parser.add_argument('--irq_cores', dest='irq_cores', type=int, default=IRQ_CORES, help='physical cores per node left to interrupt handling')
+
+  args = parser.parse_args()
+
+  topo = discover()
+  print(format_topology(topo, args.irq_cores))
+  if args.output:
+    save(topo, args.output)
@@ -0,0 +1,348 @@
+"""Warm pelikan instances up with a realistic key set instead of the built-in
+prefill, which fills the heap with uniform items of one size.
+
+Every instance is warmed in its own process, in two stages:
+
+  load    each key of the key set is `set` once, in bulk over --connections
+          pipelined connections (--depth requests per write)
+  settle  gets follow the key distribution and whatever misses is set, as a
+          cache-aside client would, until the mean hit ratio of the last
+          STEADY_WINDOWS windows of --window gets is within --tolerance of
+          that of the STEADY_WINDOWS windows before
+
+The key set comes from a klog trace (--klog: its keys, loaded in the order
+they were last accessed, with value sizes from the stores or from the
+response length of hits, read back in the order of the trace's gets), or is
+--nkey keys named like loadgen.py's, with value sizes drawn from --vsize and
+read back following a Zipf distribution (--alpha).
+
+Reported per instance are the load throughput, and how long and how many gets
+it took to reach the steady-state hit ratio. Generate the server configs with
+server_config.py --no_prefill so the instances start out empty.
+
+Requires numpy.
+"""
+
+from __future__ import print_function
+from array import array
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../test/integration'))
+from client import DataClient
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../klog'))
+import klog
+
+import client_config
+
+
+CONNECTIONS = 4  # per instance
+DEPTH = 16  # requests per connection per round trip, as loadgen.PIPELINE_DEPTH
+ALPHA = 1.0
+VSIZE_DIST = 'lognormal:{}:1.0'.format(client_config.VSIZE)
+WINDOW = 10000  # gets per hit ratio sample
+STEADY_WINDOWS = 5
+TOLERANCE = 0.005  # change in mean hit ratio between consecutive STEADY_WINDOWS windows
+SETTLE_TIMEOUT = 300  # in seconds
+# fits one server read buffer (buf_init_size in server_config.py, less its
+# header): sets pipelined past the end of it come out misparsed
+BATCH_BYTES = 4000
+REQUEST_TIMEOUT = 10.0  # in seconds, a deep pipeline of large sets takes a while
+SEED = 0
+VALUE_LINE = len(b'VALUE ') + len(b' 0 ') + 2 * len(DataClient.DELIM)  # besides key, vlen and data
+
+
+def parse_sizes(spec):
+  """value size sampler (rng, n) -> sizes, from 'lognormal:MEDIAN:SIGMA' or
+     'SIZE:WEIGHT,SIZE:WEIGHT,...'
+  """
+  if spec.startswith('lognormal:'):
+    _, median, sigma = spec.split(':')
+    return lambda rng, n: np.maximum(
+      1, rng.lognormal(np.log(float(median)), float(sigma), n)).astype(np.int64)
+  pairs = [part.split(':') for part in spec.split(',')]
+  sizes = np.array([int(p[0]) for p in pairs], dtype=np.int64)
+  weights = np.array([float(p[1]) if len(p) > 1 else 1.0 for p in pairs])
+  return lambda rng, n: rng.choice(sizes, n, p=weights / weights.sum())
+
+
+def hit_vlen(rec):
+  """value length of a klog get hit, from its response length (assumes no
+     flags, as the load testing configs use)
+  """
+  rest = rec.rsp_len - VALUE_LINE - len(rec.key)  # vlen + digits(vlen)
+  for ndigit in range(1, 11):
+    if len(str(rest - ndigit)) == ndigit:
+      return max(0, rest - ndigit)
+  return 0
+
+
+class KeySet(object):
+  """keys by dense id, each with a value size, the order to load them in, and
+     draw(n): the ids of the next n gets
+  """
+
+  def __init__(self, vlen, load_order, draw, names=None, ksize=client_config.KSIZE):
+    self.vlen = vlen
+    self.load_order = load_order
+    self.draw = draw
+    self.names = names
+    self.ksize = ksize
+    self.pad = memoryview(b'x' * int(max(vlen) if len(vlen) else 0))
+
+
+  def key(self, i):
+    if self.names is not None:
+      return self.names[i]
+    return b'%0*d' % (self.ksize, i)  # as loadgen.Workload.key()
+
+
+  def set_request(self, i):
+    n = int(self.vlen[i])
+    return [b'set ' + self.key(i) + b' 0 0 ' + str(n).encode(), self.pad[:n]]
+
+
+  def get_request(self, i):
+    return [b'get ' + self.key(i)]
+
+
+def synthetic(nkey, alpha=ALPHA, vsize=VSIZE_DIST, ksize=client_config.KSIZE, seed=SEED):
+  """nkey keys loaded in random order and read following Zipf(alpha)"""
+  rng = np.random.default_rng(seed)
+  cdf = np.cumsum(1.0 / np.arange(1, nkey + 1) ** alpha)
+  cdf /= cdf[-1]
+  perm = rng.permutation(nkey)  # so popularity is not correlated with key id
+  vlen = parse_sizes(vsize)(rng, nkey)
+
+  def draw(n):
+    return perm[np.minimum(np.searchsorted(cdf, rng.random(n)), nkey - 1)]
+
+  return KeySet(vlen, rng.permutation(nkey), draw, ksize=ksize)
+
+
+def from_klog(fnames, seed=SEED):
+  """the keys of a klog, loaded least recently accessed first and read in
+     the order of the trace's gets, over and over
+  """
+  ids = {}
+  names, vlen, last = [], array('q'), array('q')
+  gets = array('q')
+  for n, rec in enumerate(klog.records(fnames)):
+    if rec.cmd in klog.DELTA or rec.cmd == b'delete':
+      continue
+    i = ids.get(rec.key)
+    if i is None:
+      i = ids[rec.key] = len(names)
+      names.append(rec.key)
+      vlen.append(0)
+      last.append(0)
+    if rec.vlen is not None:
+      vlen[i] = rec.vlen
+    elif klog.is_hit(rec):
+      vlen[i] = hit_vlen(rec)
+    if rec.cmd in klog.RETRIEVAL:
+      gets.append(i)
+    last[i] = n
+  if not names:
+    raise ValueError('no keys in {}'.format(', '.join(fnames)))
+  vlen = np.frombuffer(vlen, dtype=np.int64).copy()
+  known = vlen[vlen > 0]
+  vlen[vlen == 0] = int(np.median(known)) if len(known) else client_config.VSIZE  # only missed
+  gets = np.frombuffer(gets, dtype=np.int64) if len(gets) else \
+    np.random.default_rng(seed).permutation(len(names))
+  pos = [0]
+
+  def draw(n):
+    idx = (pos[0] + np.arange(n)) % len(gets)
+    pos[0] = (pos[0] + n) % len(gets)
+    return gets[idx]
+
+  return KeySet(vlen, np.argsort(np.frombuffer(last, dtype=np.int64), kind='stable'), draw, names)
+
+
+def key_set(spec):
+  if spec.get('klog'):
+    return from_klog(spec['klog'], spec['seed'])
+  return synthetic(spec['nkey'], spec['alpha'], spec['vsize'], spec['ksize'], spec['seed'])
+
+
+def request_size(req):
+  return sum(len(line) + len(DataClient.DELIM) for line in req)
+
+
+def round_trip(clients, batches, max_bytes=BATCH_BYTES):
+  """pipeline every connection's batch, then read all the responses, so all
+     connections have requests in flight at once; a batch goes out in writes
+     of at most max_bytes (a larger request on its own)
+  """
+  rsps = [[] for _ in clients]
+  pending = list(batches)
+  while any(pending):
+    sent = []
+    for client, batch in zip(clients, pending):
+      n = size = 0
+      while n < len(batch) and (n == 0 or size + request_size(batch[n]) <= max_bytes):
+        size += request_size(batch[n])
+        n += 1
+      if n:
+        client.pipeline(batch[:n])
+      sent.append(n)
+    for j, (client, n) in enumerate(zip(clients, sent)):
+      if n:
+        rsps[j].extend(client.responses(n))
+        pending[j] = pending[j][n:]
+  return rsps
+
+
+def stripe(ids, n):
+  """ids dealt round robin over n connections"""
+  return [ids[c::n] for c in range(n)]
+
+
+def load(clients, keys, depth=DEPTH):
+  """set every key once, in load order"""
+  stored = errors = 0
+  step = len(clients) * depth
+  start = time.monotonic()
+  for pos in range(0, len(keys.load_order), step):
+    stripes = stripe(keys.load_order[pos:pos + step], len(clients))
+    rsps = round_trip(clients, [[keys.set_request(i) for i in ids] for ids in stripes])
+    for rs in rsps:
+      for rsp in rs:
+        if rsp[0] == b'STORED':
+          stored += 1
+        else:  # e.g. SERVER_ERROR for values larger than a slab
+          errors += 1
+  elapsed = time.monotonic() - start
+  nbyte = int(keys.vlen[keys.load_order].sum())
+  return {'keys': len(keys.load_order), 'stored': stored, 'errors': errors, 'bytes': nbyte,
+          'elapsed': elapsed, 'rate': stored / elapsed if elapsed else 0.0,
+          'bandwidth': nbyte / elapsed if elapsed else 0.0}
+
+
+def steady(ratios, windows=STEADY_WINDOWS, tolerance=TOLERANCE):
+  """whether the mean of the last windows hit ratios is within tolerance of
+     that of the windows before; means, as single windows are noisy
+  """
+  if len(ratios) < 2 * windows:
+    return False
+  return abs(np.mean(ratios[-windows:]) - np.mean(ratios[-2 * windows:-windows])) <= tolerance
+
+
+def settle(clients, keys, depth=DEPTH, window=WINDOW, windows=STEADY_WINDOWS,
+           tolerance=TOLERANCE, timeout=SETTLE_TIMEOUT):
+  """get following the key distribution, filling misses, until the hit ratio
+     is steady or timeout; samples are (seconds since start, hit ratio)
+  """
+  step = len(clients) * depth
+  samples = []
+  requests = win_requests = win_hits = 0
+  start = time.monotonic()
+  while time.monotonic() - start < timeout:
+    stripes = stripe(keys.draw(step), len(clients))
+    rsps = round_trip(clients, [[keys.get_request(i) for i in ids] for ids in stripes])
+    misses = []
+    for ids, rs in zip(stripes, rsps):
+      for i, rsp in zip(ids, rs):
+        if len(rsp) > 1:  # VALUE, data, END
+          win_hits += 1
+        else:
+          misses.append(i)
+    if misses:
+      round_trip(clients, [[keys.set_request(i) for i in ids]
+                           for ids in stripe(misses, len(clients))])
+    requests += step
+    win_requests += step
+    if win_requests >= window:
+      samples.append((time.monotonic() - start, 1.0 * win_hits / win_requests))
+      win_requests = win_hits = 0
+      if steady([r for _, r in samples], windows, tolerance):
+        break
+  ratios = [r for _, r in samples]
+  done = bool(steady(ratios, windows, tolerance))
+  return {'steady': done, 'elapsed': samples[-1][0] if samples else time.monotonic() - start,
+          'requests': requests, 'hit_ratio': float(np.mean(ratios[-windows:])) if ratios else None,
+          'samples': samples}
+
+
+def warm(endpoint, spec, connections=CONNECTIONS, depth=DEPTH, window=WINDOW,
+         windows=STEADY_WINDOWS, tolerance=TOLERANCE, timeout=SETTLE_TIMEOUT):
+  """entry point for one worker process: load then settle one instance"""
+  keys = key_set(spec)
+  clients = [DataClient(endpoint, request_timeout=REQUEST_TIMEOUT) for _ in range(connections)]
+  try:
+    result = {'endpoint': list(endpoint), 'load': load(clients, keys, depth)}
+    result['settle'] = settle(clients, keys, depth, window, windows, tolerance, timeout)
+  finally:
+    for client in clients:
+      client.close()
+  return result
+
+
+def warm_all(endpoints, spec, **kwargs):
+  """warm every instance in parallel, one process each"""
+  if len(endpoints) == 1:
+    return [warm(endpoints[0], spec, **kwargs)]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=len(endpoints)) as pool:
+    futures = [pool.submit(warm, endpoint, spec, **kwargs) for endpoint in endpoints]
+    return [f.result() for f in futures]
+
+
+def format_results(results):
+  lines = ['{:<22} {:>10} {:>8} {:>9} {:>11} {:>9} {:>10} {:>11} {:>10}'.format(
+    'instance', 'stored', 'errors', 'load s', 'sets/s', 'MB/s', 'settle s', 'gets', 'hit ratio')]
+  for r in results:
+    load_, settle_ = r['load'], r['settle']
+    lines.append('{:<22} {:>10} {:>8} {:>9.2f} {:>11.0f} {:>9.1f} {:>10} {:>11} {:>10}'.format(
+      '{}:{}'.format(*r['endpoint']), load_['stored'], load_['errors'], load_['elapsed'],
+      load_['rate'], load_['bandwidth'] / 1e6,
+      '{:.1f}'.format(settle_['elapsed']) if settle_['steady'] else 'not yet',
+      settle_['requests'],
+      '-' if settle_['hit_ratio'] is None else '{:.4f}'.format(settle_['hit_ratio'])))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="""
+    Bulk-load pelikan instances on consecutive ports with the keys of a klog
+    trace or a Zipf key set, in parallel, then read them back until the hit
+    ratio settles, and report load throughput and time to steady state.
+    """)
+  parser.add_argument('--server_ip', dest='server_ip', type=str, default='127.0.0.1', help='server ip')
+  parser.add_argument('--port', dest='port', type=int, default=client_config.PELIKAN_SERVER_PORT, help='port of the first instance')
+  parser.add_argument('--instances', dest='instances', type=int, default=client_config.INSTANCES, help='number of instances')
+  parser.add_argument('--klog', dest='klog', nargs='*', default=[], help='klog files to take keys and sizes from, oldest first')
+  parser.add_argument('--nkey', dest='nkey', type=int, default=None, help='keys without --klog, defaults to what fits in --slab_mem at the median value size')
+  parser.add_argument('--slab_mem', dest='slab_mem', type=int, default=client_config.PELIKAN_SLAB_MEM, help='slab memory, determines the default key count')
+  parser.add_argument('--alpha', dest='alpha', type=float, default=ALPHA, help='Zipf exponent of the gets without --klog')
+  parser.add_argument('--vsize', dest='vsize', type=str, default=VSIZE_DIST, help='value sizes without --klog, lognormal:MEDIAN:SIGMA or SIZE:WEIGHT,...')
+  parser.add_argument('--connections', dest='connections', type=int, default=CONNECTIONS, help='connections per instance')
+  parser.add_argument('--depth', dest='depth', type=int, default=DEPTH, help='requests pipelined per connection')
+  parser.add_argument('--window', dest='window', type=int, default=WINDOW, help='gets per hit ratio sample')
+  parser.add_argument('--tolerance', dest='tolerance', type=float, default=TOLERANCE, help='change in mean hit ratio between consecutive groups of {} windows that counts as steady'.format(STEADY_WINDOWS))
+  parser.add_argument('--timeout', dest='timeout', type=float, default=SETTLE_TIMEOUT, help='longest to wait for a steady hit ratio, in seconds')
+  parser.add_argument('--seed', dest='seed', type=int, default=SEED, help='random seed')
+  parser.add_argument('--output', dest='output', type=str, default=None, help='also write the results, with hit ratio samples, as JSON')
+
+  args = parser.parse_args()
+
+  nkey = args.nkey
+  if nkey is None and not args.klog:
+    median = int(np.median(parse_sizes(args.vsize)(np.random.default_rng(args.seed), 10001)))
+    nkey = client_config.keyspace(median, args.slab_mem)['nkey']
+  spec = {'klog': args.klog, 'nkey': nkey, 'alpha': args.alpha, 'vsize': args.vsize,
+          'ksize': client_config.KSIZE, 'seed': args.seed}
+  endpoints = [(args.server_ip, args.port + i) for i in range(args.instances)]
+  results = warm_all(endpoints, spec, connections=args.connections, depth=args.depth,
+                     window=args.window, tolerance=args.tolerance, timeout=args.timeout)
+  print(format_results(results))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -1,4 +1,5 @@
 from client import DataClient, AdminClient
+import codec
 from loader import load_seq
 from server import PelikanServer
 
@@ -6,23 +7,27 @@ import unittest
 
 DEFAULT_SERVER = ('localhost', 12321)
 DEFAULT_ADMIN = ('localhost', 9999)
+PROTOCOL = {'pelikan_rds': codec.RESP}  # memcache framing otherwise, which also fits ping
 
 class GenericTest(unittest.TestCase):
-  def __init__(self, binary_name):
-    """initialize based on what server to run the tests against"""
+  def __init__(self, binary_name, config=None):
+    """initialize based on what server to run the tests against, and the
+    config to run it with (default ports if None)"""
 
     if binary_name not in PelikanServer.SUPPORTED_SERVER:
       raise ValueError('{} is not a valid server binary'.format({binary_name}))
     super(GenericTest, self).__init__()
     self.name = binary_name
+    self.config = config
 
 
   def setUp(self):
     print('setting up {}'.format(self.name))
-    self.server = PelikanServer(self.name)
+    self.server = PelikanServer(self.name, self.config)
     self.server.ready()
-    self.data_client = DataClient(DEFAULT_SERVER)
-    self.admin_client = AdminClient(DEFAULT_ADMIN)
+    self.data_client = DataClient((DEFAULT_SERVER[0], self.server.server_port),
+                                  protocol=PROTOCOL.get(self.name, codec.MEMCACHE))
+    self.admin_client = AdminClient((DEFAULT_ADMIN[0], self.server.admin_port))
     self.stats = self.admin_client.stats()
 
 
@@ -41,10 +46,13 @@ class GenericTest(unittest.TestCase):
 
 
   def assertResponse(self, expected):
-    """receive and verify response (a list) matches expectation"""
+    """receive and verify response (a list) matches expectation; a command
+    may get more than one response, e.g. a multi-line request"""
 
     if len(expected) > 0:
-      rsp = self.data_client.response()
+      rsp = []
+      while len(rsp) < len(expected):
+        rsp.extend(self.data_client.response())
       self.assertEqual(rsp, expected, "expecting response '{}', received '{}'".format(expected, rsp))
 
 
@@ -1,7 +1,12 @@
 import errno
+import select
 import socket
 import unittest
 
+import codec
+
+IOV_MAX = 1024  # buffers per sendmsg, the Linux limit
+
 # implementation based on pymemcache: https://pypi.python.org/pypi/pymemcache
 
 class TCPClient(object):
@@ -43,28 +48,31 @@ class TCPClient(object):
 
   def recvall(self):
     """recv until no data outstanding on the socket"""
+    # block (up to request_timeout) for the first segment instead of spinning
+    # on EAGAIN, then drain whatever else is already buffered
+    readable, _, _ = select.select([self.sock], [], [], self.request_timeout)
+    if not readable:
+      raise socket.timeout('no response within {}s'.format(self.request_timeout))
     self.sock.setblocking(False)
-    data = ''
+    segs = []
     while True:
       try:
         seg = self.sock.recv(self.recv_size)
-        if seg == '':
+        if not seg:
           self.close()
-        else:
-          data += seg
+          break
+        segs.append(seg)
       except (IOError, socket.error) as e:
         err = e.args[0]
         if err == errno.EINTR:
           continue
         if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-          if len(data) == 0:
-            continue
-          else:
-            break
+          break
         else:
           raise
-    self.sock.setblocking(True)
-    return data
+    if self.sock is not None:
+      self.sock.setblocking(True)
+    return b''.join(segs)
 
 
   def send(self, data):
@@ -79,41 +87,175 @@ class TCPClient(object):
 
 
 class DataClient(TCPClient):
-    DELIM = '\r\n'
+  DELIM = codec.DELIM.decode()
+  WBUF_SIZE = codec.COPY_MAX
+  RBUF_SIZE = 64 * 1024
+  RETRIEVAL = codec.RETRIEVAL
+  RETRIEVAL_END = codec.RETRIEVAL_END
+
+
+  def __init__(self, server, *args, protocol=codec.MEMCACHE, **kwargs):
+    """protocol is codec.MEMCACHE or codec.RESP, it decides how responses
+    are framed"""
+    self.frame = codec.FRAMERS[protocol]
+    self.encoder = codec.Encoder(DataClient.WBUF_SIZE)
+    self.rbuf = bytearray(DataClient.RBUF_SIZE)
+    self.rview = memoryview(self.rbuf)
+    self.rpos = 0  # start of unconsumed data in rbuf
+    self.rend = 0  # end of valid data in rbuf
+    super(DataClient, self).__init__(server, *args, **kwargs)
+
+
+  def connect(self):
+    """(re)connect, discarding any partially framed response"""
+    self.rpos = self.rend = 0
+    super(DataClient, self).connect()
+
+
+  def request(self, req):
+    """send a (multi-line) request, req should be of a sequence type"""
+    self.pipeline([req])
 
-    def request(self, req):
-      """send a (multi-line) request, req should be of a sequence type"""
-      for line in req:
-        self.send(line + DataClient.DELIM)
 
+  def response(self):
+    """receive one response, a list of lines (bytes, delimiter stripped)"""
+    return self.next_response()
 
-    def response(self):
-      """receive a response, which will be split by delimiter (retained)"""
-      buf = self.recvall()
-      rsp = buf.split(DataClient.DELIM)
-      if rsp[-1] == '':
-        rsp.pop()
-      else:
-        raise Exception("response not terminated by " + DataClient.DELIM)
-      return rsp
+
+  # requests are coalesced into one write out of a reused buffer (large values
+  # are written in place), and responses are framed by protocol syntax/length
+  # rather than by waiting for the socket to go quiet, so many requests can be
+  # in flight
+
+  def pipeline(self, reqs):
+    """send a batch of (multi-line) requests with as few writes as possible"""
+    for req in reqs:
+      self.encoder.add(req)
+    try:
+      self.sendv(self.encoder.buffers(memoryview(self.encoder.buf)))
+    finally:  # the views are gone by now, so the buffer may grow again
+      self.encoder.reset()
+
+
+  def sendv(self, buffers):
+    """send buffers in order with vectored writes, until all are sent"""
+    if not self.sock:
+      self.connect()
+    try:
+      pending = [memoryview(b).cast('B') for b in buffers if len(b)]
+      while pending:
+        sent = self.sock.sendmsg(pending[:IOV_MAX])
+        while pending and sent >= len(pending[0]):
+          sent -= len(pending[0])
+          pending.pop(0)
+        if sent:
+          pending[0] = pending[0][sent:]
+    except Exception:
+      self.close()
+      raise
+
+
+  def responses(self, count):
+    """receive count responses, each a list of lines (delimiter stripped)"""
+    return [self.next_response() for _ in range(count)]
+
+
+  def request_pipelined(self, reqs):
+    """send all requests at once and return their responses in order"""
+    self.pipeline(reqs)
+    return self.responses(len(reqs))
+
+
+  def next_response(self):
+    """frame exactly one response off the socket"""
+    while True:
+      rsp, pos = self.frame(self.rbuf, self.rpos, self.rend)
+      if rsp is not None:
+        self.rpos = pos
+        return rsp
+      self._fill(pos - self.rpos)
+
+
+  def ready_responses(self, limit):
+    """frame up to limit responses without blocking: those buffered, or
+    completed by what the socket has already received"""
+    rsps = []
+    # in timeout mode every recv first waits for data, even with MSG_DONTWAIT
+    self.sock.setblocking(False)
+    try:
+      while len(rsps) < limit:
+        rsp, pos = self.frame(self.rbuf, self.rpos, self.rend)
+        if rsp is not None:
+          self.rpos = pos
+          rsps.append(rsp)
+        elif not self._fill(pos - self.rpos, block=False):
+          break
+    finally:
+      if self.sock is not None:
+        self.sock.settimeout(self.request_timeout)
+    return rsps
+
+
+  def _fill(self, need, block=True):
+    """recv_into rbuf until at least need unconsumed bytes are buffered;
+    unless block (the socket is then non-blocking), only as long as the
+    socket has data, returning whether there is enough"""
+    if self.rpos == self.rend:
+      self.rpos = self.rend = 0
+    if self.rpos + need > len(self.rbuf):  # compact, then grow if still short
+      size = self.rend - self.rpos
+      self.rbuf[:size] = bytes(self.rview[self.rpos:self.rend])
+      self.rpos, self.rend = 0, size
+      if need > len(self.rbuf):
+        self.rview.release()
+        self.rbuf.extend(bytearray(max(need, 2 * len(self.rbuf)) - len(self.rbuf)))
+        self.rview = memoryview(self.rbuf)
+    while self.rend - self.rpos < need:
+      try:
+        nbyte = self.sock.recv_into(self.rview[self.rend:])
+      except BlockingIOError:
+        return False
+      except (IOError, socket.error) as e:
+        if e.args and e.args[0] == errno.EINTR:
+          continue
+        self.close()
+        raise
+      if nbyte == 0:
+        self.close()
+        raise Exception('connection closed with partial response')
+      self.rend += nbyte
+    return True
 
 
 class AdminClient(TCPClient):
   DELIM = '\r\n'
   STATS_CMD = 'stats'
+  STATS_END = b'END\r\n'
 
 
   def stats(self):
-    self.send(AdminClient.STATS_CMD + AdminClient.DELIM)
-    buf = self.recvall()
-    rsp = buf.split(AdminClient.DELIM)
-    if rsp[-1] == '':
-      rsp.pop()
-    else:
-      raise Exception("response not terminated by " + DataClient.DELIM)
-    if rsp[-1] == 'END':
-      rsp.pop()
-    else:
-      raise Exception('ending not detected, found {} instead'.format(rsp[-1]))
-
-    return dict(line.split(' ')[1:] for line in rsp)
+    self.send((AdminClient.STATS_CMD + AdminClient.DELIM).encode())
+    segs = [self.recvall()]
+    while not segs[-1].endswith(AdminClient.STATS_END):  # reply spans segments
+      seg = self.recvall()
+      if not seg:
+        raise Exception('connection closed before stats reply ended')
+      segs.append(seg)
+    return parse_stats(b''.join(segs))
+
+
+def parse_stats(buf):
+  """turn a complete `stats` reply into a dict of metric name -> value (str)"""
+  if isinstance(buf, (bytes, bytearray)):
+    buf = buf.decode()
+  rsp = buf.split(AdminClient.DELIM)
+  if rsp[-1] == '':
+    rsp.pop()
+  else:
+    raise Exception("response not terminated by " + AdminClient.DELIM)
+  if rsp[-1] == 'END':
+    rsp.pop()
+  else:
+    raise Exception('ending not detected, found {} instead'.format(rsp[-1]))
+
+  return dict(line.split(' ')[1:] for line in rsp)
@@ -0,0 +1,203 @@
+"""Bytes-native memcache and RESP codecs.
+
+Requests are sequences of lines, each bytes or any other buffer (bytearray,
+memoryview), sent with DELIM after every line: that covers memcache (a
+command line, then the data block of a storage command) as well as RESP,
+whose sequence files spell out every element header and bulk string on a
+line of its own. Encoder coalesces small lines into one reused buffer and
+refers to large ones in place, so a multi-MB value is never copied on the
+way to the socket.
+
+Responses are framed by position out of a receive buffer, without slicing it
+until a response is complete: memcache data blocks and RESP bulk strings are
+skipped over by their advertised length, so they may hold anything, including
+DELIM, and a large value is scanned once rather than every time more of it
+arrives. A framed response is a list of lines (bytes, DELIM stripped), the
+way the test sequences spell responses out: for RESP that is every element
+header (`+OK`, `:1`, `$3`, `*2`, ...) followed, for bulk strings, by the data.
+
+Framers take (buf, pos, end) and return (lines, next_pos) when a whole
+response is buffered, otherwise (None, min_end): the smallest buffer end
+worth trying again at.
+"""
+
+DELIM = b'\r\n'
+MEMCACHE = 'memcache'
+RESP = 'resp'
+
+COPY_MAX = 64 * 1024  # in bytes, larger lines are sent in place instead of copied
+RETRIEVAL = b'VALUE '
+RETRIEVAL_END = b'END'
+
+# RESP element types (src/protocol/data/resp/token.c)
+RESP_STR = b'+'
+RESP_ERR = b'-'
+RESP_INT = b':'
+RESP_BULK = b'$'
+RESP_ARRAY = b'*'
+RESP_ATTRIB = b'|'
+RESP_NULL = b'_'
+
+
+class Encoder(object):
+  """requests -> the buffers to write: small lines are coalesced into one
+     reused bytearray, lines of COPY_MAX bytes or more are referenced as is
+  """
+
+  def __init__(self, size=COPY_MAX):
+    self.buf = bytearray(size)
+    self.n = 0
+    self.parts = []  # (start, end) of buf, or a line referenced in place
+    self.start = 0
+
+
+  def _append(self, data):
+    end = self.n + len(data)
+    if end > len(self.buf):
+      self.buf.extend(bytearray(max(end, 2 * len(self.buf)) - len(self.buf)))
+    self.buf[self.n:end] = data
+    self.n = end
+
+
+  def add(self, req):
+    for line in req:
+      if not isinstance(line, (bytes, bytearray, memoryview)):
+        line = line.encode()
+      if len(line) >= COPY_MAX:
+        if self.n > self.start:
+          self.parts.append((self.start, self.n))
+        self.parts.append(line)
+        self.start = self.n
+      else:
+        self._append(line)
+      self._append(DELIM)
+    return self
+
+
+  def buffers(self, view):
+    """the buffers to write, in order; view is memoryview(self.buf), to be
+       dropped along with them before the next add()
+    """
+    parts = self.parts + ([(self.start, self.n)] if self.n > self.start else [])
+    return [view[p[0]:p[1]] if isinstance(p, tuple) else p for p in parts]
+
+
+  def reset(self):
+    self.n = self.start = 0
+    self.parts = []
+
+
+def encode_requests(reqs, buf):
+  """serialize (multi-line) requests into buf, growing it if needed.
+
+  Returns the (possibly reallocated) buffer and the number of bytes used.
+  """
+  n = 0
+  for req in reqs:
+    for line in req:
+      if not isinstance(line, (bytes, bytearray, memoryview)):
+        line = line.encode()
+      end = n + len(line) + len(DELIM)
+      if end > len(buf):
+        buf.extend(bytearray(max(end, 2 * len(buf)) - len(buf)))
+      buf[n:n + len(line)] = line
+      buf[n + len(line):end] = DELIM
+      n = end
+  return buf, n
+
+
+def memcache_store(cmd, key, value, flag=0, expiry=0):
+  """lines of a memcache storage command; value is sent in place if large"""
+  return [b' '.join([cmd, key, str(flag).encode(), str(expiry).encode(),
+                     str(len(value)).encode()]), value]
+
+
+def resp_command(args):
+  """lines of a RESP command, an array of bulk strings; args are bytes or
+     other buffers, sent in place if large
+  """
+  lines = [RESP_ARRAY + str(len(args)).encode()]
+  for arg in args:
+    if isinstance(arg, str):
+      arg = arg.encode()
+    lines.append(RESP_BULK + str(len(arg)).encode())
+    lines.append(arg)
+  return lines
+
+
+def frame_memcache(buf, pos, end):
+  """frame one memcache response from buf[pos:end].
+
+  A retrieval response (VALUE ... <bytes>) is walked block by block, using the
+  advertised length to skip over the data, until END. Everything else is a
+  single line. Value data is returned as one element even if it contains the
+  delimiter.
+  """
+  idx = buf.find(DELIM, pos, end)
+  if idx < 0:
+    return None, end + 1
+  line = bytes(buf[pos:idx])
+  if not line.startswith(RETRIEVAL):
+    return [line], idx + len(DELIM)
+  rsp = []
+  cur = pos
+  while line.startswith(RETRIEVAL):
+    fields = line.split()
+    if len(fields) < 4:
+      raise Exception('malformed retrieval line {!r}'.format(line))
+    start = idx + len(DELIM)
+    stop = start + int(fields[3])
+    if stop + len(DELIM) > end:
+      return None, stop + len(DELIM)
+    if buf[stop:stop + len(DELIM)] != DELIM:
+      raise Exception('data block not terminated by {!r}'.format(DELIM))
+    rsp.append(line)
+    rsp.append(bytes(buf[start:stop]))
+    cur = stop + len(DELIM)
+    idx = buf.find(DELIM, cur, end)
+    if idx < 0:
+      return None, end + 1
+    line = bytes(buf[cur:idx])
+  if line != RETRIEVAL_END:
+    raise Exception('ending not detected, found {!r} instead'.format(line))
+  rsp.append(line)
+  return rsp, idx + len(DELIM)
+
+
+def frame_resp(buf, pos, end):
+  """frame one RESP response (one top-level element, with everything nested
+     in it) from buf[pos:end]. Arrays and attributes only add to the count of
+     elements still to come, so nesting needs no recursion
+  """
+  rsp = []
+  remaining = 1
+  while remaining:
+    idx = buf.find(DELIM, pos, end)
+    if idx < 0:
+      return None, end + 1
+    line = bytes(buf[pos:idx])
+    kind = line[:1]
+    pos = idx + len(DELIM)
+    remaining -= 1
+    rsp.append(line)
+    if kind == RESP_BULK:
+      n = int(line[1:])
+      if n < 0:  # nil
+        continue
+      stop = pos + n
+      if stop + len(DELIM) > end:
+        return None, stop + len(DELIM)
+      if buf[stop:stop + len(DELIM)] != DELIM:
+        raise Exception('bulk string not terminated by {!r}'.format(DELIM))
+      rsp.append(bytes(buf[pos:stop]))
+      pos = stop + len(DELIM)
+    elif kind == RESP_ARRAY:
+      remaining += max(0, int(line[1:]))  # *-1 is a nil array
+    elif kind == RESP_ATTRIB:
+      remaining += 2 * int(line[1:]) + 1  # key/value pairs, then what they annotate
+    elif kind not in (RESP_STR, RESP_ERR, RESP_INT, RESP_NULL):
+      raise Exception('unknown RESP type in {!r}'.format(line))
+  return rsp, pos
+
+
+FRAMERS = {MEMCACHE: frame_memcache, RESP: frame_resp}
@@ -4,10 +4,11 @@ from __future__ import print_function
 import re
 import sys
 
-re_empty = re.compile("^$")
-re_req = re.compile("^>>> (.+)$")
-re_rsp = re.compile("^<<< (.+)$")
-re_stat = re.compile("^\+\+\+ (.+)$")
+# sequences are read as bytes, so lines may hold any byte but a newline
+re_empty = re.compile(b"^$")
+re_req = re.compile(b"^>>> (.+)$")
+re_rsp = re.compile(b"^<<< (.+)$")
+re_stat = re.compile(rb"^\+\+\+ (.+)$")
 
 
 def split_metrics(line):
@@ -16,6 +17,8 @@ def split_metrics(line):
   'get +1, get_hit +1' -> {'get':1, 'get_hit':1}
   'request_free -1, request_parse +1' -> {'request_free':-1, 'request_parse':1}
   """
+  if isinstance(line, bytes):
+    line = line.decode()
   metrics = line.split(',')
   d = {}
   for m in metrics:
@@ -30,11 +33,12 @@ def load_seq(fname):
 
   Each command contains one or more lines of request, leading with '>>> ', and
   one or more lines of response, leading with '<<< '. Commands are separated
-  by an empty line.
+  by an empty line. Request and response lines are bytes.
   """
-  lines = open(fname).readlines()
+  with open(fname, 'rb') as f:
+    lines = f.readlines()
   if not re_empty.match(lines[-1]):  # ensure an empty line at the end
-    lines.append('\n')
+    lines.append(b'\n')
 
   seq = []
   req = []
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Run integration test sequences in parallel.
+
+Every sequence file gets a fresh server, as with test_twemcache.py, but each
+server listens on its own free data/admin port pair with a generated config,
+so sequences run concurrently across a pool of worker processes. Sequences are
+found in one folder per server binary (see SEQ_DIRS).
+"""
+
+from __future__ import print_function
+import argparse
+import concurrent.futures
+from contextlib import redirect_stdout
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from base import GenericTest
+from server import EXITED, PelikanServer
+
+SEQ_DIRS = {
+  'pelikan_pingserver': 'pingserver',
+  'pelikan_rds': 'rds',
+  'pelikan_slimcache': 'slimcache',
+  'pelikan_twemcache': 'twemcache' }
+PORT_RETRY = 3  # a port found free may be taken by the time the server binds
+
+
+def free_ports(n):
+  """n distinct ports that are free right now"""
+  socks = []
+  try:
+    for _ in range(n):
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.bind(('localhost', 0))
+      socks.append(sock)
+    return [sock.getsockname()[1] for sock in socks]
+  finally:
+    for sock in socks:
+      sock.close()
+
+
+def write_config(workdir, server_port, admin_port):
+  """config with the given ports and logs kept in workdir, returns its path"""
+  fname = os.path.join(workdir, 'server.conf')
+  with open(fname, 'w') as f:
+    f.write('server_port: {}\n'.format(server_port))
+    f.write('admin_port: {}\n'.format(admin_port))
+    f.write('debug_log_file: {}\n'.format(os.path.join(workdir, 'server.log')))
+  return fname
+
+
+def run_one(binary, fname):
+  """run one sequence against its own server, returns (ok, output, elapsed)"""
+  start = time.time()
+  workdir = tempfile.mkdtemp(prefix='pelikan-test-')
+  try:
+    for _ in range(PORT_RETRY):
+      config = write_config(workdir, *free_ports(2))
+      out = io.StringIO()
+      with redirect_stdout(out):
+        test = GenericTest(binary, config)
+        test.load(fname)
+        result = unittest.TextTestRunner(stream=out, verbosity=2).run(test)
+      if not any(EXITED in err for _, err in result.errors):
+        break
+    return result.wasSuccessful(), out.getvalue(), time.time() - start
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def collect(paths, binaries):
+  """[(binary, sequence file)] from files and folders named as in SEQ_DIRS"""
+  by_dir = dict((d, b) for b, d in SEQ_DIRS.items())
+  tests = []
+  for path in paths:
+    if os.path.isdir(path):
+      binary = by_dir.get(os.path.basename(os.path.normpath(path)))
+      files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+    else:
+      binary = by_dir.get(os.path.basename(os.path.dirname(os.path.abspath(path))))
+      files = [path]
+    if binary is None:
+      raise ValueError('cannot tell which server {} is for'.format(path))
+    if binary in binaries:
+      tests.extend((binary, f) for f in files)
+  return tests
+
+
+def run(tests, jobs, verbose=False):
+  """run tests across jobs processes, printing as they finish; True if all passed"""
+  failed = 0
+  start = time.time()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = dict((pool.submit(run_one, binary, fname), (binary, fname))
+                   for binary, fname in tests)
+    for future in concurrent.futures.as_completed(futures):
+      binary, fname = futures[future]
+      try:
+        ok, output, elapsed = future.result()
+      except Exception as e:
+        ok, output, elapsed = False, repr(e), 0.0
+      failed += not ok
+      print('{:<4} {:<20} {} ({:.2f}s)'.format('ok' if ok else 'FAIL', binary, fname, elapsed))
+      if verbose or not ok:
+        print(output)
+  print('{} sequences, {} failed, {:.2f}s with {} workers'.format(
+    len(tests), failed, time.time() - start, jobs))
+  return failed == 0
+
+
+if __name__ == '__main__':
+  here = os.path.dirname(os.path.abspath(__file__))
+  parser = argparse.ArgumentParser(description="""
+    Run integration test sequences in parallel, one isolated server per
+    sequence on free ports. Binaries are taken from PELIKAN_BIN_PATH.
+    """)
+  parser.add_argument('paths', nargs='*', help='sequence files or folders, defaults to every folder in SEQ_DIRS')
+  parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count(), help='worker processes')
+  parser.add_argument('--binary', dest='binary', nargs='+', choices=PelikanServer.SUPPORTED_SERVER, default=PelikanServer.SUPPORTED_SERVER, help='only run sequences for these servers')
+  parser.add_argument('--verbose', '-v', dest='verbose', action='store_true', help='print output of passing sequences too')
+
+  args = parser.parse_args()
+
+  paths = args.paths or [os.path.join(here, d) for d in sorted(SEQ_DIRS.values())
+                         if os.path.isdir(os.path.join(here, d))]
+  tests = collect(paths, args.binary)
+  sys.exit(0 if run(tests, max(1, args.jobs), args.verbose) else 1)
@@ -1,9 +1,69 @@
+from __future__ import print_function
+import argparse
 import os
+import re
 import subprocess
-#import tempfile
+import tempfile
+import time
+
+from client import AdminClient
+
+READY_TIMEOUT = 60.0  # in seconds, generous for prefaulting multi-GB heaps
+BACKOFF_MIN = 0.001  # in seconds, first retry interval of the readiness probe
+BACKOFF_MAX = 0.1
+STOP_TIMEOUT = 5.0  # in seconds, before a server that ignores SIGTERM is killed
+PREFILL_LOG_WAIT = 1.0  # in seconds, the debug log is flushed every dlog_intvl
+PID_FILE_WAIT = 5.0  # in seconds, for a daemonized server to write its pid_filename
+EXITED = 'server exited before it was ready'
+
+re_prefill = re.compile(r'prefilling \w+ with .* in ([0-9.]+) seconds')
+
+
+def wait_ready(admin, timeout=READY_TIMEOUT, alive=None):
+  """poll `stats` on the admin endpoint, backing off exponentially, until it
+  answers; returns the stats. alive, if given, is called between attempts and
+  should raise if there is no point in waiting any longer."""
+  deadline = time.time() + timeout
+  delay = BACKOFF_MIN
+  while True:
+    try:
+      client = AdminClient(admin)
+      try:
+        return client.stats()
+      finally:
+        client.close()
+    except Exception:
+      if time.time() + delay > deadline:
+        raise Exception('{}:{} not ready after {}s'.format(admin[0], admin[1], timeout))
+    if alive is not None:
+      alive()
+    time.sleep(delay)
+    delay = min(delay * 2, BACKOFF_MAX)
+
+
+def pids_alive(pid_files, since, wait=PID_FILE_WAIT):
+  """alive check for wait_ready() on daemonized servers: raises once the
+  process of any of pid_files is gone, or a file is still missing wait seconds
+  after since (time.time()) as its server exited before writing it"""
+  for fname in pid_files:
+    try:
+      with open(fname) as f:
+        pid = int(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+      if time.time() - since > wait:
+        raise Exception('{}: no pid after {}s, {}'.format(fname, wait, EXITED))
+      continue
+    try:
+      os.kill(pid, 0)
+    except ProcessLookupError:
+      raise Exception('{}: pid {}, {}'.format(fname, pid, EXITED))
+    except PermissionError:  # e.g. started with sudo, but there
+      pass
 
 
 class PelikanServer(object):
+  DEFAULT_SERVER_PORT = 12321
+  DEFAULT_ADMIN_PORT = 9999
   SUPPORTED_SERVER = [
     'pelikan_pingserver',
     'pelikan_rds',
@@ -19,42 +79,124 @@ class PelikanServer(object):
     ))
 
 
-  def __init__(self, executable, config=None):
+  def __init__(self, executable, config=None, wrapper=None, cwd=None):
+    """wrapper is a command line prefix, e.g. numactl and its options; cwd is
+    where the server runs, which relative paths in its config are against"""
     if executable not in PelikanServer.SUPPORTED_SERVER:
       raise Exception('executable not supported')
     self.executable = executable
     self.config = config
+    self.wrapper = list(wrapper or [])
+    self.cwd = cwd
+    self.options = {}
+    self.server_port = PelikanServer.DEFAULT_SERVER_PORT
+    self.admin_port = PelikanServer.DEFAULT_ADMIN_PORT
     if config:  # server different from default
-      # TODO: find out server info from config
-      pass
+      self.load_config(config)
+    # seconds from start: 'listen' until admin stats answer (prefill, if any,
+    # is done by then), 'prefill' as reported by the server itself
+    self.startup = {}
     self.start(config)
 
 
+  def load_config(self, config):
+    """find out where the server listens from its config (`name: value` lines)"""
+    with open(config) as f:
+      for line in f:
+        name, _, value = line.partition(':')
+        if name.strip() and not name.startswith('#'):
+          self.options[name.strip()] = value.strip()
+    self.server_port = int(self.options.get('server_port', self.server_port))
+    self.admin_port = int(self.options.get('admin_port', self.admin_port))
+
+
   def start(self, config):
     executable = os.path.join(
       os.getenv('PELIKAN_BIN_PATH', PelikanServer.default_path()),
       self.executable
     )
-    exec_tup = (executable, self.config) if self.config else (executable)
+    exec_tup = self.wrapper + [executable] + ([self.config] if self.config else [])
 
+    # output goes to a file rather than a pipe nobody drains, which would
+    # eventually block a server logging to stderr
+    self.output = tempfile.TemporaryFile()
+    self.started = time.time()
     self.server = subprocess.Popen(exec_tup,
-      stdin=subprocess.PIPE,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
+      stdin=subprocess.DEVNULL,
+      stdout=self.output,
+      stderr=subprocess.STDOUT,
+      cwd=self.cwd,
     )
 
 
-  def ready(self):
-    # wait for the port to be listening; no great "ready" output present
-    # but it lists all configs, so this must exist
+  def alive(self):
+    if self.server.poll() is not None:
+      raise Exception('{} (exit code {})'.format(EXITED, self.server.returncode))
+
+
+  def ready(self, timeout=READY_TIMEOUT):
+    """wait until the server answers on its admin port, recording startup times"""
     if not self.server:
       raise Exception('server is not started')
-    line = self.server.stdout.readline()
-    while not line.decode('UTF-8').startswith(u'name: server_port'):
-      line = self.server.stdout.readline()
-      #pass
+    wait_ready(('localhost', self.admin_port), timeout, self.alive)
+    self.startup['listen'] = time.time() - self.started
+    prefill = self.prefill_time(PREFILL_LOG_WAIT if self.prefills() else 0)
+    if prefill is not None:
+      self.startup['prefill'] = prefill
     print("server is up and running")
 
 
-  def stop(self):
-    self.server.kill()
+  def prefills(self):
+    return self.options.get('prefill', 'no').lower() in ('yes', 'true', '1')
+
+
+  def prefill_time(self, wait=0):
+    """prefill duration the server logged, waiting up to wait seconds for the log"""
+    deadline = time.time() + wait
+    log_file = self.options.get('debug_log_file')
+    if log_file and self.cwd:
+      log_file = os.path.join(self.cwd, log_file)
+    while True:
+      if log_file and log_file != 'NULL' and os.path.exists(log_file):
+        with open(log_file, 'rb') as f:
+          text = f.read()
+      else:  # no log file, so it goes to stderr
+        self.output.seek(0)
+        text = self.output.read()
+      m = re_prefill.search(text.decode('UTF-8', 'replace'))
+      if m or time.time() >= deadline:
+        return float(m.group(1)) if m else None
+      time.sleep(0.05)
+
+
+  def stop(self, timeout=STOP_TIMEOUT):
+    """stop gracefully, killing the server if it doesn't exit in time, and reap it"""
+    if self.server.poll() is None:
+      self.server.terminate()
+      try:
+        self.server.wait(timeout)
+      except subprocess.TimeoutExpired:
+        self.server.kill()
+        self.server.wait()
+    self.output.close()
+    return self.server.returncode
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="""
+    Wait until pelikan instances on consecutive admin ports answer `stats`,
+    and report how long each took.
+    """)
+  parser.add_argument('--host', dest='host', type=str, default='localhost', help='server host')
+  parser.add_argument('--admin_port', dest='admin_port', type=int, default=PelikanServer.DEFAULT_ADMIN_PORT, help='admin port of the first instance')
+  parser.add_argument('--instances', dest='instances', type=int, default=1, help='number of instances')
+  parser.add_argument('--timeout', dest='timeout', type=float, default=READY_TIMEOUT, help='seconds to wait for all instances')
+  parser.add_argument('--pid_files', dest='pid_files', nargs='*', default=[], help='pid_filename of each (daemonized, local) instance, to give up as soon as one exits')
+
+  args = parser.parse_args()
+
+  start = time.time()
+  alive = (lambda: pids_alive(args.pid_files, start)) if args.pid_files else None
+  for i in range(args.instances):
+    wait_ready((args.host, args.admin_port + i), args.timeout - (time.time() - start), alive)
+    print('{}:{} ready after {:.3f}s'.format(args.host, args.admin_port + i, time.time() - start))
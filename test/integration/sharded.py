@@ -0,0 +1,195 @@
+"""Client sharding keys over several instances by consistent hashing.
+
+Servers are placed on a ketama continuum the way libketama and twemproxy
+(distribution: ketama) do it: each server gets POINTS_PER_SERVER points on a
+32-bit ring, in proportion to its weight, four per md5 of `<name>-<i>` where
+name is `host:port`. A key belongs to the first point at or after the first
+four bytes of its md5 (little-endian), wrapping around, so adding or removing
+a server only moves the keys of its own arcs.
+
+ShardedClient keeps a small pool of DataClient connections per server, opened
+on first use and taken in turn. A multiget is fanned out as one write per
+server: the keys of a server are coalesced into `get` requests of at most
+MAX_BATCH keys (the server's MAX_BATCH_SIZE), pipelined together, and the
+responses are collected from whichever server answers first.
+"""
+
+from bisect import bisect_left
+import hashlib
+import select
+import socket
+import struct
+import time
+
+from client import DataClient
+import codec
+
+POINTS_PER_SERVER = 160  # as libketama, 40 md5 digests of 4 points each
+POINTS_PER_HASH = 4
+MAX_BATCH = 100  # keys per get, MAX_BATCH_SIZE in src/protocol/data/memcache
+POOL_SIZE = 2  # connections per server
+
+
+def ketama_hash(data, alignment=0):
+  """the alignment-th little-endian 32-bit word of md5(data)"""
+  return struct.unpack_from('<I', hashlib.md5(data).digest(), 4 * alignment)[0]
+
+
+class Continuum(object):
+
+  def __init__(self, servers, weights=None):
+    """servers are (host, port), weights default to equal"""
+    if not servers:
+      raise ValueError('a continuum needs at least one server')
+    weights = list(weights) if weights else [1] * len(servers)
+    if len(weights) != len(servers) or min(weights) <= 0:
+      raise ValueError('one positive weight per server is needed')
+    total = sum(weights)
+    ring = []
+    for idx, (server, weight) in enumerate(zip(servers, weights)):
+      # the same rounding as twemproxy's ketama_update()
+      npoint = int(1.0 * weight / total * POINTS_PER_SERVER * len(servers) + 0.0000000001)
+      name = '{}:{}'.format(*server).encode()
+      for i in range(npoint // POINTS_PER_HASH):
+        digest = hashlib.md5(name + b'-' + str(i).encode()).digest()
+        ring.extend((point, idx) for point in struct.unpack('<4I', digest))
+    ring.sort()
+    self.servers = list(servers)
+    self.points = [p for p, _ in ring]
+    self.owners = [idx for _, idx in ring]
+
+
+  def index(self, key):
+    """index into servers of the server owning key (bytes)"""
+    i = bisect_left(self.points, ketama_hash(key))
+    return self.owners[i if i < len(self.points) else 0]
+
+
+  def server(self, key):
+    return self.servers[self.index(key)]
+
+
+  def shares(self):
+    """fraction of the hash space each server owns, in the order of servers"""
+    share = [0.0] * len(self.servers)
+    prev = self.points[-1] - (1 << 32)
+    for point, idx in zip(self.points, self.owners):
+      share[idx] += 1.0 * (point - prev) / (1 << 32)
+      prev = point
+    return share
+
+
+class ShardedClient(object):
+
+  def __init__(self, servers, weights=None, pool_size=POOL_SIZE, **kwargs):
+    """kwargs are passed on to every DataClient, which speaks memcache"""
+    if pool_size < 1:
+      raise ValueError('pool_size must be at least 1')
+    self.continuum = Continuum(servers, weights)
+    self.pool_size = pool_size
+    self.kwargs = kwargs
+    self.pools = [[] for _ in servers]
+    self.turn = [0] * len(servers)
+
+
+  def connection(self, idx):
+    """the next connection of the pool of server idx, opened on demand"""
+    pool = self.pools[idx]
+    i = self.turn[idx]
+    self.turn[idx] = (i + 1) % self.pool_size
+    if i == len(pool):
+      pool.append(DataClient(self.continuum.servers[idx], **self.kwargs))
+    return pool[i]
+
+
+  def close(self):
+    for pool in self.pools:
+      for conn in pool:
+        conn.close()
+    self.pools = [[] for _ in self.pools]
+    self.turn = [0] * len(self.pools)
+
+
+  def group(self, keys):
+    """{server index: [keys]}, keys in their original order"""
+    groups = {}
+    for key in keys:
+      groups.setdefault(self.continuum.index(key), []).append(key)
+    return groups
+
+
+  def request(self, key, req):
+    """send one (multi-line) request to the server of key, return its response"""
+    return self.connection(self.continuum.index(key)).request_pipelined([req])[0]
+
+
+  def set(self, key, value, flag=0, expiry=0):
+    return self.request(key, codec.memcache_store(b'set', key, value, flag, expiry))
+
+
+  def get(self, key):
+    return self.get_multi([key]).get(key)
+
+
+  def fan_out(self, groups, requests):
+    """send requests(keys) to every server of groups in one write each, then
+       collect the responses as servers answer, framing what each socket has
+       without blocking so one slow server doesn't delay the others. Returns
+       {server index: (responses, seconds until the last of them was framed)}
+    """
+    pending = {}
+    start = time.monotonic()
+    for idx, keys in groups.items():
+      conn = self.connection(idx)
+      reqs = requests(keys)
+      conn.pipeline(reqs)
+      pending[conn] = (idx, len(reqs), [])
+    results = {}
+    while pending:
+      socks = dict((c.sock, c) for c in pending)
+      readable, _, _ = select.select(list(socks), [], [],
+                                     max(c.request_timeout for c in pending))
+      if not readable:
+        raise socket.timeout('{} servers did not answer'.format(len(pending)))
+      for sock in readable:
+        conn = socks[sock]
+        idx, count, rsps = pending[conn]
+        rsps.extend(conn.ready_responses(count - len(rsps)))
+        if len(rsps) == count:
+          results[idx] = (rsps, time.monotonic() - start)
+          del pending[conn]
+    return results
+
+
+  def get_multi(self, keys, timings=None):
+    """{key: value} of the keys found. If timings (a dict) is given, it gets
+       the seconds each server involved took, by server index
+    """
+    def requests(keys):
+      return [[b'get ' + b' '.join(keys[i:i + MAX_BATCH])]
+              for i in range(0, len(keys), MAX_BATCH)]
+
+    values = {}
+    for idx, (rsps, elapsed) in self.fan_out(self.group(keys), requests).items():
+      for rsp in rsps:
+        for i in range(0, len(rsp) - 1, 2):
+          values[rsp[i].split()[1]] = rsp[i + 1]
+      if timings is not None:
+        timings[idx] = elapsed
+    return values
+
+
+  def set_multi(self, items, flag=0, expiry=0):
+    """store (key, value) pairs, pipelined per server; returns the keys that
+       were not STORED
+    """
+    values = dict(items)
+
+    def requests(keys):
+      return [codec.memcache_store(b'set', key, values[key], flag, expiry) for key in keys]
+
+    failed = []
+    groups = self.group(values)
+    for idx, (rsps, _) in self.fan_out(groups, requests).items():
+      failed.extend(key for key, rsp in zip(groups[idx], rsps) if rsp != [b'STORED'])
+    return failed
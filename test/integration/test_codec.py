@@ -0,0 +1,157 @@
+import codec
+from codec import COPY_MAX, Encoder, encode_requests, frame_memcache, frame_resp
+
+import unittest
+
+
+def frame_all(framer, data):
+  """every response framed out of data, and where framing stopped"""
+  rsps, pos = [], 0
+  while pos < len(data):
+    rsp, nxt = framer(data, pos, len(data))
+    if rsp is None:
+      break
+    rsps.append(rsp)
+    pos = nxt
+  return rsps, pos
+
+
+class FrameMemcacheTest(unittest.TestCase):
+
+  def test_line(self):
+    self.assertEqual(frame_memcache(b'STORED\r\nEND\r\n', 0, 13), ([b'STORED'], 8))
+    self.assertEqual(frame_memcache(b'STORED\r\nEND\r\n', 8, 13), ([b'END'], 13))
+
+
+  def test_partial_line(self):
+    self.assertEqual(frame_memcache(b'STOR', 0, 4), (None, 5))
+    self.assertEqual(frame_memcache(b'STORED\r', 0, 7), (None, 8))
+
+
+  def test_partial_value(self):
+    data = b'VALUE foo 0 10\r\n0123456789\r\nEND\r\n'
+    header = len(b'VALUE foo 0 10\r\n')
+    # the data block and its delimiter are needed before looking further
+    self.assertEqual(frame_memcache(data, 0, header + 3), (None, header + 12))
+    self.assertEqual(frame_memcache(data, 0, header + 11), (None, header + 12))
+    # then the line after it
+    self.assertEqual(frame_memcache(data, 0, header + 12), (None, header + 13))
+    self.assertEqual(frame_memcache(data, 0, len(data) - 1), (None, len(data)))
+    self.assertEqual(frame_memcache(data, 0, len(data)),
+                     ([b'VALUE foo 0 10', b'0123456789', b'END'], len(data)))
+
+
+  def test_value_with_delimiter(self):
+    data = b'VALUE foo 0 9\r\n\r\nEND\r\n\r\n\r\nEND\r\n'
+    self.assertEqual(frame_memcache(data, 0, len(data)),
+                     ([b'VALUE foo 0 9', b'\r\nEND\r\n\r\n', b'END'], len(data)))
+
+
+  def test_multiple_values(self):
+    data = b'VALUE a 0 1\r\nx\r\nVALUE bb 3 2\r\nyy\r\nVALUE c 0 0\r\n\r\nEND\r\nSTORED\r\n'
+    self.assertEqual(frame_all(frame_memcache, data), ([
+      [b'VALUE a 0 1', b'x', b'VALUE bb 3 2', b'yy', b'VALUE c 0 0', b'', b'END'],
+      [b'STORED']], len(data)))
+
+
+  def test_offset_into_buffer(self):
+    data = bytearray(b'garbageVALUE k 0 3\r\nabc\r\nEND\r\nmore')
+    self.assertEqual(frame_memcache(data, 7, len(data)),
+                     ([b'VALUE k 0 3', b'abc', b'END'], len(data) - 4))
+
+
+  def test_malformed(self):
+    with self.assertRaises(Exception):
+      frame_memcache(b'VALUE foo 0 3\r\nabcd\r\nEND\r\n', 0, 26)
+    with self.assertRaises(Exception):
+      frame_memcache(b'VALUE foo 0 3\r\nabc\r\nSTORED\r\n', 0, 28)
+
+
+class FrameRespTest(unittest.TestCase):
+
+  def test_simple(self):
+    data = b'+OK\r\n-ERR no\r\n:42\r\n_\r\n'
+    self.assertEqual(frame_all(frame_resp, data),
+                     ([[b'+OK'], [b'-ERR no'], [b':42'], [b'_']], len(data)))
+
+
+  def test_bulk_with_delimiter(self):
+    data = b'$5\r\na\r\n\r\n\r\n'
+    self.assertEqual(frame_resp(data, 0, len(data)), ([b'$5', b'a\r\n\r\n'], len(data)))
+
+
+  def test_partial(self):
+    data = b'*2\r\n$3\r\nfoo\r\n:1\r\n'
+    self.assertEqual(frame_resp(data, 0, 2), (None, 3))
+    self.assertEqual(frame_resp(data, 0, 9), (None, 13))  # all of foo and its delimiter
+    self.assertEqual(frame_resp(data, 0, 13), (None, 14))
+    self.assertEqual(frame_resp(data, 0, len(data)),
+                     ([b'*2', b'$3', b'foo', b':1'], len(data)))
+
+
+  def test_nil(self):
+    data = b'$-1\r\n*-1\r\n*2\r\n$-1\r\n*-1\r\n'
+    self.assertEqual(frame_all(frame_resp, data),
+                     ([[b'$-1'], [b'*-1'], [b'*2', b'$-1', b'*-1']], len(data)))
+
+
+  def test_nested(self):
+    data = b'*3\r\n*2\r\n:1\r\n*0\r\n$2\r\nab\r\n*1\r\n*1\r\n+x\r\n+next\r\n'
+    self.assertEqual(frame_all(frame_resp, data), ([
+      [b'*3', b'*2', b':1', b'*0', b'$2', b'ab', b'*1', b'*1', b'+x'],
+      [b'+next']], len(data)))
+
+
+  def test_attribute(self):
+    data = b'|1\r\n+key\r\n:7\r\n$1\r\nv\r\n'
+    self.assertEqual(frame_resp(data, 0, len(data)),
+                     ([b'|1', b'+key', b':7', b'$1', b'v'], len(data)))
+
+
+  def test_unknown_type(self):
+    with self.assertRaises(Exception):
+      frame_resp(b'?what\r\n', 0, 7)
+
+
+class EncoderTest(unittest.TestCase):
+
+  def encode(self, reqs):
+    encoder = Encoder().add(reqs[0])
+    for req in reqs[1:]:
+      encoder.add(req)
+    return encoder, encoder.buffers(memoryview(encoder.buf))
+
+
+  def test_small_lines_coalesced(self):
+    reqs = [[b'get a'], codec.memcache_store(b'set', b'b', b'xyz'), ['delete c']]
+    _, bufs = self.encode(reqs)
+    self.assertEqual(len(bufs), 1)
+    self.assertEqual(bytes(bufs[0]), b'get a\r\nset b 0 0 3\r\nxyz\r\ndelete c\r\n')
+    buf, n = encode_requests(reqs, bytearray(4))
+    self.assertEqual(bytes(buf[:n]), bytes(bufs[0]))
+
+
+  def test_large_line_in_place(self):
+    value = b'v' * COPY_MAX
+    reqs = [[b'get a'], codec.memcache_store(b'set', b'big', value), [b'get big']]
+    encoder, bufs = self.encode(reqs)
+    self.assertEqual(len(bufs), 3)
+    self.assertIs(bufs[1], value)  # referenced, not copied
+    self.assertEqual(bytes(bufs[0]), b'get a\r\nset big 0 0 %d\r\n' % COPY_MAX)
+    self.assertEqual(bytes(bufs[2]), b'\r\nget big\r\n')
+    self.assertLess(encoder.n, COPY_MAX)
+    buf, n = encode_requests(reqs, bytearray())
+    self.assertEqual(b''.join(bytes(b) for b in bufs), bytes(buf[:n]))
+
+
+  def test_reset(self):
+    encoder = Encoder(size=8)
+    encoder.add([b'x' * 100])  # grows past its initial size
+    encoder.reset()
+    encoder.add(['get a'])
+    self.assertEqual([bytes(b) for b in encoder.buffers(memoryview(encoder.buf))],
+                     [b'get a\r\n'])
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,108 @@
+from sharded import Continuum, ShardedClient, ketama_hash
+
+import socket
+import threading
+import time
+import unittest
+
+
+SERVERS = [('127.0.0.1', 12300), ('127.0.0.1', 12301), ('127.0.0.1', 12302)]
+KEYS = [b'key:%d' % i for i in range(24)]
+# server index of each of KEYS as libketama's ketama_get_server() maps it
+EQUAL = [2, 2, 1, 0, 0, 1, 2, 0, 1, 0, 0, 2, 0, 2, 1, 2, 1, 0, 0, 1, 0, 1, 0, 0]
+WEIGHTED = [2, 2, 1, 0, 2, 2, 2, 0, 1, 0, 0, 2, 2, 2, 1, 2, 1, 0, 0, 1, 0, 1, 0, 1]
+
+
+class ContinuumTest(unittest.TestCase):
+
+  def test_hash(self):
+    # md5(b'') starts d4 1d 8c d9
+    self.assertEqual(ketama_hash(b''), 0xd98c1dd4)
+
+
+  def test_points(self):
+    self.assertEqual(len(Continuum(SERVERS).points), 480)
+    self.assertEqual(len(Continuum(SERVERS, [1, 1, 2]).points), 480)
+
+
+  def test_equal_weights(self):
+    continuum = Continuum(SERVERS)
+    self.assertEqual([continuum.index(key) for key in KEYS], EQUAL)
+
+
+  def test_weighted(self):
+    continuum = Continuum(SERVERS, [1, 1, 2])
+    self.assertEqual([continuum.index(key) for key in KEYS], WEIGHTED)
+    self.assertEqual(continuum.server(KEYS[4]), SERVERS[2])
+
+
+  def test_shares(self):
+    shares = Continuum(SERVERS, [1, 1, 2]).shares()
+    self.assertAlmostEqual(sum(shares), 1.0)
+    self.assertGreater(shares[2], max(shares[:2]))
+
+
+  def test_remove_server(self):
+    # only the keys of the server removed move
+    smaller = Continuum(SERVERS[:2])
+    for key, idx in zip(KEYS, EQUAL):
+      if idx < 2:
+        self.assertEqual(smaller.index(key), idx)
+
+
+  def test_invalid(self):
+    with self.assertRaises(ValueError):
+      Continuum([])
+    with self.assertRaises(ValueError):
+      Continuum(SERVERS, [1, 1])
+    with self.assertRaises(ValueError):
+      Continuum(SERVERS, [1, 0, 1])
+
+
+def serve_once(sock, pieces):
+  """accept one connection on sock, read a request and send pieces, each
+     (seconds to wait first, bytes)
+  """
+  conn, _ = sock.accept()
+  try:
+    conn.recv(4096)
+    for delay, data in pieces:
+      time.sleep(delay)
+      conn.sendall(data)
+    conn.recv(4096)  # until the client closes
+  finally:
+    conn.close()
+    sock.close()
+
+
+class FanOutTest(unittest.TestCase):
+
+  def test_late_shard_in_pieces(self):
+    # the slow shard sends half a response at once and the rest later; the
+    # fast one answers in between and must not wait for it
+    reply = b'VALUE k 0 1\r\nx\r\nEND\r\n'
+    pieces = [[(0.0, reply[:12]), (0.4, reply[12:])], [(0.1, reply)]]
+    servers, threads = [], []
+    for piece in pieces:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.bind(('127.0.0.1', 0))
+      sock.listen(1)
+      servers.append(sock.getsockname())
+      threads.append(threading.Thread(target=serve_once, args=(sock, piece)))
+      threads[-1].start()
+    client = ShardedClient(servers, request_timeout=1.0)
+    try:
+      results = client.fan_out({0: [b'k'], 1: [b'k']}, lambda keys: [[b'get k']])
+    finally:
+      client.close()
+      for thread in threads:
+        thread.join()
+    expected = [b'VALUE k 0 1', b'x', b'END']
+    self.assertEqual(results[0][0], [expected])
+    self.assertEqual(results[1][0], [expected])
+    self.assertLess(results[1][1], 0.3)
+    self.assertGreaterEqual(results[0][1], 0.4)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)